@@ -44,6 +44,8 @@ setup(
     ],
     extras_require={
         "tests": [
+            "cryptography>=42",
+            "pytest-benchmark>=4,<6",
             "pytest-cov>=6",
             "pytest-instafail==0.5.*",
             "pytest-mock==3.*",
@@ -58,7 +60,7 @@ setup(
     ],
     entry_points={
         "console_scripts": [
-            "nfhl-skid = nfhl.main:process",
+            "nfhl-skid = nfhl.main:cli",
         ]
     },
 )
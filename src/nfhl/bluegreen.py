@@ -0,0 +1,80 @@
+"""
+bluegreen.py: Blue/green loads into a standby hosted layer that a layer's public hosted view is then switched to
+"""
+
+
+def _service_name(url):
+    #: Hosted feature service urls end in .../rest/services/{service name}/FeatureServer
+    return url.rstrip("/").split("/")[-2]
+
+
+def _feature_layer_collection(gis, itemid):
+    from arcgis.features import FeatureLayerCollection
+
+    item = gis.content.get(itemid)
+    if item is None:
+        raise ValueError(f"Item {itemid} not found")
+    return FeatureLayerCollection.fromitem(item)
+
+
+def find_standby(gis, view_itemid, source_itemids):
+    """Find which of a hosted view's two source layers the view isn't using.
+
+    Args:
+        gis (arcgis.gis.GIS): The AGOL organization's gis object
+        view_itemid (str): The public hosted view's item id
+        source_itemids (list[str]): The item ids of the two hosted layers the view can be switched between
+
+    Raises:
+        ValueError: If the view's source isn't one of source_itemids
+
+    Returns:
+        tuple[str, str]: The item ids of the standby source (to load into) and the live source (that the view uses)
+    """
+
+    view = _feature_layer_collection(gis, view_itemid)
+    view_definition = view.layers[0].manager.properties["adminLayerInfo"]["viewLayerDefinition"]
+    live_service = view_definition["sourceServiceName"]
+    services = {itemid: _service_name(_feature_layer_collection(gis, itemid).url) for itemid in source_itemids}
+
+    live = [itemid for itemid, service in services.items() if service == live_service]
+    if not live:
+        raise ValueError(f"View {view_itemid} uses {live_service}, which isn't one of {list(source_itemids)}")
+    standby = [itemid for itemid in source_itemids if itemid != live[0]]
+    return standby[0], live[0]
+
+
+def hosted_count(gis, itemid):
+    """Count the features in a hosted layer.
+
+    Args:
+        gis (arcgis.gis.GIS): The AGOL organization's gis object
+        itemid (str): The hosted layer's item id
+
+    Returns:
+        int: Number of features in the item's first layer
+    """
+
+    return _feature_layer_collection(gis, itemid).layers[0].query(return_count_only=True)
+
+
+def switch_view(gis, view_itemid, source_itemid):
+    """Point a hosted view's layer at a different source layer with the same schema.
+
+    The view keeps its item id, url, sharing, and item-level settings (such as the hazard area symbology), so the maps
+    and apps that use it don't change. AGOL swaps the source by removing the view's layer and adding it back with the
+    new source, so requests in the instant between the two can fail, but readers never see a partial load. The old
+    source is left as it was, so switching back to it is an instant rollback.
+
+    Args:
+        gis (arcgis.gis.GIS): The AGOL organization's gis object
+        view_itemid (str): The hosted view's item id
+        source_itemid (str): The item id of the hosted layer to use as the view's source
+
+    Returns:
+        dict: AGOL's response to adding the view's layer back
+    """
+
+    view = _feature_layer_collection(gis, view_itemid)
+    source = _feature_layer_collection(gis, source_itemid).layers[0]
+    return view.manager.swap_view(0, source)
@@ -0,0 +1,157 @@
+"""
+budget.py: A run-wide deadline, shared retry budget, and circuit breaker so a bad FEMA day can't outlast the task
+"""
+
+import math
+import threading
+import time
+
+
+class BudgetExhausted(Exception):
+    """Raised instead of starting work that the run no longer has the time, retries, or a working FEMA for."""
+
+
+class RunBudget:
+    """Shared by every layer in a run to bound how long and how hard the run keeps trying.
+
+    The deadline is run_seconds after the budget is created, less summary_seconds held back to send the summary.
+    Every retry of a layer's extract, transform, or load comes out of the same max_retries, and after breaker_threshold
+    layers fail in a row the breaker opens and no more layers or FEMA requests are started. Any limit left as None
+    isn't applied.
+    """
+
+    def __init__(self, module_logger, run_seconds=None, summary_seconds=60, max_retries=None, breaker_threshold=None):
+        """
+        Args:
+            module_logger (logging.Logger): The skid's logger
+            run_seconds (float, optional): Wall-clock seconds the whole run has, such as a little under the task's
+                timeout. Defaults to None (no deadline).
+            summary_seconds (float, optional): Seconds held back from run_seconds to wrap up and send the summary.
+                Defaults to 60.
+            max_retries (int, optional): Retries shared by every layer. Defaults to None (only each call's own tries).
+            breaker_threshold (int, optional): Consecutive layer failures that open the breaker. Defaults to None
+                (never opens).
+        """
+
+        self._logger = module_logger
+        self._lock = threading.Lock()
+        self.deadline = None if run_seconds is None else time.monotonic() + run_seconds - summary_seconds
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+
+        self.retries = 0  #: retries taken so far, across every layer
+        self.consecutive_failures = 0
+        self.breaker_open = False
+
+    @property
+    def limited(self):
+        return self.deadline is not None or self.max_retries is not None or self.breaker_threshold is not None
+
+    def remaining(self):
+        """Seconds left before the deadline.
+
+        Returns:
+            float: Seconds left (negative once it has passed), or infinity without a deadline
+        """
+
+        return math.inf if self.deadline is None else self.deadline - time.monotonic()
+
+    def timeout(self):
+        """Seconds to wait for work that has to finish before the deadline.
+
+        Returns:
+            float: Seconds left (at least 0), or None to wait indefinitely without a deadline
+        """
+
+        return None if self.deadline is None else max(self.remaining(), 0)
+
+    def check(self, work):
+        """Make sure there's still time and a closed breaker before starting some work.
+
+        Args:
+            work (str): What's about to start, for the error message
+
+        Raises:
+            BudgetExhausted: If the deadline has passed or the breaker is open
+        """
+
+        if self.breaker_open:
+            raise BudgetExhausted(f"Not starting {work}: {self.consecutive_failures} layers failed in a row")
+        if self.remaining() <= 0:
+            raise BudgetExhausted(f"Not starting {work}: the run is out of time")
+
+    def _take_retry(self, work, wait):
+        with self._lock:
+            if self.max_retries is not None and self.retries >= self.max_retries:
+                raise BudgetExhausted(f"Not retrying {work}: all {self.max_retries} retries have been used")
+            if wait >= self.remaining():
+                raise BudgetExhausted(f"Not retrying {work}: the run would be out of time")
+            self.retries += 1
+
+    def retry(self, worker_method, *args, **kwargs):
+        """Call worker_method like palletjack's utils.retry, but take each retry from the run's budget.
+
+        worker_method is tried up to utils.RETRY_MAX_TRIES more times after a failure, waiting
+        utils.RETRY_DELAY_TIME ** n seconds before the nth retry. A retry isn't made (and the last error is raised,
+        chained to the reason) if the breaker is open, the shared retries are used up, or the wait would run past the
+        deadline. BudgetExhausted from worker_method (such as from a FEMA request) isn't retried.
+
+        Args:
+            worker_method (callable): The method to call
+
+        Raises:
+            Exception: worker_method's final error
+
+        Returns:
+            various: The value(s) returned by worker_method
+        """
+
+        from palletjack import utils
+
+        work = getattr(worker_method, "__name__", str(worker_method))
+        for tries in range(1, utils.RETRY_MAX_TRIES + 2):
+            self.check(work)
+            try:
+                return worker_method(*args, **kwargs)
+            except Exception as error:
+                if tries > utils.RETRY_MAX_TRIES or isinstance(error, BudgetExhausted):
+                    raise
+                wait_time = utils.RETRY_DELAY_TIME**tries
+                try:
+                    self._take_retry(work, wait_time)
+                except BudgetExhausted as exhausted:
+                    raise error from exhausted
+                self._logger.debug(
+                    'Exception "%s" thrown on "%s". Retrying after %s seconds...', error, work, wait_time
+                )
+                utils.sleep(wait_time)
+
+    def record_layer(self, name, success):
+        """Track consecutive layer failures and open the breaker after breaker_threshold of them.
+
+        Args:
+            name (str): The layer's name
+            success (bool): Whether the layer loaded
+        """
+
+        with self._lock:
+            if success:
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if (
+                self.breaker_threshold is not None
+                and not self.breaker_open
+                and self.consecutive_failures >= self.breaker_threshold
+            ):
+                self.breaker_open = True
+                self._logger.error(
+                    "%s layers in a row have failed (the last was %s), not starting any more",
+                    self.breaker_threshold,
+                    name,
+                )
+
+    def __str__(self):
+        retries = f"{self.retries}" if self.max_retries is None else f"{self.retries} of {self.max_retries}"
+        breaker = "open" if self.breaker_open else "closed"
+        return f"{retries} retries used, circuit breaker {breaker}"
@@ -0,0 +1,121 @@
+"""
+cache.py: On-disk GeoParquet cache of extracted layers so re-runs don't have to download them from FEMA again
+"""
+
+import hashlib
+import json
+import time
+from pathlib import Path
+
+import geopandas as gpd
+
+
+def cache_key(service_url, layer, fingerprint=None):
+    """Build a cache key that changes whenever the service, layer number, where clause, or upstream fingerprint change.
+
+    Including the fingerprint from state.probe_layer means an extract cached before FEMA changed the layer isn't
+    reused after it does, even within the TTL.
+
+    Args:
+        service_url (str): The MapServer's REST endpoint
+        layer (dict): The layer's entry in config.FEMA_LAYERS
+        fingerprint (dict, optional): The layer's upstream fingerprint from this run's probe. Defaults to None (not
+            probed).
+
+    Returns:
+        str: The layer name followed by a short digest of the query parameters
+    """
+
+    query = {"url": service_url, "number": layer["number"], "where_clause": layer["where_clause"]}
+    if fingerprint:
+        query["fingerprint"] = fingerprint
+    digest = hashlib.sha256(json.dumps(query, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return f"{layer['name']}_{digest}"
+
+
+def read(cache_dir, key, ttl, **read_kwargs):
+    """Get a cached extract if it exists and is younger than ttl.
+
+    Args:
+        cache_dir (str or Path): The cache directory
+        key (str): The extract's cache key
+        ttl (int): Maximum age of a cached extract in seconds
+        **read_kwargs (keyword arguments, optional): Arguments to pass through to gpd.read_parquet
+
+    Returns:
+        gpd.GeoDataFrame: The cached extract with its geometry in the SHAPE column, or None on a cache miss
+    """
+
+    cache_path = Path(cache_dir) / f"{key}.parquet"
+    try:
+        if time.time() - cache_path.stat().st_mtime > ttl:
+            cache_path.unlink(missing_ok=True)
+            return None
+        return gpd.read_parquet(cache_path, **read_kwargs)
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+
+
+def write(cache_dir, key, dataframe, ttl, max_bytes):
+    """Save an extract to the cache and then evict old entries.
+
+    The extract is written to a temporary file first so that a run killed partway through can't leave a truncated
+    entry behind.
+
+    Args:
+        cache_dir (str or Path): The cache directory
+        key (str): The extract's cache key
+        dataframe (pd.DataFrame): Spatially-enabled or geo-dataframe of the extracted features
+        ttl (int): Maximum age of a cached extract in seconds
+        max_bytes (int): Maximum total size of the cache in bytes
+
+    Returns:
+        Path: Path to the cached extract
+    """
+
+    from palletjack import utils
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_path = cache_dir / f"{key}.parquet"
+    temp_path = cache_dir / f"{key}.parquet.tmp"
+
+    utils.convert_to_gdf(dataframe).to_parquet(temp_path)
+    temp_path.replace(cache_path)
+
+    evict(cache_dir, ttl, max_bytes)
+
+    return cache_path
+
+
+def evict(cache_dir, ttl, max_bytes):
+    """Remove expired extracts, then the oldest extracts until the cache is no larger than max_bytes.
+
+    Args:
+        cache_dir (str or Path): The cache directory
+        ttl (int): Maximum age of a cached extract in seconds
+        max_bytes (int): Maximum total size of the cache in bytes
+
+    Returns:
+        list[Path]: The evicted files
+    """
+
+    now = time.time()
+    entries = []
+    for cache_path in Path(cache_dir).glob("*.parquet"):
+        try:
+            stats = cache_path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stats.st_mtime, stats.st_size, cache_path))
+
+    evicted = []
+    total_bytes = sum(size for _, size, _ in entries)
+    for modified, size, cache_path in sorted(entries, key=lambda entry: entry[0]):
+        if now - modified <= ttl and total_bytes <= max_bytes:
+            continue
+        cache_path.unlink(missing_ok=True)
+        total_bytes -= size
+        evicted.append(cache_path)
+
+    return evicted
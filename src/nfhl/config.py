@@ -2,52 +2,194 @@
 config.py: Configuration values. Secrets to be handled with Secrets Manager
 """
 
+import functools
 import logging
+import os
 import socket
-import urllib
 
 SKID_NAME = "nfhl_skid"
 
 AGOL_ORG = "https://utah-em.maps.arcgis.com"
 
-try:
-    url = "http://metadata.google.internal/computeMetadata/v1/project/project-id"
-    req = urllib.request.Request(url)
-    req.add_header("Metadata-Flavor", "Google")
-    with urllib.request.urlopen(req, timeout=15) as response:
-        project_id = response.read().decode()
-        if not project_id:
-            raise ValueError
-        HOST_NAME = project_id
-except Exception:
-    HOST_NAME = socket.gethostname()
-
-SENDGRID_SETTINGS = {  #: Settings for SendGridHandler
-    "from_address": "noreply@utah.gov",
-    "to_addresses": ["ugrc-developers@utah.gov", "hstrand@utah.gov"],
-    "prefix": f"{SKID_NAME} on {HOST_NAME}: ",
+
+@functools.cache
+def get_host_name():
+    """Get the GCP project id from the metadata server, or the machine's host name when not running in GCP.
+
+    This is only called (once) when HOST_NAME or SENDGRID_SETTINGS is first used, so that importing config doesn't
+    wait on the metadata server.
+
+    Returns:
+        str: The project id or host name
+    """
+
+    import urllib.request
+
+    try:
+        url = "http://metadata.google.internal/computeMetadata/v1/project/project-id"
+        req = urllib.request.Request(url)
+        req.add_header("Metadata-Flavor", "Google")
+        with urllib.request.urlopen(req, timeout=15) as response:
+            project_id = response.read().decode()
+            if not project_id:
+                raise ValueError
+            return project_id
+    except Exception:
+        return socket.gethostname()
+
+
+#: Settings that depend on the host name are built on first access by __getattr__ below
+_LAZY_SETTINGS = {
+    "HOST_NAME": get_host_name,
+    "SENDGRID_SETTINGS": lambda: {  #: Settings for SendGridHandler
+        "from_address": "noreply@utah.gov",
+        "to_addresses": ["ugrc-developers@utah.gov", "hstrand@utah.gov"],
+        "prefix": f"{SKID_NAME} on {get_host_name()}: ",
+    },
 }
+
+
+def __getattr__(name):
+    try:
+        value = _LAZY_SETTINGS[name]()
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    globals()[name] = value  #: cache it so later lookups don't come back here
+    return value
+
+
 LOG_LEVEL = logging.INFO
 LOG_FILE_NAME = "log"
+REPORT_FILE_NAME = "run_report"  #: json report of each layer's stage timings and sizes, attached to the summary
+PROMETHEUS_TEXTFILE_PATH = None  #: Also write the run's metrics to this .prom file for node_exporter; None disables
+#: Profile each layer's stages with cProfile and tracemalloc and attach the profiles to the summary (or run with
+#: nfhl-skid --profile)
+PROFILE = os.environ.get("NFHL_PROFILE", "").lower() in ["1", "true", "yes"]
+PROFILE_DIR_NAME = "profiles"  #: The profiles' directory in the run's tempdir, zipped into one attachment
+PROFILE_TOP_ALLOCATIONS = 25  #: Allocation sites listed in each stage's allocation report
 
 TIMEOUT = 20
+PAGE_SIZE = 100  #: Number of features requested from FEMA at a time (adjusted by the request controller)
+PARTITION_WORKERS = 4  #: Number of partitions of a layer (see "partitions" below) to download at the same time
+HTTP_POOL_SIZE = 16  #: Keep-alive connections to FEMA shared by every layer; at least max_concurrency below
+QUERY_FORMAT = "json"  #: "pbf" downloads features as Esri's protobuf from layers that support it, falling back to json
+REQUEST_CONTROLLER_SETTINGS = {  #: Limits for adapting requests to FEMA to how the server is responding
+    "concurrency": 2,  #: Requests in flight at once across all layers and partitions
+    "page_size": PAGE_SIZE,
+    "timeout": TIMEOUT,
+    "pause": 1.5,  #: Seconds to wait (plus up to the same again as jitter) before each request
+    "min_concurrency": 1,
+    "max_concurrency": 8,
+    "min_page_size": 25,
+    "max_page_size": 1000,
+    "min_timeout": 10,
+    "max_timeout": 120,
+    "min_pause": 0.5,
+    "max_pause": 30,
+    "target_latency": 5,  #: Only speed up while requests average less than this many seconds
+    "max_tries": 4,
+}
+MAX_WORKERS = 1  #: Number of layers to extract, transform, and load at the same time; 1 processes them in order
+RUN_SECONDS = None  #: Wall-clock budget for the run, eg a little under the task timeout; None doesn't set a deadline
+SUMMARY_SECONDS = 60  #: Seconds held back from RUN_SECONDS to update the symbology and send the summary
+RETRY_BUDGET = None  #: Retries shared by every layer's extract, transform, and load; None only limits each call
+BREAKER_THRESHOLD = None  #: Stop starting layers and FEMA requests once this many layers fail in a row; None never does
+FANOUT_TOPIC = None  #: Pub/Sub topic (projects/{project}/topics/{topic}) to send layers to workers on; "local" to test
+FANOUT_RESULTS_DIR = None  #: Directory or fsspec url shared with the workers for their results; None uses the tempdir
+FANOUT_TIMEOUT = 60 * 60 * 3  #: Seconds to wait for the workers to report back (no longer than RUN_SECONDS allows)
+FANOUT_POLL_SECONDS = 15  #: Seconds between checks for the workers' results
+STREAM_BATCH_SIZE = None  #: Extract, transform, and load layers in batches of this many features; None disables
+DELTA_SYNC = False  #: Only send added, changed, and deleted features instead of truncating and loading each layer
+DELTA_SYNC_KEY = "global_id"  #: Unique key for matching features; override per layer with a "key_field" entry
+DELTA_SYNC_GRID_SIZE = 0.0000001  #: Coordinates are snapped to this grid before hashing to ignore storage rounding
+ENRICHMENT = False  #: Copy each layer's "enrich" fields from the layers it falls on; the hosted layers need the fields
+STATE_MANIFEST_PATH = None  #: json file of upstream fingerprints from the last run; unchanged layers are skipped
+EXTRACT_CACHE_DIR = None  #: Directory for GeoParquet copies of each extract so re-runs can skip FEMA; None disables
+EXTRACT_CACHE_TTL = 60 * 60 * 24  #: Seconds a cached extract can be reused
+EXTRACT_CACHE_MAX_BYTES = 2 * 1024**3  #: The oldest cached extracts are removed when the cache grows past this size
+ARROW_DTYPES = False  #: Hold extracts in pyarrow-backed strings and each layer's "category_fields" as categoricals
+OUTPUT_SINKS = ["agol"]  #: Where to write each transformed layer: any of "agol", "geoparquet", and "vector_tiles"
+GEOPARQUET_OUTPUT_DIR = None  #: Directory or fsspec url (eg gs://bucket/nfhl, needs gcsfs) for the geoparquet sink
+VECTOR_TILE_OUTPUT_DIR = None  #: Directory or fsspec url for the vector_tiles sink's tile packages and styles
+VECTOR_TILE_FORMAT = "pmtiles"  #: "pmtiles" or "mbtiles"
+VECTOR_TILE_BASE_URL = None  #: Public url the tile packages are served from, for the styles; None uses the output path
+BLUE_GREEN = False  #: Load layers with "source_itemids" into their standby source and then switch their view to it
+GEOMETRY_QUARANTINE_DIR = None  #: Directory or fsspec url for geoparquet files of features with unfixable geometries
 SERVICE_URL = "https://hazards.fema.gov/arcgis/rest/services/public/NFHL/MapServer"
 DFIRM_WHERE = "DFIRM_ID LIKE '49%'"
+DFIRM_CATEGORY_FIELDS = ["dfirm_id", "source_cit"]  #: Low-cardinality fields shared by the DFIRM layers
+#: The FIRM panel and flood zone each feature is on, as {layer: {its field: the new field}} (see "enrich" below)
+PANEL_AND_ZONE_ENRICHMENT = {
+    "S_FIRM_Pan": {"firm_pan": "firm_pan"},
+    "S_Fld_Haz_Ar": {"fld_zone": "fld_zone", "label": "zone_label"},
+}
+#: Polygon file or ArcGIS layer url (such as UGRC's Utah state boundary layer, .../FeatureServer/0) to clip layers with
+#: "clip_to_boundary" to; None uses the approximate boundary bundled with the skid
+CLIP_BOUNDARY_PATH = None
 LAT_LON_WHERE = "LAT > 36.95 and LAT < 42.05 AND LON > -114.05 AND LON < -109.04 AND NOT (LAT > 41 AND LON >-111.05)"
+
+#: Countywide DFIRM_IDs start with the county's FIPS code (49001C...49057C), so there's a partition for each county
+#: plus one for every DFIRM_ID that doesn't start with a county code (ie, community-based IDs).
+UTAH_COUNTY_FIPS = [f"49{county:03d}" for county in range(1, 58, 2)]
+DFIRM_PARTITIONS = [{"name": fips, "where_clause": f"DFIRM_ID LIKE '{fips}C%'"} for fips in UTAH_COUNTY_FIPS] + [
+    {
+        "name": "other",
+        "where_clause": " AND ".join([DFIRM_WHERE] + [f"DFIRM_ID NOT LIKE '{fips}C%'" for fips in UTAH_COUNTY_FIPS]),
+    }
+]
+#: Alternatively, split a layer into a grid of tiles over Utah's extent. Features crossing tile boundaries are
+#: returned by more than one tile and de-duplicated after download.
+UTAH_EXTENT = (-114.06, 36.99, -109.04, 42.01)  #: xmin, ymin, xmax, ymax in WGS84
+TILE_ROWS = TILE_COLUMNS = 3
+TILE_WIDTH = (UTAH_EXTENT[2] - UTAH_EXTENT[0]) / TILE_COLUMNS
+TILE_HEIGHT = (UTAH_EXTENT[3] - UTAH_EXTENT[1]) / TILE_ROWS
+UTAH_TILES = [
+    {
+        "name": f"tile_{row}_{column}",
+        "where_clause": DFIRM_WHERE,
+        "envelope_params": {
+            "geometry": f"{UTAH_EXTENT[0] + column * TILE_WIDTH:.4f},{UTAH_EXTENT[1] + row * TILE_HEIGHT:.4f},"
+            f"{UTAH_EXTENT[0] + (column + 1) * TILE_WIDTH:.4f},{UTAH_EXTENT[1] + (row + 1) * TILE_HEIGHT:.4f}",
+            "inSR": "4326",
+        },
+    }
+    for row in range(TILE_ROWS)
+    for column in range(TILE_COLUMNS)
+]
+
+#: Layers with "simplify_tolerance" and/or "xy_precision" have their geometries simplified (preserving topology) and
+#: their coordinates snapped to a grid before loading. Both are in the extract's units (degrees); 0.00001 is about 1m.
+#: No layer is generalized by default because it changes FEMA's published geometry (see the README for examples).
+#: Layers with "enrich" get fields copied from the features of other layers that they fall on when ENRICHMENT is on.
+#: Points are matched by their location, lines by their midpoint, and polygons by a point inside them.
+#: Layers with "clip_to_boundary" only keep the features within CLIP_BOUNDARY_PATH's polygon after they're
+#: extracted, so their where clauses can stay coarse.
+#: Layers with "source_itemids" (two hosted layers with the same schema) are loaded blue/green when BLUE_GREEN is on:
+#: their "itemid" must be a hosted view of one of the two, the other is loaded, and the view is switched to it once
+#: its count checks out.
+#: Layers with "vector_tiles" get a tile package of their "fields" between "min_zoom" and "max_zoom" from the
+#: vector_tiles sink.
+#: Layers with "partitions" are downloaded as several smaller queries instead of one. Each partition has a unique name
+#: and a where_clause and/or envelope_params that replace the layer's. No layer is partitioned by default; add
+#: "partitions": DFIRM_PARTITIONS (or UTAH_TILES) to a layer whose single query keeps timing out.
 FEMA_LAYERS = {
     "S_LOMR": {
         "number": 1,
         "itemid": "647c5dfc31044b0aba7611f0b7b3ed62",
         "name": "S_LOMR",
         "date_fields": ["eff_date"],
+        "change_date_field": "EFF_DATE",
         "where_clause": DFIRM_WHERE,
+        "category_fields": DFIRM_CATEGORY_FIELDS,
     },
     "S_FIRM_Pan": {
         "number": 3,
         "itemid": "cb041caea3ad4b48bef4502e10e14368",
         "name": "S_FIRM_Pan",
         "date_fields": ["pre_date", "eff_date"],
+        "change_date_field": "EFF_DATE",
         "where_clause": DFIRM_WHERE,
+        "category_fields": DFIRM_CATEGORY_FIELDS,
     },
     "S_XS": {
         "number": 14,
@@ -55,26 +197,32 @@ FEMA_LAYERS = {
         "name": "S_XS",
         "double_fields": ["stream_stn", "wsel_reg", "strmbed_el"],
         "int_fields": ["seq"],
+        "enrich": PANEL_AND_ZONE_ENRICHMENT,
         "where_clause": DFIRM_WHERE,
+        "category_fields": DFIRM_CATEGORY_FIELDS,
     },
     "S_BFE": {
         "number": 16,
         "itemid": "8cab946b96d94167bd75314c32584d1a",
         "name": "S_BFE",
         "double_fields": ["elev"],
+        "enrich": PANEL_AND_ZONE_ENRICHMENT,
         "where_clause": DFIRM_WHERE,
+        "category_fields": DFIRM_CATEGORY_FIELDS,
     },
     "S_PROFIL_BASLN": {
         "number": 17,
         "itemid": "c0e92cf18ed14dc883b5ce9cae69e288",
         "name": "S_PROFIL_BASLN",
         "where_clause": DFIRM_WHERE,
+        "category_fields": DFIRM_CATEGORY_FIELDS,
     },
     "S_Wtr_Ln": {
         "number": 20,
         "itemid": "f784f6c8b32a4f7abe180c4e37ffb8d6",
         "name": "S_Wtr_Ln",
         "where_clause": DFIRM_WHERE,
+        "category_fields": DFIRM_CATEGORY_FIELDS,
     },
     "S_LEVEE": {
         "number": 23,
@@ -83,6 +231,7 @@ FEMA_LAYERS = {
         "date_fields": ["const_date", "pal_date"],
         "double_fields": ["freeboard"],
         "where_clause": DFIRM_WHERE,
+        "category_fields": DFIRM_CATEGORY_FIELDS,
     },
     "S_Fld_Haz_Ar": {
         "number": 28,
@@ -90,13 +239,22 @@ FEMA_LAYERS = {
         "name": "S_Fld_Haz_Ar",
         "double_fields": ["static_bfe", "depth", "velocity", "bfe_revert", "dep_revert"],
         "where_clause": DFIRM_WHERE,
+        "category_fields": DFIRM_CATEGORY_FIELDS + ["fld_zone", "zone_subty"],
+        "vector_tiles": {
+            "fields": ["label", "fld_zone", "zone_subty", "sfha_tf", "static_bfe", "dfirm_id"],
+            "min_zoom": 4,
+            "max_zoom": 14,
+        },
     },
     "S_LOMAs": {
         "number": 34,
         "itemid": "db07fd59e21846a993c32b1d048ba38f",
         "name": "S_LOMAs",
         "date_fields": ["dateended"],
+        "change_date_field": "DATEENDED",
         "where_clause": LAT_LON_WHERE,
+        "clip_to_boundary": True,
+        "enrich": PANEL_AND_ZONE_ENRICHMENT,
         "double_fields": ["lat", "lon"],
     },
 }
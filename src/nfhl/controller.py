@@ -0,0 +1,189 @@
+"""
+controller.py: Adaptive concurrency, page size, timeout, and pacing for requests to FEMA's map service
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RequestController:
+    """Shared by every extraction request in a run to adapt how hard the skid pushes FEMA's server.
+
+    Uses additive-increase/multiplicative-decrease: every time a full round of requests (one per concurrency slot)
+    succeeds with an average latency under target_latency, concurrency goes up by one, the page size by min_page_size,
+    and the pause between requests shrinks. Any failure or request that takes most of its timeout halves concurrency
+    and page size and doubles the pause. Decreases are limited to one per average request latency so that a burst of
+    failures from requests that were already in flight only counts once. The timeout follows the observed latency.
+    Every change is logged so the limits can be tuned.
+    """
+
+    def __init__(
+        self,
+        module_logger,
+        concurrency=2,
+        page_size=100,
+        timeout=20,
+        pause=1.5,
+        min_concurrency=1,
+        max_concurrency=8,
+        min_page_size=25,
+        max_page_size=1000,
+        min_timeout=10,
+        max_timeout=120,
+        min_pause=0.5,
+        max_pause=30,
+        target_latency=5,
+        max_tries=4,
+        run_budget=None,
+        session=None,
+    ):
+        """
+        Args:
+            module_logger (logging.Logger): The skid's logger
+            concurrency (int, optional): Starting number of simultaneous requests. Defaults to 2.
+            page_size (int, optional): Starting number of features per page. Defaults to 100.
+            timeout (int, optional): Starting request timeout in seconds. Defaults to 20.
+            pause (float, optional): Starting pause before each request in seconds. Defaults to 1.5.
+            min_concurrency, max_concurrency (int, optional): Concurrency limits. Default to 1 and 8.
+            min_page_size, max_page_size (int, optional): Page size limits. Default to 25 and 1000.
+            min_timeout, max_timeout (int, optional): Timeout limits in seconds. Default to 10 and 120.
+            min_pause, max_pause (float, optional): Pause limits in seconds. Default to 0.5 and 30.
+            target_latency (float, optional): Only speed up while the average latency is below this. Defaults to 5.
+            max_tries (int, optional): Attempts per request in call(). Defaults to 4.
+            run_budget (budget.RunBudget, optional): Checked before each attempt in call() so that no requests are
+                started after the run's deadline or once its circuit breaker opens. Defaults to None.
+            session (requests.Session, optional): The run's pooled session for requests to FEMA, kept here so that
+                every layer's requests share it. Defaults to None.
+        """
+
+        self._logger = module_logger
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.timeout = timeout
+        self.pause = pause
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_pause = min_pause
+        self.max_pause = max_pause
+        self.target_latency = target_latency
+        self.max_tries = max_tries
+        self.run_budget = run_budget
+        self.session = session
+
+        self.latency = None  #: exponentially-weighted average request time in seconds
+        self.error_rate = 0.0  #: exponentially-weighted fraction of failed requests
+        self.requests = 0  #: total requests made (including retries) for the run report
+        self.failed_requests = 0
+        self._active = 0
+        self._round_successes = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Wait for a free concurrency slot, then time the request made inside the context and record its outcome."""
+
+        with self._condition:
+            while self._active >= self.concurrency:
+                self._condition.wait()
+            self._active += 1
+
+        start = time.monotonic()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            with self._condition:
+                self._active -= 1
+                self.record(time.monotonic() - start, success)
+                self._condition.notify_all()
+
+    def call(self, worker_method, *args, **kwargs):
+        """Call worker_method in a concurrency slot after the current pause, retrying up to max_tries times.
+
+        Use this instead of utils.retry for requests to FEMA so that the pacing and backoff come from the controller.
+
+        Args:
+            worker_method (callable): The request to make
+
+        Raises:
+            budget.BudgetExhausted: If the run's budget doesn't allow another attempt
+            Exception: The final error if every attempt fails
+
+        Returns:
+            various: The value(s) returned by worker_method
+        """
+
+        for attempt in range(1, self.max_tries + 1):
+            if self.run_budget is not None:
+                self.run_budget.check("a request to FEMA")
+            #: jitter the pause so that concurrent requests don't all hit the server at once
+            time.sleep(self.pause * random.uniform(1, 2))
+            try:
+                with self.slot():
+                    return worker_method(*args, **kwargs)
+            except Exception as error:
+                if attempt == self.max_tries:
+                    raise
+                self._logger.debug("Request attempt %s of %s failed: %s", attempt, self.max_tries, error)
+
+    def record(self, latency, success):
+        """Update the latency and error averages with one request's outcome and adjust the limits.
+
+        Args:
+            latency (float): How long the request took in seconds
+            success (bool): Whether the request succeeded
+        """
+
+        self.requests += 1
+        self.failed_requests += 0 if success else 1
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.error_rate = 0.8 * self.error_rate + 0.2 * (0 if success else 1)
+
+        if not success or latency > 0.8 * self.timeout:
+            self._decrease("request failed" if not success else f"slow request ({latency:.1f}s)")
+            return
+
+        self._round_successes += 1
+        if self._round_successes >= self.concurrency and self.latency < self.target_latency:
+            self._increase()
+
+    def _decrease(self, reason):
+        self._round_successes = 0
+        now = time.monotonic()
+        if now - self._last_decrease < max(1.0, self.latency or 0):
+            return
+        self._last_decrease = now
+
+        self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        self.page_size = max(self.min_page_size, self.page_size // 2)
+        self.timeout = min(self.max_timeout, self.timeout * 1.5)
+        self.pause = min(self.max_pause, self.pause * 2)
+        self._log_decision(f"Backing off after {reason}")
+
+    def _increase(self):
+        self._round_successes = 0
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        self.page_size = min(self.max_page_size, self.page_size + self.min_page_size)
+        self.timeout = min(self.max_timeout, max(self.min_timeout, 4 * self.latency))
+        self.pause = max(self.min_pause, self.pause * 0.8)
+        self._log_decision("Speeding up")
+
+    def _log_decision(self, decision):
+        self._logger.info(
+            "%s: concurrency %s, page size %s, timeout %.0fs, pause %.1fs (latency %.1fs, error rate %.0f%%)",
+            decision,
+            self.concurrency,
+            self.page_size,
+            self.timeout,
+            self.pause,
+            self.latency,
+            self.error_rate * 100,
+        )
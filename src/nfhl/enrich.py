@@ -0,0 +1,124 @@
+"""
+enrich.py: Spatially-indexed lookups that copy attributes (panel ids, flood zones) from one layer onto another's features
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+
+def representative_points(geometries):
+    """Reduce geometries to the single point used to look them up.
+
+    Points are used as-is, lines by their midpoint (ie, where a cross section crosses the channel), and polygons by a
+    point guaranteed to be inside them. Missing geometries stay missing.
+
+    Args:
+        geometries (gpd.GeoSeries): The geometries to reduce
+
+    Returns:
+        np.ndarray: Shapely points (or None) in the same order as geometries
+    """
+
+    values = np.asarray(geometries.values, dtype=object)
+    type_ids = shapely.get_type_id(values)
+    points = values.copy()
+    lines = np.isin(type_ids, [1, 2, 5])  #: LineString, LinearRing, MultiLineString
+    polygons = np.isin(type_ids, [3, 6])  #: Polygon, MultiPolygon
+    points[lines] = shapely.line_interpolate_point(values[lines], 0.5, normalized=True)
+    points[polygons] = shapely.point_on_surface(values[polygons])
+    return points
+
+
+class SpatialLookup:
+    """An STRtree over a reference layer's geometries and the attributes to copy from them.
+
+    Built once after the reference layer is transformed and then shared (read-only) by every layer enriched from it.
+    """
+
+    def __init__(self, layer_name, layer_df, fields):
+        """
+        Args:
+            layer_name (str): The reference layer's name
+            layer_df (gpd.GeoDataFrame): The reference layer after its transform
+            fields (list[str]): The fields that other layers copy
+        """
+
+        self.layer_name = layer_name
+        self.crs = layer_df.geometry.crs
+        geometries = np.asarray(layer_df.geometry.values, dtype=object)
+        self._tree = shapely.STRtree(geometries)
+        #: Copy just the needed columns so the lookup doesn't keep the whole layer alive after it's loaded
+        self._attributes = {field: layer_df[field].array.copy() for field in fields}
+
+    def __len__(self):
+        return len(self._tree)
+
+    def match(self, points):
+        """Find the reference feature each point falls on, in one bulk STRtree query.
+
+        Points on the boundary between two reference features (such as adjoining panels) are matched to the first.
+
+        Args:
+            points (np.ndarray): Shapely points (or None)
+
+        Returns:
+            np.ndarray: Position of the matching reference feature for each point, or -1 if there isn't one
+        """
+
+        point_positions, tree_positions = self._tree.query(points, predicate="intersects")
+        #: Results are sorted by point, so the first of each point's results is at its first occurrence
+        matched_points, first = np.unique(point_positions, return_index=True)
+        matches = np.full(len(points), -1, dtype=np.intp)
+        matches[matched_points] = tree_positions[first]
+        return matches
+
+    def take(self, field, matches, index):
+        """Get a field's values for each match, keeping its dtype (eg, categoricals) and using nulls for no match.
+
+        Args:
+            field (str): One of the lookup's fields
+            matches (np.ndarray): Positions from match()
+            index (pd.Index): Index for the resulting series
+
+        Returns:
+            pd.Series: The field's values for each match
+        """
+
+        return pd.Series(pd.api.extensions.take(self._attributes[field], matches, allow_fill=True), index=index)
+
+
+def enrich(module_logger, layer_name, layer_df, lookups, enrichment):
+    """Add fields from reference layers to each feature of a layer based on where it falls.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        layer_name (str): The layer's name for logging
+        layer_df (gpd.GeoDataFrame): The layer after its transform
+        lookups (dict): SpatialLookup for each reference layer name
+        enrichment (dict): {reference layer name: {reference field: new field}}, ie, the layer's "enrich" entry
+
+    Returns:
+        gpd.GeoDataFrame: layer_df with the new fields
+    """
+
+    if layer_df.empty:
+        return layer_df
+
+    for reference_name, fields in enrichment.items():
+        lookup = lookups[reference_name]
+        geometries = layer_df.geometry
+        if geometries.crs and lookup.crs and not geometries.crs.equals(lookup.crs):
+            geometries = geometries.to_crs(lookup.crs)
+        matches = lookup.match(representative_points(geometries))
+        for field, new_field in fields.items():
+            layer_df[new_field] = lookup.take(field, matches, layer_df.index)
+        module_logger.info(
+            "Enriched %s from %s: matched %s of %s features",
+            layer_name,
+            reference_name,
+            f"{(matches >= 0).sum():,}",
+            f"{len(matches):,}",
+        )
+
+    return layer_df
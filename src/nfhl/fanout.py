@@ -0,0 +1,208 @@
+"""
+fanout.py: Messages, queues, and shared results for fanning a run's layers out to workers on other instances
+"""
+
+import base64
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def _is_url(path):
+    return "://" in str(path)
+
+
+def _run_dir(results_dir, run_id):
+    return f"{str(results_dir).rstrip('/')}/{run_id}"
+
+
+def encode(run_id, layer_names, results_dir, fingerprints=None):
+    """Build a worker message's data.
+
+    Args:
+        run_id (str): The coordinator's run, which the worker's results are filed under
+        layer_names (list[str]): The layers for the worker to process
+        results_dir (str): Directory or fsspec url the worker writes its results to
+        fingerprints (dict, optional): The coordinator's upstream fingerprint of each layer, so the worker doesn't use
+            a cached extract from before FEMA changed it. Defaults to None.
+
+    Returns:
+        bytes: The message data
+    """
+
+    message = {
+        "run_id": run_id,
+        "layers": list(layer_names),
+        "results_dir": str(results_dir),
+        "fingerprints": fingerprints or {},
+    }
+    return json.dumps(message).encode("utf-8")
+
+
+def decode(event):
+    """Get the message data from a Pub/Sub event.
+
+    Args:
+        event (dict): The PubsubMessage from a background function trigger (as in pubsub.sh) or the body of a push
+            subscription's request, which wraps it in "message". Its "data" is base64-encoded.
+
+    Returns:
+        dict: The run_id, layers, results_dir, and fingerprints from encode()
+    """
+
+    message = event.get("message", event)
+    return json.loads(base64.b64decode(message["data"]))
+
+
+def _result_name(layer_names):
+    #: A worker's layers are only ever sent in one message per run, so the first one names its results
+    return f"{layer_names[0]}.json"
+
+
+def write_result(results_dir, run_id, layer_names, result):
+    """Save a worker's results where the coordinator will look for them.
+
+    Local files are written to a temporary file and renamed into place so the coordinator never reads a partial file.
+    Urls need fsspec and the filesystem's implementation (eg, gcsfs for gs://) to be installed.
+
+    Args:
+        results_dir (str or Path): Directory or fsspec url from the worker's message
+        run_id (str): The coordinator's run
+        layer_names (list[str]): The layers from the worker's message
+        result (dict): What the worker has to report, which must be json-serializable
+
+    Returns:
+        str: The results file's path or url
+    """
+
+    contents = json.dumps(result, default=str)
+    result_path = f"{_run_dir(results_dir, run_id)}/{_result_name(layer_names)}"
+    if _is_url(results_dir):
+        import fsspec
+
+        with fsspec.open(result_path, "w", encoding="utf-8") as result_file:
+            result_file.write(contents)
+        return result_path
+
+    result_path = Path(result_path)
+    result_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = result_path.with_suffix(".tmp")
+    temp_path.write_text(contents, encoding="utf-8")
+    temp_path.replace(result_path)
+    return str(result_path)
+
+
+def read_results(results_dir, run_id):
+    """Read the results the workers have saved for a run so far.
+
+    Args:
+        results_dir (str or Path): Directory or fsspec url the workers write their results to
+        run_id (str): The coordinator's run
+
+    Returns:
+        dict: Each worker's result, by its results file's name
+    """
+
+    run_dir = _run_dir(results_dir, run_id)
+    if _is_url(results_dir):
+        import fsspec
+
+        filesystem, root = fsspec.core.url_to_fs(run_dir)
+        return {Path(path).name: json.loads(filesystem.cat_file(path)) for path in filesystem.glob(f"{root}/*.json")}
+
+    return {path.name: json.loads(path.read_text(encoding="utf-8")) for path in Path(run_dir).glob("*.json")}
+
+
+def wait_for_results(results_dir, run_id, groups, timeout=None, poll_seconds=15):
+    """Wait until every worker has saved its results or the timeout runs out.
+
+    Args:
+        results_dir (str or Path): Directory or fsspec url the workers write their results to
+        run_id (str): The coordinator's run
+        groups (list[list[str]]): The layers sent in each message
+        timeout (float, optional): Seconds to wait. Defaults to None (wait until they're all in).
+        poll_seconds (float, optional): Seconds between checks. Defaults to 15.
+
+    Returns:
+        dict: Each worker's result by the layers sent to it as a tuple, for the workers that finished in time
+    """
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        results = read_results(results_dir, run_id)
+        if all(_result_name(group) in results for group in groups):
+            break
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            break
+        time.sleep(poll_seconds if remaining is None else min(poll_seconds, remaining))
+
+    return {tuple(group): results[_result_name(group)] for group in groups if _result_name(group) in results}
+
+
+class PubSubQueue:
+    """Publishes worker messages to a Pub/Sub topic. Needs google-cloud-pubsub to be installed."""
+
+    def __init__(self, topic_path):
+        """
+        Args:
+            topic_path (str): The topic, as projects/{project}/topics/{topic}
+        """
+
+        from google.cloud import pubsub_v1
+
+        self.topic_path = topic_path
+        self._publisher = pubsub_v1.PublisherClient()
+
+    def publish(self, data):
+        """Publish a message and wait for Pub/Sub to accept it.
+
+        Args:
+            data (bytes): The message data
+
+        Returns:
+            str: The message's id
+        """
+
+        return self._publisher.publish(self.topic_path, data).result()
+
+    def close(self):
+        self._publisher.stop()
+
+
+class LocalQueue:
+    """An in-process stand-in for Pub/Sub that delivers each message to a subscriber on a background thread.
+
+    Messages are delivered the way a Pub/Sub trigger does, as an event with base64-encoded data, so the whole
+    coordinator, worker, and aggregation flow can run locally and in tests.
+    """
+
+    def __init__(self, subscriber, workers=1):
+        """
+        Args:
+            subscriber (callable): Called with each message's event, like a worker's entry point
+            workers (int, optional): Messages delivered at the same time. Defaults to 1.
+        """
+
+        self._subscriber = subscriber
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout")
+        self.published = 0
+
+    def publish(self, data):
+        """Queue a message for delivery.
+
+        Args:
+            data (bytes): The message data
+
+        Returns:
+            str: The message's id
+        """
+
+        self.published += 1
+        self._executor.submit(self._subscriber, {"data": base64.b64encode(data).decode("ascii")})
+        return str(self.published)
+
+    def close(self):
+        #: Don't wait for workers that are still running, the coordinator has already given up on them
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,203 @@
+"""
+geometry.py: Vectorized geometry generalization, clipping, and validation to shrink and check what gets uploaded to AGOL
+"""
+
+import functools
+import re
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+
+def _size(geometries, chunk_size=10_000):
+    #: Measure WKB in chunks so that sizing a large layer doesn't hold a second copy of all its geometries in memory
+    vertices = int(shapely.get_num_coordinates(geometries).sum())
+    wkb_bytes = 0
+    for start in range(0, len(geometries), chunk_size):
+        wkb_bytes += sum(len(wkb) for wkb in shapely.to_wkb(geometries[start : start + chunk_size]) if wkb is not None)
+    return vertices, wkb_bytes
+
+
+def generalize(module_logger, layer_name, geometries, simplify_tolerance=None, xy_precision=None, coverage=True):
+    """Simplify geometries while preserving topology and snap their coordinates to a grid.
+
+    Polygons are simplified together with shapely.coverage_simplify (when available) so that edges shared by adjacent
+    polygons are simplified the same way and don't open gaps or overlaps between them. Other geometries are simplified
+    individually with the Douglas-Peucker algorithm, preserving their topology. The coordinates are then snapped to a
+    grid of xy_precision with shapely.set_precision, which keeps the output valid. Geometries that collapse when
+    snapped (slivers smaller than the grid) become None so they are dropped with the other empty geometries. Invalid
+    geometries make GEOS raise a TopologyException for the whole array, so they are left as they are and reported;
+    run validate first to repair them.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        layer_name (str): The layer's name for logging
+        geometries (gpd.GeoSeries): The layer's geometries
+        simplify_tolerance (float, optional): Maximum distance a simplified edge can move, in the layer's coordinate
+            units. Defaults to None (don't simplify).
+        xy_precision (float, optional): Size of the grid to snap coordinates to, in the layer's coordinate units.
+            Defaults to None (don't snap).
+        coverage (bool, optional): Simplify the polygons together as a coverage. Only do this when geometries holds
+            every polygon of the layer; simplifying parts of a coverage separately opens gaps and overlaps along the
+            edges they share. Defaults to True.
+
+    Returns:
+        gpd.GeoSeries: The generalized geometries with the same index and crs
+    """
+
+    values = np.asarray(geometries.values, dtype=object).copy()
+    vertices_before, bytes_before = _size(values)
+    already_empty = shapely.is_missing(values) | shapely.is_empty(values)
+    invalid = ~already_empty & ~shapely.is_valid(values)
+    present = ~already_empty & ~invalid
+
+    if simplify_tolerance:
+        polygons = present & np.isin(shapely.get_type_id(values), [3, 6])  #: Polygon, MultiPolygon
+        if coverage and polygons.any() and hasattr(shapely, "coverage_simplify"):
+            values[polygons] = shapely.coverage_simplify(values[polygons], simplify_tolerance)
+            others = present & ~polygons
+        else:
+            others = present
+        values[others] = shapely.simplify(values[others], simplify_tolerance, preserve_topology=True)
+
+    if xy_precision:
+        values[present] = shapely.set_precision(values[present], xy_precision)
+
+    collapsed = shapely.is_empty(values) & ~already_empty
+    values[collapsed] = None
+
+    if invalid.any():
+        module_logger.warning("Left %s invalid geometries in %s ungeneralized", f"{invalid.sum():,}", layer_name)
+
+    vertices_after, bytes_after = _size(values)
+    module_logger.info(
+        "Generalized %s: %s to %s vertices, %.1f to %.1f MB of WKB (%s geometries collapsed)",
+        layer_name,
+        f"{vertices_before:,}",
+        f"{vertices_after:,}",
+        bytes_before / 1024**2,
+        bytes_after / 1024**2,
+        int(collapsed.sum()),
+    )
+
+    return gpd.GeoSeries(values, index=geometries.index, crs=geometries.crs, name=geometries.name)
+
+
+@functools.cache
+def read_boundary(path):
+    """Read a boundary file or layer and union its features into a single prepared polygon. Cached for each path.
+
+    An ArcGIS feature or map service layer's url (ending in FeatureServer/0 or MapServer/0, for example) is queried
+    for all of its features as GeoJSON in WGS84.
+
+    Args:
+        path (str or Path): Any file GDAL can read, such as the bundled utah_boundary.geojson, or the url of an ArcGIS
+            layer, such as UGRC's Utah state boundary layer
+
+    Raises:
+        ValueError: If the file or layer doesn't have any polygons, such as a service's error response
+
+    Returns:
+        tuple[shapely.Geometry, pyproj.CRS]: The prepared boundary and its coordinate reference system
+    """
+
+    if re.search(r"/(Feature|Map)Server/\d+/?$", str(path)):
+        path = f"{str(path).rstrip('/')}/query?where=1%3D1&outFields=*&outSR=4326&f=geojson"
+    boundary_df = gpd.read_file(path)
+    boundary = shapely.union_all(boundary_df.geometry.values)
+    if shapely.is_empty(boundary) or shapely.get_dimensions(boundary) != 2:
+        raise ValueError(f"{path} doesn't have a boundary polygon")
+    shapely.prepare(boundary)
+    return boundary, boundary_df.crs
+
+
+def clip_to_boundary(module_logger, layer_name, geometries, boundary, boundary_crs):
+    """Find which geometries fall within a boundary polygon.
+
+    Points are tested against the prepared boundary in one vectorized shapely.contains_xy call on their coordinates,
+    and any other geometries are kept if they intersect it. Geometries aren't cut at the boundary. Missing and empty
+    geometries are kept so that they are reported and dropped with the other empty geometries.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        layer_name (str): The layer's name for logging
+        geometries (gpd.GeoSeries): The layer's geometries
+        boundary (shapely.Geometry): The boundary polygon, from read_boundary
+        boundary_crs (pyproj.CRS): The boundary's coordinate reference system. The boundary is reprojected to the
+            geometries' crs if they differ.
+
+    Returns:
+        np.ndarray: Boolean mask of the geometries to keep
+    """
+
+    if geometries.crs and boundary_crs and not geometries.crs.equals(boundary_crs):
+        boundary = gpd.GeoSeries([boundary], crs=boundary_crs).to_crs(geometries.crs).iloc[0]
+        shapely.prepare(boundary)
+
+    values = np.asarray(geometries.values, dtype=object)
+    present = ~(shapely.is_missing(values) | shapely.is_empty(values))
+    points = present & (shapely.get_type_id(values) == 0)  #: Point
+    others = present & ~points
+
+    keep = ~present
+    coordinates = shapely.get_coordinates(values[points])
+    keep[points] = shapely.contains_xy(boundary, coordinates[:, 0], coordinates[:, 1])
+    keep[others] = shapely.intersects(boundary, values[others])
+
+    module_logger.info(
+        "Clipped %s to the boundary: dropped %s of %s features", layer_name, f"{(~keep).sum():,}", f"{len(keep):,}"
+    )
+
+    return keep
+
+
+def validate(module_logger, layer_name, geometries):
+    """Check every geometry's validity in one vectorized call and repair the invalid ones.
+
+    Invalid geometries (such as self-intersecting or bow-tie polygons) are rebuilt with shapely.make_valid's
+    "structure" method, which keeps polygons as polygons and drops any parts that collapse to lines or points. A
+    geometry can't be fixed if its repair is empty (as it is for non-finite coordinates) or has a different dimension
+    than the original (such as a line with a single distinct point). Missing and empty geometries are left alone so
+    they are reported and dropped with the other empty geometries.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        layer_name (str): The layer's name for logging
+        geometries (gpd.GeoSeries): The layer's geometries
+
+    Returns:
+        tuple[gpd.GeoSeries, np.ndarray, np.ndarray]: The geometries with the invalid ones repaired (same index and
+            crs), and boolean masks of the geometries that were repaired and of those that couldn't be fixed
+    """
+
+    values = np.asarray(geometries.values, dtype=object)
+    present = ~(shapely.is_missing(values) | shapely.is_empty(values))
+    invalid = present & ~shapely.is_valid(values)
+    repaired = np.zeros(len(values), dtype=bool)
+    unfixable = np.zeros(len(values), dtype=bool)
+
+    if invalid.any():
+        #: Show a few of GEOS's reasons (eg, "Self-intersection[-111.9 40.7]") to help track down the source features
+        reasons = shapely.is_valid_reason(values[invalid][:5])
+        originals = values[invalid]
+        fixes = shapely.make_valid(originals, method="structure", keep_collapsed=False)
+        fixable = ~shapely.is_empty(fixes) & (shapely.get_dimensions(fixes) == shapely.get_dimensions(originals))
+        positions = np.flatnonzero(invalid)
+        values = values.copy()
+        values[positions[fixable]] = fixes[fixable]
+        repaired[positions[fixable]] = True
+        unfixable[positions[~fixable]] = True
+        module_logger.warning(
+            "Found %s invalid geometries in %s (eg, %s)", f"{invalid.sum():,}", layer_name, "; ".join(reasons)
+        )
+
+    module_logger.info(
+        "Validated %s: repaired %s and dropped %s of %s geometries",
+        layer_name,
+        f"{repaired.sum():,}",
+        f"{unfixable.sum():,}",
+        f"{len(values):,}",
+    )
+
+    return gpd.GeoSeries(values, index=geometries.index, crs=geometries.crs, name=geometries.name), repaired, unfixable
@@ -4,28 +4,74 @@
 Run the nfhl-skid script as a cloud function.
 """
 
+import argparse
+import functools
 import json
 import logging
+import math
 import shutil
 import sys
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from types import SimpleNamespace
 
-import arcgis
-from palletjack import extract, load, transform, utils
-from supervisor.message_handlers import SendGridHandler
-from supervisor.models import MessageDetails, Supervisor
+import pandas as pd
 
 #: This makes it work when calling with just `python <file>`/installing via pip and in the gcf framework, where
 #: the relative imports fail because of how it's calling the function.
 try:
-    from . import config, version
+    from . import (
+        bluegreen,
+        budget,
+        cache,
+        config,
+        controller,
+        enrich,
+        fanout,
+        geometry,
+        metrics,
+        paging,
+        profiling,
+        query,
+        sinks,
+        state,
+        sync,
+        version,
+    )
 except ImportError:
+    import bluegreen
+    import budget
+    import cache
     import config
+    import controller
+    import enrich
+    import fanout
+    import geometry
+    import metrics
+    import paging
+    import profiling
+    import query
+    import sinks
+    import state
+    import sync
     import version
 
+#: arcgis, palletjack, and supervisor take seconds to import, so they're imported by the functions that use them
+#: instead of here. This keeps cold starts and importing the module for tests fast.
+
+
+def _retry(worker_method, *args, run_budget=None, **kwargs):
+    #: Retries come out of the run's budget when there is one
+    if run_budget is not None:
+        return run_budget.retry(worker_method, *args, **kwargs)
+
+    from palletjack import utils
+
+    return utils.retry(worker_method, *args, **kwargs)
+
 
 def _get_secrets():
     """A helper method for loading secrets from either a GCF mount point or the local src/nfhl-skid/secrets/secrets.
@@ -89,6 +135,9 @@ def _initialize(log_path, sendgrid_api_key):
     #: (all log messages were duplicated if put at beginning)
     logging.captureWarnings(True)
 
+    from supervisor.message_handlers import SendGridHandler
+    from supervisor.models import Supervisor
+
     skid_logger.debug("Creating Supervisor object")
     skid_supervisor = Supervisor(handle_errors=False)
     sendgrid_settings = config.SENDGRID_SETTINGS
@@ -120,56 +169,185 @@ def _remove_log_file_handlers(log_name, loggers):
                 pass
 
 
+#: Symbology labels for each (FLD_ZONE, ZONE_SUBTY) combination. A ZONE_SUBTY of None matches null subtypes and
+#: ANY_SUBTYPE matches every subtype in that zone. Areas that don't match a rule get an empty label.
+ANY_SUBTYPE = object()
+HAZARD_AREA_LABELS = {
+    **{(zone, None): "1% Annual Chance Flood Hazard" for zone in ["A", "AE", "AH", "AO", "VE"]},
+    ("AE", "FLOODWAY"): "Regulatory Floodway",
+    ("AE", "FLOODWAY CONTAINED IN CHANNEL"): "Regulatory Floodway",
+    ("D", ANY_SUBTYPE): "Area of Undetermined Flood Hazard",
+    ("X", "0.2 PCT ANNUAL CHANCE FLOOD HAZARD"): "0.2% Annual Chance Flood Hazard",
+    ("X", "1 PCT DEPTH LESS THAN 1 FOOT"): "0.2% Annual Chance Flood Hazard",
+    ("X", "1 PCT DRAINAGE AREA LESS THAN 1 SQUARE MILE"): "0.2% Annual Chance Flood Hazard",
+    ("X", "AREA WITH REDUCED FLOOD RISK DUE TO LEVEE"): "Area with Reduced Flood Risk due to Levee",
+    ("AREA NOT INCLUDED", ANY_SUBTYPE): "Area Not Included",
+}
+
+
 def _hazard_areas(hazard_areas_df):
-    #: Calculate label values for symbology
-    one_per_annual_flood_dq = (hazard_areas_df["FLD_ZONE"].isin(["A", "AE", "AH", "AO", "VE"])) & (
-        hazard_areas_df["ZONE_SUBTY"].isnull()
-    )
-    regulatory_floodway_dq = (hazard_areas_df["FLD_ZONE"] == "AE") & (
-        hazard_areas_df["ZONE_SUBTY"].isin(["FLOODWAY", "FLOODWAY CONTAINED IN CHANNEL"])
+    #: Calculate label values for symbology in one vectorized lookup against HAZARD_AREA_LABELS
+    subtype_labels = {
+        f"{zone}|{subtype}": label
+        for (zone, subtype), label in HAZARD_AREA_LABELS.items()
+        if subtype is not None and subtype is not ANY_SUBTYPE
+    }
+    null_subtype_labels = {zone: label for (zone, subtype), label in HAZARD_AREA_LABELS.items() if subtype is None}
+    zone_labels = {zone: label for (zone, subtype), label in HAZARD_AREA_LABELS.items() if subtype is ANY_SUBTYPE}
+
+    zones = _category_values(hazard_areas_df["FLD_ZONE"])
+    subtypes = _category_values(hazard_areas_df["ZONE_SUBTY"])
+    null_subtypes = subtypes.isnull()
+    labels = (zones + "|" + subtypes).map(subtype_labels)
+    labels[null_subtypes] = zones[null_subtypes].map(null_subtype_labels)
+    labels = labels.fillna(zones.map(zone_labels)).fillna("")
+
+    label_categories = [""] + list(dict.fromkeys(HAZARD_AREA_LABELS.values()))
+    hazard_areas_df["label"] = pd.Categorical(labels, categories=label_categories)
+
+    #: fill null strings with empty string '' to fix featureset error
+    string_columns = hazard_areas_df.select_dtypes("string").columns
+    hazard_areas_df[string_columns] = hazard_areas_df[string_columns].fillna("")
+    for column in hazard_areas_df.select_dtypes("category").columns:
+        if hazard_areas_df[column].isnull().any():
+            if "" not in hazard_areas_df[column].cat.categories:
+                hazard_areas_df[column] = hazard_areas_df[column].cat.add_categories("")
+            hazard_areas_df[column] = hazard_areas_df[column].fillna("")
+
+    return hazard_areas_df
+
+
+def _category_values(series):
+    #: Categoricals can't be combined like strings, so use their values in the dtype of their categories
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.astype(series.dtype.categories.dtype)
+    return series
+
+
+def _compact_dtypes(layer, layer_df):
+    #: Convert any python-object strings to pyarrow-backed strings and the layer's category_fields to categoricals.
+    #: config uses the lower-case field names from after the transform, but the extract still has FEMA's names.
+    category_fields = {field.lower() for field in layer.get("category_fields", [])}
+    for column in layer_df.columns:
+        series = layer_df[column]
+        if series.dtype == object and pd.api.types.infer_dtype(series, skipna=True) == "string":
+            series = series.astype(pd.StringDtype("pyarrow"))
+        if column.lower() in category_fields and not isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype("category")
+        if series is not layer_df[column]:
+            layer_df[column] = series
+    return layer_df
+
+
+def _service_layer(module_logger, fema_extractor, layer, request_controller):
+    return query.ServiceLayer(
+        module_logger,
+        f"{fema_extractor.url}/{layer['number']}",
+        request_controller.session,
+        timeout=config.TIMEOUT,
+        where_clause=layer["where_clause"],
+        query_format=config.QUERY_FORMAT,
     )
-    undet_flood_hazard_dq = hazard_areas_df["FLD_ZONE"] == "D"
-    point_oh_two_percent_annual_flood_dq = (hazard_areas_df["FLD_ZONE"] == "X") & (
-        hazard_areas_df["ZONE_SUBTY"].isin(
-            [
-                "0.2 PCT ANNUAL CHANCE FLOOD HAZARD",
-                "1 PCT DEPTH LESS THAN 1 FOOT",
-                "1 PCT DRAINAGE AREA LESS THAN 1 SQUARE MILE",
-            ]
+
+
+def _extract_layer(module_logger, fema_extractor, layer, tempdir, request_controller):
+    module_logger.info("Extracting %s...", layer["name"])
+    service_layer = _service_layer(module_logger, fema_extractor, layer, request_controller)
+    #: Pages are checkpointed in the tempdir so that a retry only downloads the pages that failed
+    scratch_dir = Path(tempdir) / "extract" / layer["name"]
+    if layer.get("partitions"):
+        return paging.get_partitioned_features(
+            module_logger,
+            service_layer,
+            layer["partitions"],
+            scratch_dir,
+            request_controller,
+            max_workers=config.PARTITION_WORKERS,
+            arrow_strings=config.ARROW_DTYPES,
         )
+    layer_df = paging.get_features(
+        module_logger, service_layer, scratch_dir, request_controller, arrow_strings=config.ARROW_DTYPES
     )
-    reduced_risk_levee_dq = (hazard_areas_df["FLD_ZONE"] == "X") & (
-        hazard_areas_df["ZONE_SUBTY"] == "AREA WITH REDUCED FLOOD RISK DUE TO LEVEE"
-    )
-    area_not_included_dq = hazard_areas_df["FLD_ZONE"] == "AREA NOT INCLUDED"
+    return layer_df
 
-    hazard_areas_df["label"] = ""
-    hazard_areas_df.loc[one_per_annual_flood_dq, "label"] = "1% Annual Chance Flood Hazard"
-    hazard_areas_df.loc[regulatory_floodway_dq, "label"] = "Regulatory Floodway"
-    hazard_areas_df.loc[undet_flood_hazard_dq, "label"] = "Area of Undetermined Flood Hazard"
-    hazard_areas_df.loc[point_oh_two_percent_annual_flood_dq, "label"] = "0.2% Annual Chance Flood Hazard"
-    hazard_areas_df.loc[reduced_risk_levee_dq, "label"] = "Area with Reduced Flood Risk due to Levee"
-    hazard_areas_df.loc[area_not_included_dq, "label"] = "Area Not Included"
 
-    #: fill null strings with empty string '' to fix featureset error
-    for col in hazard_areas_df.columns:
-        if hazard_areas_df[col].dtype == "string":
-            hazard_areas_df[col].fillna("", inplace=True)
+def _extract_layer_with_cache(
+    module_logger, fema_extractor, layer, tempdir, request_controller, stage, run_budget=None, fingerprint=None
+):
+    """Get a layer from the extraction cache if it has a fresh copy, otherwise extract it from FEMA and cache it.
 
-    return hazard_areas_df
+    Cached copies are keyed on the layer's upstream fingerprint as well as its query, so a copy cached before FEMA
+    changed the layer isn't used. Errors writing to the cache are logged but don't fail the layer.
 
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        fema_extractor (extract.RESTServiceLoader): Loader for FEMA's map service
+        layer (dict): The layer's entry in config.FEMA_LAYERS
+        tempdir (str): The run's temporary directory
+        request_controller (controller.RequestController): The run's controller for requests to FEMA
+        stage (metrics.Stage): The layer's extract stage, for counting extraction attempts
+        run_budget (budget.RunBudget, optional): The run's deadline and retry budget. Defaults to None.
+        fingerprint (dict, optional): The layer's upstream fingerprint from this run's probe. Defaults to None.
 
-def _extract_layer(module_logger, fema_extractor, layer):
-    module_logger.info("Extracting %s...", layer["name"])
-    service_layer = extract.ServiceLayer(
-        f"{fema_extractor.url}/{layer['number']}", timeout=config.TIMEOUT, where_clause=layer["where_clause"]
+    Returns:
+        pd.DataFrame: The layer's features
+    """
+
+    if not config.EXTRACT_CACHE_DIR:
+        return _retry(
+            stage.counted(_extract_layer),
+            module_logger,
+            fema_extractor,
+            layer,
+            tempdir,
+            request_controller,
+            run_budget=run_budget,
+        )
+
+    cache_key = cache.cache_key(fema_extractor.url, layer, fingerprint)
+    read_kwargs = paging.ARROW_STRING_KWARGS if config.ARROW_DTYPES else {}
+    layer_df = cache.read(config.EXTRACT_CACHE_DIR, cache_key, config.EXTRACT_CACHE_TTL, **read_kwargs)
+    if layer_df is not None:
+        module_logger.info("Using cached extract of %s (%s)", layer["name"], cache_key)
+        return layer_df
+
+    layer_df = _retry(
+        stage.counted(_extract_layer),
+        module_logger,
+        fema_extractor,
+        layer,
+        tempdir,
+        request_controller,
+        run_budget=run_budget,
     )
-    layer_df = fema_extractor.get_features(service_layer)
+    try:
+        cache.write(
+            config.EXTRACT_CACHE_DIR, cache_key, layer_df, config.EXTRACT_CACHE_TTL, config.EXTRACT_CACHE_MAX_BYTES
+        )
+    except Exception:
+        module_logger.warning("Could not cache extract of %s", layer["name"], exc_info=True)
+
     return layer_df
 
 
-def _transform_layer(module_logger, layer, layer_df):
+def _transform_layer(module_logger, layer, layer_df, whole_layer=True):
+    from palletjack import transform
+
     module_logger.info("Transforming %s...", layer["name"])
+    #: Work on a shallow copy so that a retry gets the extract's original columns rather than ones already renamed
+    layer_df = layer_df.copy(deep=False)
+
+    #: The where clause only approximates the state, so drop the features that fall outside its actual boundary
+    if layer.get("clip_to_boundary"):
+        keep = geometry.clip_to_boundary(
+            module_logger,
+            layer["name"],
+            layer_df["SHAPE"],
+            *_clip_boundary(module_logger),
+        )
+        if not keep.all():
+            layer_df = layer_df[keep].copy()
+
     if layer["name"] == "S_Fld_Haz_Ar":
         layer_df = _hazard_areas(layer_df)
 
@@ -192,6 +370,17 @@ def _transform_layer(module_logger, layer, layer_df):
         except KeyError:
             pass
 
+    #: Optionally simplify and quantize the geometries; any that collapse become empty and are dropped below
+    if layer.get("simplify_tolerance") or layer.get("xy_precision"):
+        layer_df["SHAPE"] = geometry.generalize(
+            module_logger,
+            layer["name"],
+            layer_df["SHAPE"],
+            simplify_tolerance=layer.get("simplify_tolerance"),
+            xy_precision=layer.get("xy_precision"),
+            coverage=whole_layer,
+        )
+
     #: Drop rows with empty geometries
     empty_geometries = layer_df["SHAPE"].isnull()
     if empty_geometries.any():
@@ -205,7 +394,45 @@ def _transform_layer(module_logger, layer, layer_df):
     return layer_df
 
 
+def _validate_geometries(module_logger, layer, layer_df, stage):
+    #: Repair invalid geometries before they can fail the transform or the load, and set aside the features that
+    #: can't be fixed
+    layer_df["SHAPE"], repaired, unfixable = geometry.validate(module_logger, layer["name"], layer_df["SHAPE"])
+    stage.counts["repaired"] = stage.counts.get("repaired", 0) + int(repaired.sum())
+    stage.counts["dropped"] = stage.counts.get("dropped", 0) + int(unfixable.sum())
+    quarantined_df = layer_df[unfixable]
+    if unfixable.any():
+        layer_df = layer_df[~unfixable].copy()
+    return layer_df, quarantined_df
+
+
+def _quarantine(module_logger, tempdir, layer, quarantined_df):
+    #: Keep the features with unfixable geometries for a closer look if there's somewhere to put them. A failure here
+    #: is logged but doesn't fail the layer.
+    if quarantined_df.empty or not config.GEOMETRY_QUARANTINE_DIR:
+        return
+    try:
+        output = sinks.write_geoparquet(
+            f"{layer['name']}_quarantine", quarantined_df, Path(tempdir) / "outputs", config.GEOMETRY_QUARANTINE_DIR
+        )
+        module_logger.warning(
+            "Quarantined %s features of %s with unfixable geometries in %s", len(quarantined_df), layer["name"], output
+        )
+    except Exception:
+        module_logger.exception("Error quarantining the unfixable geometries of %s", layer["name"])
+
+
+def _prepare_for_load(layer_df):
+    #: palletjack's field checks don't know about categoricals, so turn them back into the dtype of their categories
+    for column in layer_df.select_dtypes("category").columns:
+        layer_df[column] = _category_values(layer_df[column])
+    return layer_df
+
+
 def _load_layer(module_logger, tempdir, gis, layer, layer_df):
+    from palletjack import load
+
+    layer_df = _prepare_for_load(layer_df)
     run_dir = Path(tempdir) / layer["name"]
     try:
         run_dir.mkdir()
@@ -214,36 +441,300 @@ def _load_layer(module_logger, tempdir, gis, layer, layer_df):
         run_dir.mkdir()
 
     module_logger.info("Loading %s...", layer["name"])
-    feature_layer = load.ServiceUpdater(gis, layer["itemid"], working_dir=run_dir)
+    feature_layer = load.ServiceUpdater(
+        gis, layer["itemid"], working_dir=run_dir, gdb_item_prefix=_gdb_item_prefix(layer)
+    )
+    if config.DELTA_SYNC:
+        key_field = layer.get("key_field", config.DELTA_SYNC_KEY)
+        return sync.delta_load(module_logger, feature_layer, layer_df, key_field, config.DELTA_SYNC_GRID_SIZE)
     features_loaded = feature_layer.truncate_and_load(layer_df, save_old=False)
     return features_loaded
 
 
+def _load_batch(module_logger, tempdir, gis, layer, batch_df, batch_number):
+    from palletjack import load
+
+    batch_df = _prepare_for_load(batch_df)
+    #: palletjack always writes its upload gdb to the same place in working_dir, so give each batch its own
+    batch_dir = Path(tempdir) / layer["name"] / f"batch_{batch_number:05d}"
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    batch_dir.mkdir(parents=True)
+
+    feature_layer = load.ServiceUpdater(
+        gis, layer["itemid"], working_dir=batch_dir, gdb_item_prefix=_gdb_item_prefix(layer)
+    )
+    #: The first batch replaces the existing data and the rest are appended to it
+    if batch_number == 0:
+        features_loaded = feature_layer.truncate_and_load(batch_df, save_old=False)
+    else:
+        features_loaded = feature_layer.add(batch_df)
+
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    return features_loaded
+
+
+def _stream_layer(
+    module_logger, tempdir, gis, fema_extractor, request_controller, run_metrics, layer, lookups=None, run_budget=None
+):
+    """Extract, transform, and load a layer in batches of config.STREAM_BATCH_SIZE features.
+
+    Each batch is transformed and loaded as soon as it's downloaded, so memory use is bounded by the batch size and
+    loading starts before the extract finishes. The first batch truncates and loads the hosted layer and the rest are
+    appended. The extraction cache isn't used, and, like truncate and load, a failure partway through leaves the
+    hosted layer with only the batches loaded so far. Blue/green layers are streamed into their standby source, so a
+    failure there just leaves their view on the previous load.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        tempdir (str): The run's temporary directory
+        gis (arcgis.gis.GIS): The AGOL organization's gis object
+        fema_extractor (extract.RESTServiceLoader): Loader for FEMA's map service
+        request_controller (controller.RequestController): The run's controller for requests to FEMA
+        run_metrics (metrics.RunMetrics): Collects the timings and sizes of each layer's stages
+        layer (dict): The layer's entry in config.FEMA_LAYERS
+        lookups (dict, optional): Future of the enrich.SpatialLookup for each layer that other layers are enriched
+            from. Defaults to None.
+        run_budget (budget.RunBudget, optional): The run's deadline and retry budget. Defaults to None.
+
+    Returns:
+        int: Number of features loaded
+    """
+
+    layer_lookups = _wait_for_lookups(lookups, layer)
+    target_layer = _target_layer(module_logger, gis, layer, run_budget)
+    module_logger.info("Streaming %s in batches of %s features...", layer["name"], config.STREAM_BATCH_SIZE)
+    _delete_existing_gdb_item(gis, f"{_gdb_item_prefix(layer)} Temporary gdb upload", module_logger)
+
+    #: Batches are only part of the layer, and simplifying parts of a coverage separately opens gaps along their edges
+    if layer.get("simplify_tolerance"):
+        module_logger.info("%s is streamed, so its polygons are simplified one at a time", layer["name"])
+
+    features_loaded = 0
+    quarantined = []
+    with run_metrics.stage(layer["name"], "stream") as stage:
+        stage.rows = 0
+        stage.memory_bytes = 0  #: the largest batch's in-memory size
+        batches = paging.iter_features(
+            module_logger,
+            _service_layer(module_logger, fema_extractor, layer, request_controller),
+            request_controller,
+            config.STREAM_BATCH_SIZE,
+            partitions=layer.get("partitions"),
+        )
+        batch_number = 0
+        for batch_df in batches:
+            if config.ARROW_DTYPES:
+                batch_df = _compact_dtypes(layer, batch_df)
+            batch_df, quarantined_df = _validate_geometries(module_logger, layer, batch_df, stage)
+            if not quarantined_df.empty:
+                quarantined.append(quarantined_df)
+            batch_df = _retry(
+                _transform_layer, module_logger, layer, batch_df, whole_layer=False, run_budget=run_budget
+            )
+            if layer_lookups:
+                batch_df = enrich.enrich(module_logger, layer["name"], batch_df, layer_lookups, layer["enrich"])
+            #: Every row can be dropped for an empty geometry, and the first non-empty batch must be the one to truncate
+            if batch_df.empty:
+                continue
+            stage.rows += len(batch_df)
+            stage.memory_bytes = max(stage.memory_bytes, int(batch_df.memory_usage(deep=True).sum()))
+            features_loaded += _retry(
+                stage.counted(_load_batch),
+                module_logger,
+                tempdir,
+                gis,
+                target_layer,
+                batch_df,
+                batch_number,
+                run_budget=run_budget,
+            )
+            module_logger.debug("Loaded batch %s of %s (%s features so far)", batch_number, layer["name"], stage.rows)
+            batch_number += 1
+
+    if quarantined:
+        _quarantine(module_logger, tempdir, layer, pd.concat(quarantined))
+    if not stage.rows:
+        module_logger.warning("%s has no features, the hosted layer was not changed", layer["name"])
+    else:
+        _switch_view(module_logger, gis, run_metrics, layer, target_layer, stage.rows, run_budget)
+
+    return features_loaded
+
+
+def _clip_boundary(module_logger):
+    #: A boundary read from a service (such as UGRC's) can be unreachable; the bundled one is close enough to carry on
+    bundled_path = _bundled_file("utah_boundary.geojson")
+    if not config.CLIP_BOUNDARY_PATH:
+        return geometry.read_boundary(bundled_path)
+    try:
+        return geometry.read_boundary(config.CLIP_BOUNDARY_PATH)
+    except (OSError, RuntimeError, ValueError) as error:
+        module_logger.warning(
+            "Couldn't read the clip boundary from %s, using the bundled Utah boundary: %s",
+            config.CLIP_BOUNDARY_PATH,
+            error,
+        )
+        return geometry.read_boundary(bundled_path)
+
+
+def _bundled_file(file_name):
+    #: Try to get the file from a specific location in the container (as per dockerfile's COPY), otherwise use a
+    #: relative path
+    container_path = Path("/app/src/nfhl") / file_name
+    if container_path.exists():
+        return container_path
+    return Path(__file__).parent / file_name
+
+
+def _hazard_area_drawing_info():
+    with _bundled_file("fld_haz_ar_drawingInfo.json").open("r", encoding="utf-8") as symbology_file:
+        symbology_json = json.load(symbology_file)
+
+    return symbology_json
+
+
 def _update_hazard_layer_symbology(gis):
     layer_item = gis.content.get(config.FEMA_LAYERS["S_Fld_Haz_Ar"]["itemid"])
     layer_data = layer_item.get_data()
+    layer_data["layers"][0]["layerDefinition"]["drawingInfo"] = _hazard_area_drawing_info()
+    result = _retry(layer_item.update, item_properties={"text": json.dumps(layer_data)})
+    return result
+
 
-    #: Try to get the symbology file from a specific location in the container (as per dockerfile's COPY)
+def _write_geoparquet(tempdir, layer, layer_df):
+    return sinks.write_geoparquet(layer["name"], layer_df, Path(tempdir) / "outputs", config.GEOPARQUET_OUTPUT_DIR)
+
+
+def _write_vector_tiles(tempdir, layer, layer_df):
+    tile_settings = layer["vector_tiles"]
+    scratch_dir = Path(tempdir) / "outputs"
+    tiles_path = sinks.write_vector_tiles(
+        layer["name"],
+        layer_df,
+        scratch_dir,
+        config.VECTOR_TILE_OUTPUT_DIR,
+        tile_format=config.VECTOR_TILE_FORMAT,
+        fields=tile_settings.get("fields"),
+        min_zoom=tile_settings.get("min_zoom", 0),
+        max_zoom=tile_settings.get("max_zoom", 14),
+    )
+
+    #: Hazard areas also get a style with the same symbology as the hosted layer, pointed at where the tiles are served
+    if layer["name"] == "S_Fld_Haz_Ar":
+        tiles_url = tiles_path
+        if config.VECTOR_TILE_BASE_URL:
+            tiles_url = f"{config.VECTOR_TILE_BASE_URL.rstrip('/')}/{Path(tiles_path).name}"
+        tiles_url = f"{sinks.TILE_FORMATS[config.VECTOR_TILE_FORMAT]['scheme']}{tiles_url}"
+        style = sinks.maplibre_style(_hazard_area_drawing_info(), layer["name"], tiles_url)
+        sinks.write_style(layer["name"], style, scratch_dir, config.VECTOR_TILE_OUTPUT_DIR)
+
+    return tiles_path
+
+
+#: Outputs written from the transformed layer in addition to (or instead of) the hosted layer, by their name in
+#: config.OUTPUT_SINKS. The "agol" sink is the load stage.
+FILE_SINKS = {"geoparquet": _write_geoparquet, "vector_tiles": _write_vector_tiles}
+
+
+def _file_sinks(layer):
+    #: Only layers with tile settings get vector tiles
+    return [
+        sink
+        for sink in config.OUTPUT_SINKS
+        if sink in FILE_SINKS and (sink != "vector_tiles" or "vector_tiles" in layer)
+    ]
+
+
+def _write_file_outputs(module_logger, tempdir, run_metrics, layer, layer_df, run_budget=None):
+    """Write a transformed layer to each of its file sinks, each timed as its own stage.
+
+    A failed output is logged and recorded as an errored stage, but doesn't stop the other outputs or the layer's load
+    to AGOL.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        tempdir (str): The run's temporary directory
+        run_metrics (metrics.RunMetrics): Collects the timings and sizes of each layer's stages
+        layer (dict): The layer's entry in config.FEMA_LAYERS
+        layer_df (pd.DataFrame): The transformed layer
+        run_budget (budget.RunBudget, optional): The run's deadline and retry budget. Defaults to None.
+    """
+
+    for sink in _file_sinks(layer):
+        try:
+            with run_metrics.stage(layer["name"], sink) as stage:
+                stage.measure(layer_df)
+                module_logger.info("Writing %s to %s...", layer["name"], sink)
+                output = _retry(stage.counted(FILE_SINKS[sink]), tempdir, layer, layer_df, run_budget=run_budget)
+                module_logger.info("Wrote %s", output)
+        except Exception:
+            module_logger.exception("Error writing %s to %s", layer["name"], sink)
+
+
+def _enriched_layers():
+    #: The "enrich" entry of each layer that gets enriched from other layers, when enrichment is on
+    if not config.ENRICHMENT:
+        return {}
+    return {name: layer["enrich"] for name, layer in config.FEMA_LAYERS.items() if layer.get("enrich")}
+
+
+def _build_lookup(module_logger, run_metrics, lookups, layer, layer_df):
+    #: Index the fields that the other layers need from this one and hand it to the layers waiting for it. A failure
+    #: fails those layers but not this one's own load.
+    fields = sorted(
+        {field for enrichment in _enriched_layers().values() for field in enrichment.get(layer["name"], {})}
+    )
     try:
-        json_path = Path("/app/src/nfhl/fld_haz_ar_drawingInfo.json")
-        with json_path.open("r", encoding="utf-8") as symbology_file:
-            symbology_json = json.load(symbology_file)
-
-    #: otherwise, use a relative path
-    except FileNotFoundError:
-        json_path = Path(__file__).parent / "fld_haz_ar_drawingInfo.json"
-        with json_path.open("r", encoding="utf-8") as symbology_file:
-            symbology_json = json.load(symbology_file)
-
-    layer_data["layers"][0]["layerDefinition"]["drawingInfo"] = symbology_json
-    result = utils.retry(layer_item.update, item_properties={"text": json.dumps(layer_data)})
-    return result
+        with run_metrics.stage(layer["name"], "index") as stage:
+            lookup = stage.counted(enrich.SpatialLookup)(layer["name"], layer_df, fields)
+            stage.rows = len(lookup)
+    except Exception as error:
+        module_logger.exception("Error indexing %s for enrichment", layer["name"])
+        lookups[layer["name"]].set_exception(error)
+        return
+    module_logger.info("Indexed %s features of %s for enrichment", f"{len(lookup):,}", layer["name"])
+    lookups[layer["name"]].set_result(lookup)
+
+
+def _wait_for_lookups(lookups, layer):
+    #: Get the lookups of the layers this layer is enriched from, waiting for them to be extracted if need be
+    if layer["name"] not in _enriched_layers():
+        return {}
+    return {name: lookups[name].result() for name in layer["enrich"]}
+
+
+def _fail_lookup(lookup_future, name, layer_future):
+    #: Called when a layer that others are enriched from finishes; if it failed before building its lookup, fail the
+    #: layers waiting for it instead of leaving them waiting forever
+    if not lookup_future.done():
+        error = RuntimeError(f"{name} could not be indexed for enrichment")
+        error.__cause__ = None if layer_future.cancelled() else layer_future.exception()
+        lookup_future.set_exception(error)
+
+
+def _enrich_layer(module_logger, run_metrics, lookups, layer, layer_df):
+    #: Wait outside the stage so that time spent waiting for the other layers isn't counted as enrichment
+    layer_lookups = _wait_for_lookups(lookups, layer)
+    with run_metrics.stage(layer["name"], "enrich") as stage:
+        layer_df = stage.counted(enrich.enrich)(module_logger, layer["name"], layer_df, layer_lookups, layer["enrich"])
+        stage.measure(layer_df)
+    return layer_df
+
+
+def _gdb_item_prefix(layer):
+    #: Each layer gets its own temporary gdb item so that concurrent loads don't find and delete each other's uploads
+    return f"palletjack {layer['name']}"
 
 
 def _delete_existing_gdb_item(gis, gdb_item_name, module_logger):
     module_logger.info("Searching for and deleting GDB item '%s' if needed...", gdb_item_name)
 
-    searches = gis.content.search(query=gdb_item_name, item_type="File Geodatabase")
+    #: The search is fuzzy and would also return the other layers' temporary items, so only keep exact title matches
+    searches = [
+        item
+        for item in gis.content.search(query=gdb_item_name, item_type="File Geodatabase")
+        if item.title == gdb_item_name
+    ]
     if not searches:
         module_logger.info("GDB item '%s' not found, proceeding", gdb_item_name)
         return
@@ -256,48 +747,616 @@ def _delete_existing_gdb_item(gis, gdb_item_name, module_logger):
         raise ValueError(f"Cannot delete '{gdb_item_name}' ({gdb_item.itemid})") from error
 
 
-def process():  # pylint: disable=too-many-locals
-    """The main function that does all the work."""
+def _target_layer(module_logger, gis, layer, run_budget=None):
+    #: The layer entry to load into: the layer itself, or for blue/green layers a copy pointing at the source layer
+    #: that its view isn't using
+    if not (config.BLUE_GREEN and layer.get("source_itemids")):
+        return layer
+    standby, live = _retry(bluegreen.find_standby, gis, layer["itemid"], layer["source_itemids"], run_budget=run_budget)
+    module_logger.info("Loading %s into standby %s while its view uses %s", layer["name"], standby, live)
+    return {**layer, "itemid": standby}
+
+
+def _switch_view(module_logger, gis, run_metrics, layer, target_layer, expected_count, run_budget=None):
+    #: Once a blue/green layer's standby source is loaded and has every feature, point the layer's view at it. The
+    #: previous source is left alone as the rollback.
+    if target_layer is layer:
+        return
+    with run_metrics.stage(layer["name"], "switch") as stage:
+        stage.rows = _retry(stage.counted(bluegreen.hosted_count), gis, target_layer["itemid"], run_budget=run_budget)
+        if stage.rows != expected_count:
+            raise ValueError(
+                f"Standby {target_layer['itemid']} has {stage.rows} features instead of {expected_count}, "
+                f"leaving {layer['name']}'s view as it was"
+            )
+        _retry(
+            stage.counted(bluegreen.switch_view), gis, layer["itemid"], target_layer["itemid"], run_budget=run_budget
+        )
+    module_logger.info("Switched %s's view to %s", layer["name"], target_layer["itemid"])
+
+
+def _process_layer(
+    module_logger,
+    tempdir,
+    gis,
+    fema_extractor,
+    request_controller,
+    run_metrics,
+    layer,
+    lookups=None,
+    run_budget=None,
+    fingerprint=None,
+):
+    lookups = lookups or {}
+    if run_budget is not None:
+        run_budget.check(layer["name"])
+
+    #: Delta sync, the file sinks, and indexing a layer for enrichment need the whole layer, so they take precedence
+    #: over streaming. Streaming loads each batch into AGOL, so it's only used when AGOL is a sink.
+    if (
+        config.STREAM_BATCH_SIZE
+        and "agol" in config.OUTPUT_SINKS
+        and not config.DELTA_SYNC
+        and not _file_sinks(layer)
+        and layer["name"] not in lookups
+    ):
+        return _stream_layer(
+            module_logger, tempdir, gis, fema_extractor, request_controller, run_metrics, layer, lookups, run_budget
+        )
+
+    with run_metrics.stage(layer["name"], "extract") as stage:
+        layer_df = _extract_layer_with_cache(
+            module_logger, fema_extractor, layer, tempdir, request_controller, stage, run_budget, fingerprint
+        )
+        if config.ARROW_DTYPES:
+            layer_df = _compact_dtypes(layer, layer_df)
+        stage.measure(layer_df)
+
+    #: Repair the geometries before the transform clips and generalizes them, since GEOS can't work with invalid ones
+    with run_metrics.stage(layer["name"], "validate") as stage:
+        layer_df, quarantined_df = stage.counted(_validate_geometries)(module_logger, layer, layer_df, stage)
+        stage.measure(layer_df)
+    _quarantine(module_logger, tempdir, layer, quarantined_df)
+
+    with run_metrics.stage(layer["name"], "transform") as stage:
+        layer_df = _retry(stage.counted(_transform_layer), module_logger, layer, layer_df, run_budget=run_budget)
+        stage.measure(layer_df)
+
+    if layer["name"] in lookups:
+        _build_lookup(module_logger, run_metrics, lookups, layer, layer_df)
+    if layer["name"] in _enriched_layers():
+        layer_df = _enrich_layer(module_logger, run_metrics, lookups, layer, layer_df)
+
+    _write_file_outputs(module_logger, tempdir, run_metrics, layer, layer_df, run_budget)
+    if "agol" not in config.OUTPUT_SINKS:
+        return len(layer_df)
+
+    with run_metrics.stage(layer["name"], "load") as stage:
+        stage.measure(layer_df)
+        target_layer = _target_layer(module_logger, gis, layer, run_budget)
+        _delete_existing_gdb_item(gis, f"{_gdb_item_prefix(layer)} Temporary gdb upload", module_logger)
+        features_loaded = _retry(
+            stage.counted(_load_layer), module_logger, tempdir, gis, target_layer, layer_df, run_budget=run_budget
+        )
+    _switch_view(module_logger, gis, run_metrics, layer, target_layer, len(layer_df), run_budget)
+
+    return features_loaded
+
+
+def _probe_layers(module_logger, fema_extractor, run_budget=None):
+    """Fingerprint every layer with a cheap statistics query. Layers that can't be probed get a None fingerprint.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        fema_extractor (extract.RESTServiceLoader): Loader for FEMA's map service
+        run_budget (budget.RunBudget, optional): The run's deadline and retry budget. Defaults to None.
+
+    Returns:
+        dict: Fingerprint (or None) for each layer name
+    """
+
+    fingerprints = {}
+    for name, layer in config.FEMA_LAYERS.items():
+        try:
+            fingerprints[name] = _retry(
+                state.probe_layer,
+                fema_extractor.url,
+                layer,
+                config.TIMEOUT,
+                version.__version__,
+                run_budget=run_budget,
+            )
+        except Exception:
+            module_logger.warning("Could not probe %s for changes, it will be reloaded", name, exc_info=True)
+            fingerprints[name] = None
+
+    return fingerprints
+
+
+def _record_layer(run_budget, name, future):
+    #: Called when a layer finishes so the circuit breaker sees layer failures in the order they happen. Layers that
+    #: weren't started because of the budget don't count.
+    if future.cancelled() or isinstance(future.exception(), budget.BudgetExhausted):
+        return
+    run_budget.record_layer(name, future.exception() is None)
+
+
+def _likely_to_succeed_first(names, lookups, fingerprints, manifest):
+    #: The layers others wait for first, then the ones that FEMA answered a probe for and that loaded last time, then
+    #: the smallest (by the probe's count)
+    def _key(name):
+        fingerprint = fingerprints.get(name) or {}
+        return (
+            name not in lookups,
+            bool(fingerprints) and not fingerprint,
+            bool(manifest) and name not in manifest,
+            fingerprint.get("feature_count") or math.inf,
+        )
+
+    return sorted(names, key=_key)
+
+
+def _check_for_changes(module_logger, fema_extractor, run_budget=None):
+    """Find the layers that haven't changed since they were last loaded, if config.STATE_MANIFEST_PATH is set.
+
+    An enriched layer is reloaded if any layer it's enriched from changed, and those layers are then reloaded too.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        fema_extractor (extract.RESTServiceLoader): Loader for FEMA's map service
+        run_budget (budget.RunBudget, optional): The run's deadline and retry budget. Defaults to None.
+
+    Returns:
+        tuple[dict, dict, set]: The manifest, each layer's new fingerprint, and the names of the unchanged layers
+    """
+
+    manifest = {}
+    fingerprints = {}
+    if config.STATE_MANIFEST_PATH:
+        module_logger.info("Checking FEMA layers for changes...")
+        manifest = state.load_manifest(config.STATE_MANIFEST_PATH)
+        fingerprints = _probe_layers(module_logger, fema_extractor, run_budget)
+
+    unchanged = {
+        name for name in config.FEMA_LAYERS if fingerprints.get(name) and fingerprints[name] == manifest.get(name)
+    }
+    enriched_layers = _enriched_layers()
+    for name, enrichment in enriched_layers.items():
+        if not unchanged.issuperset(enrichment):
+            unchanged.discard(name)
+    for name, enrichment in enriched_layers.items():
+        if name not in unchanged:
+            unchanged.difference_update(enrichment)
+
+    return manifest, fingerprints, unchanged
+
+
+def _save_manifest(manifest, fingerprints, feature_counts):
+    #: Record the new fingerprint of every layer that loaded
+    for name, count in feature_counts.items():
+        if count not in ["error", "skipped", "timed out", "unchanged"] and fingerprints.get(name):
+            manifest[name] = fingerprints[name]
+    state.save_manifest(config.STATE_MANIFEST_PATH, manifest)
+
+
+def _process_layers(
+    module_logger,
+    tempdir,
+    gis,
+    fema_extractor,
+    request_controller,
+    run_metrics,
+    run_budget=None,
+    layer_names=None,
+    fingerprints=None,
+):
+    """Extract, transform, and load all the FEMA_LAYERS, running up to config.MAX_WORKERS layers at the same time.
+
+    Layers are independent of each other, so running them concurrently lets one layer's FEMA download overlap with
+    another's AGOL upload. Errors are caught per layer so that one failure doesn't stop the others.
+
+    If config.STATE_MANIFEST_PATH is set, each layer is probed for changes first and layers whose fingerprint matches
+    the one recorded after the last successful load are skipped and reported as "unchanged".
+
+    If config.ENRICHMENT is on, the layers that others are enriched from are submitted first. Each builds a spatial
+    lookup as soon as it's transformed, and the enriched layers wait for the lookups they need. An enriched layer is
+    reloaded if any layer it's enriched from changed, and those layers are then extracted (and reloaded) even if they
+    didn't change.
+
+    A fan-out worker passes just the layers from its message as layer_names. The coordinator has already checked
+    them for changes, so they're all processed.
+
+    Every layer shares run_budget's deadline, retries, and circuit breaker. When it has limits, the layers most likely
+    to finish are started first, layers not started once the deadline passes or the breaker opens are reported as
+    "skipped", and layers still running at the deadline are reported as "timed out" and left to finish on their own
+    so the summary can still be sent.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        tempdir (str): The run's temporary directory
+        gis (arcgis.gis.GIS): The AGOL organization's gis object
+        fema_extractor (extract.RESTServiceLoader): Loader for FEMA's map service
+        request_controller (controller.RequestController): The run's controller for requests to FEMA
+        run_metrics (metrics.RunMetrics): Collects the timings and sizes of each layer's stages
+        run_budget (budget.RunBudget, optional): The run's deadline, retry budget, and circuit breaker. Defaults to
+            None (no limits).
+        layer_names (list[str], optional): Only process these layers, without checking them for changes. Defaults
+            to None (every layer in FEMA_LAYERS).
+        fingerprints (dict, optional): The upstream fingerprints of layer_names from the coordinator's check for
+            changes, for keying the extraction cache. Defaults to None.
+
+    Returns:
+        dict: Number of features loaded (or "error", "skipped", "timed out", or "unchanged") for each layer, in
+            FEMA_LAYERS (or layer_names) order
+    """
+
+    if run_budget is None:
+        run_budget = budget.RunBudget(module_logger)
+
+    check_for_changes = layer_names is None
+    if check_for_changes:
+        manifest, fingerprints, unchanged = _check_for_changes(module_logger, fema_extractor, run_budget)
+        layer_names = list(config.FEMA_LAYERS)
+    else:
+        manifest, fingerprints, unchanged = {}, fingerprints or {}, set()
+
+    lookups = {}
+    for name, enrichment in _enriched_layers().items():
+        if name in layer_names and name not in unchanged:
+            lookups.update({reference: Future() for reference in enrichment if reference not in lookups})
+
+    #: Submitting the layers that others wait for first means a waiting layer can never hold the only free worker
+    submission_order = sorted(layer_names, key=lambda name: name not in lookups)
+    if run_budget.limited:
+        submission_order = _likely_to_succeed_first(submission_order, lookups, fingerprints, manifest)
+
+    #: Not a with block, which would wait for layers still running at the deadline before the summary could be sent
+    executor = ThreadPoolExecutor(max_workers=config.MAX_WORKERS, thread_name_prefix=config.SKID_NAME)
+    out_of_time = False
+    try:
+        futures = {}
+        for name in submission_order:
+            if name in unchanged:
+                module_logger.info("%s is unchanged since the last load, skipping", name)
+                futures[name] = None
+                continue
+            futures[name] = executor.submit(
+                _process_layer,
+                module_logger,
+                tempdir,
+                gis,
+                fema_extractor,
+                request_controller,
+                run_metrics,
+                config.FEMA_LAYERS[name],
+                lookups,
+                run_budget,
+                fingerprints.get(name),
+            )
+            futures[name].add_done_callback(functools.partial(_record_layer, run_budget, name))
+            if name in lookups:
+                futures[name].add_done_callback(functools.partial(_fail_lookup, lookups[name], name))
+
+        feature_counts = {}
+        for name in layer_names:
+            future = futures[name]
+            if future is None:
+                feature_counts[name] = "unchanged"
+                continue
+            if out_of_time and future.cancel():
+                module_logger.warning("Not starting %s: the run is out of time", name)
+                feature_counts[name] = "skipped"
+                continue
+            try:
+                features_loaded = future.result(timeout=run_budget.timeout())
+            except TimeoutError as error:
+                #: A layer's own timeout (eg, a socket timeout) is the same exception as waiting on it past the
+                #: deadline, but it comes from a finished future
+                if future.done() and future.exception() is error:
+                    module_logger.exception("Error loading %s", name)
+                    features_loaded = "error"
+                else:
+                    module_logger.error("%s didn't finish before the run's deadline", name)
+                    out_of_time = True
+                    features_loaded = "timed out"
+            except budget.BudgetExhausted as error:
+                module_logger.warning("%s", error)
+                features_loaded = "skipped"
+            except Exception:
+                module_logger.exception("Error loading %s", name)
+                features_loaded = "error"
+            feature_counts[name] = features_loaded
+    finally:
+        executor.shutdown(wait=not out_of_time, cancel_futures=True)
+
+    if config.STATE_MANIFEST_PATH and check_for_changes:
+        _save_manifest(manifest, fingerprints, feature_counts)
+
+    return feature_counts
+
+
+def _layer_groups(layer_names):
+    #: Layers enriched from each other have to be processed by the same worker, so group each enriched layer with the
+    #: layers it's enriched from and every other layer enriched from those. Every other layer is in a group of its own.
+    enriched_layers = _enriched_layers()
+    groups = []
+    for name in layer_names:
+        group = {name, *enriched_layers.get(name, {})}
+        group.update(other for other, enrichment in enriched_layers.items() if name in enrichment)
+        group &= set(layer_names)
+        for other_group in [other_group for other_group in groups if other_group & group]:
+            group |= other_group
+            groups.remove(other_group)
+        groups.append(group)
+    groups = [[name for name in layer_names if name in group] for group in groups]
+    return sorted(groups, key=lambda group: layer_names.index(group[0]))
+
+
+def _fanout_queue():
+    if config.FANOUT_TOPIC == "local":
+        return fanout.LocalQueue(process_message)
+    return fanout.PubSubQueue(config.FANOUT_TOPIC)
+
+
+def _fan_out(module_logger, tempdir, fema_extractor, request_controller, run_metrics, run_budget, run_id):
+    """Send each group of layers to a worker as a message, wait for their results, and collect them into this run.
+
+    The workers' stages are added to run_metrics and their FEMA requests and retries to request_controller's and
+    run_budget's so that the summary covers the whole run. Layers whose worker hasn't reported back by
+    config.FANOUT_TIMEOUT or the run's deadline are reported as "timed out".
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        tempdir (str): The run's temporary directory
+        fema_extractor (extract.RESTServiceLoader): Loader for FEMA's map service
+        request_controller (controller.RequestController): The run's controller for requests to FEMA
+        run_metrics (metrics.RunMetrics): Collects the timings and sizes of each layer's stages
+        run_budget (budget.RunBudget): The run's deadline, retry budget, and circuit breaker
+        run_id (str): Unique id for the run that the workers file their results under
+
+    Returns:
+        dict: Number of features loaded (or "error", "skipped", "timed out", or "unchanged") for each layer, in
+            FEMA_LAYERS order
+    """
+
+    manifest, fingerprints, unchanged = _check_for_changes(module_logger, fema_extractor, run_budget)
+    groups = _layer_groups([name for name in config.FEMA_LAYERS if name not in unchanged])
+    results_dir = config.FANOUT_RESULTS_DIR or Path(tempdir) / "fanout"
+
+    queue = _fanout_queue()
+    try:
+        for group in groups:
+            group_fingerprints = {name: fingerprints.get(name) for name in group}
+            message_id = queue.publish(fanout.encode(run_id, group, results_dir, group_fingerprints))
+            module_logger.info("Sent %s to a worker (message %s)", ", ".join(group), message_id)
+
+        timeout = config.FANOUT_TIMEOUT
+        if run_budget.timeout() is not None:
+            timeout = min(timeout, run_budget.timeout())
+        results = fanout.wait_for_results(results_dir, run_id, groups, timeout, config.FANOUT_POLL_SECONDS)
+    finally:
+        queue.close()
+
+    worker_counts = {}
+    for result in results.values():
+        worker_counts.update(result["feature_counts"])
+        run_metrics.stages.extend(metrics.Stage.from_dict(values) for values in result["stages"])
+        request_controller.requests += result["requests"]
+        request_controller.failed_requests += result["failed_requests"]
+        run_budget.retries += result["retries"]
+        run_budget.breaker_open |= result["breaker_open"]
+
+    feature_counts = {}
+    for name in config.FEMA_LAYERS:
+        if name in unchanged:
+            module_logger.info("%s is unchanged since the last load, skipping", name)
+            feature_counts[name] = "unchanged"
+        elif name in worker_counts:
+            feature_counts[name] = worker_counts[name]
+        else:
+            module_logger.error("%s's worker didn't report back before the run's deadline", name)
+            feature_counts[name] = "timed out"
+
+    if config.STATE_MANIFEST_PATH:
+        _save_manifest(manifest, fingerprints, feature_counts)
+
+    return feature_counts
+
+
+def _validate_config():
+    unknown_sinks = set(config.OUTPUT_SINKS) - {"agol", *FILE_SINKS}
+    if unknown_sinks:
+        raise ValueError(f"Unknown output sinks {sorted(unknown_sinks)}, expected agol or one of {list(FILE_SINKS)}")
+    for sink, output_dir in [("geoparquet", "GEOPARQUET_OUTPUT_DIR"), ("vector_tiles", "VECTOR_TILE_OUTPUT_DIR")]:
+        if sink in config.OUTPUT_SINKS and not getattr(config, output_dir):
+            raise ValueError(f"{output_dir} must be set to use the {sink} sink")
+    unknown_references = {name for enrichment in _enriched_layers().values() for name in enrichment}
+    unknown_references -= set(config.FEMA_LAYERS)
+    if unknown_references:
+        raise ValueError(f"Layers {sorted(unknown_references)} are used for enrichment but aren't in FEMA_LAYERS")
+    if config.BLUE_GREEN:
+        for name, layer in config.FEMA_LAYERS.items():
+            source_itemids = layer.get("source_itemids")
+            if source_itemids and (len(set(source_itemids)) != 2 or layer["itemid"] in source_itemids):
+                raise ValueError(f"{name} needs two different source_itemids that aren't its view's itemid")
+    if config.FANOUT_TOPIC not in [None, "local"] and not config.FANOUT_RESULTS_DIR:
+        raise ValueError("FANOUT_RESULTS_DIR must be set to somewhere the workers can write to")
+
+
+def _run_budget(module_logger, start):
+    #: The deadline starts from when the run started so that setting up counts against it
+    run_seconds = None
+    if config.RUN_SECONDS is not None:
+        run_seconds = config.RUN_SECONDS - (datetime.now() - start).total_seconds()
+    return budget.RunBudget(
+        module_logger,
+        run_seconds=run_seconds,
+        summary_seconds=config.SUMMARY_SECONDS,
+        max_retries=config.RETRY_BUDGET,
+        breaker_threshold=config.BREAKER_THRESHOLD,
+    )
+
+
+def _request_controller(module_logger, run_budget):
+    #: Every request to FEMA in the run goes through the controller and shares its pooled session
+    return controller.RequestController(
+        module_logger,
+        run_budget=run_budget,
+        session=query.make_session(config.HTTP_POOL_SIZE),
+        **config.REQUEST_CONTROLLER_SETTINGS,
+    )
+
+
+def process_message(event, context=None):  # pylint: disable=unused-argument
+    """The fan-out worker's entry point: process the layers named in a coordinator's message and save the results.
+
+    Deploy it behind a Pub/Sub trigger on config.FANOUT_TOPIC (eg, functions-framework --target=process_message
+    --signature-type=event). The worker doesn't send a summary; its log goes to stdout and its results are saved for
+    the coordinator. Errors are recorded in the results instead of raised so Pub/Sub doesn't redeliver the message.
+
+    Args:
+        event (dict): The Pub/Sub message, with a fanout.encode()d message as its data
+        context (google.cloud.functions.Context, optional): The event's metadata. Defaults to None.
+    """
+
+    import arcgis
+    from palletjack import extract
+
+    message = fanout.decode(event)
+    layer_names = message["layers"]
+    start = datetime.now()
+    module_logger = logging.getLogger(config.SKID_NAME)
+    run_metrics = metrics.RunMetrics(module_logger)
+    run_budget = _run_budget(module_logger, start)
+    request_controller = _request_controller(module_logger, run_budget)
+    feature_counts = dict.fromkeys(layer_names, "error")
+
+    loggers = [logging.getLogger(config.SKID_NAME), logging.getLogger("palletjack")]
+    handler_counts = {logger.name: len(logger.handlers) for logger in loggers}
+    with TemporaryDirectory(ignore_cleanup_errors=True) as tempdir:
+        try:
+            _validate_config()
+            secrets = SimpleNamespace(**_get_secrets())
+            log_path = Path(tempdir) / f"{config.LOG_FILE_NAME}_{start.strftime('%Y%m%d-%H%M%S')}.txt"
+            _initialize(log_path, secrets.SENDGRID_API_KEY)
+            module_logger.info("Processing %s for run %s", ", ".join(layer_names), message["run_id"])
+            gis = None
+            if "agol" in config.OUTPUT_SINKS:
+                gis = arcgis.gis.GIS(config.AGOL_ORG, secrets.AGOL_USER, secrets.AGOL_PASSWORD)
+            fema_extractor = extract.RESTServiceLoader(config.SERVICE_URL, timeout=config.TIMEOUT)
+            feature_counts = _process_layers(
+                module_logger,
+                tempdir,
+                gis,
+                fema_extractor,
+                request_controller,
+                run_metrics,
+                run_budget,
+                layer_names,
+                message.get("fingerprints"),
+            )
+        except Exception:
+            module_logger.exception("Error processing %s", ", ".join(layer_names))
+        finally:
+            fanout.write_result(
+                message["results_dir"],
+                message["run_id"],
+                layer_names,
+                {
+                    "feature_counts": feature_counts,
+                    "stages": [stage.to_dict() for stage in run_metrics.stages],
+                    "requests": request_controller.requests,
+                    "failed_requests": request_controller.failed_requests,
+                    "retries": run_budget.retries,
+                    "breaker_open": run_budget.breaker_open,
+                },
+            )
+            request_controller.session.close()
+            #: A worker instance handles many messages, so remove this message's handlers instead of piling them up
+            for logger in loggers:
+                for handler in logger.handlers[handler_counts[logger.name] :]:
+                    logger.removeHandler(handler)
+                    handler.close()
+
+
+def process(profile=None):  # pylint: disable=too-many-locals
+    """The main function that does all the work.
+
+    If config.FANOUT_TOPIC is set, this is the fan-out coordinator: each layer (or group of layers enriched from
+    each other) is sent to a worker as a message, and the summary is sent once the workers have reported back.
+
+    Args:
+        profile (bool, optional): Profile each stage of the layers processed here and attach the profiles to the
+            summary. Defaults to None (config.PROFILE).
+    """
+
+    import arcgis
+    from palletjack import extract
+    from supervisor.models import MessageDetails
+
+    _validate_config()
 
     #: Set up secrets, tempdir, supervisor, and logging
     start = datetime.now()
 
     secrets = SimpleNamespace(**_get_secrets())
 
-    with TemporaryDirectory() as tempdir:
+    #: Layers still running at the deadline may hold files in the tempdir when it's cleaned up
+    with TemporaryDirectory(ignore_cleanup_errors=True) as tempdir:
         tempdir_path = Path(tempdir)
         log_name = f"{config.LOG_FILE_NAME}_{start.strftime('%Y%m%d-%H%M%S')}.txt"
         log_path = tempdir_path / log_name
 
         skid_supervisor = _initialize(log_path, secrets.SENDGRID_API_KEY)
-        #: Get our GIS object via the ArcGIS API for Python
-        gis = arcgis.gis.GIS(config.AGOL_ORG, secrets.AGOL_USER, secrets.AGOL_PASSWORD)
+        #: Get our GIS object via the ArcGIS API for Python, unless only writing file outputs
+        gis = None
+        if "agol" in config.OUTPUT_SINKS:
+            gis = arcgis.gis.GIS(config.AGOL_ORG, secrets.AGOL_USER, secrets.AGOL_PASSWORD)
         fema_extractor = extract.RESTServiceLoader(config.SERVICE_URL, timeout=config.TIMEOUT)
         module_logger = logging.getLogger(config.SKID_NAME)
 
-        feature_counts = {}
-
-        for name, layer in config.FEMA_LAYERS.items():
+        run_budget = _run_budget(module_logger, start)
+        request_controller = _request_controller(module_logger, run_budget)
+        profiler = None
+        if config.PROFILE if profile is None else profile:
+            profiler = profiling.StageProfiler(
+                module_logger,
+                tempdir_path / f"{config.PROFILE_DIR_NAME}_{start.strftime('%Y%m%d-%H%M%S')}",
+                top=config.PROFILE_TOP_ALLOCATIONS,
+            )
+            profiler.start()
+        run_metrics = metrics.RunMetrics(module_logger, profiler)
+
+        if config.FANOUT_TOPIC:
+            run_id = f"{start.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+            feature_counts = _fan_out(
+                module_logger, tempdir, fema_extractor, request_controller, run_metrics, run_budget, run_id
+            )
+        else:
+            feature_counts = _process_layers(
+                module_logger, tempdir, gis, fema_extractor, request_controller, run_metrics, run_budget
+            )
+        request_controller.session.close()
+        if profiler is not None:
+            profiler.stop()
+
+        hazard_area_result = None  #: not applicable without the hosted layers
+        if gis is not None:
+            module_logger.info("Updating hazard area symbology...")
             try:
-                layer_df = utils.retry(_extract_layer, module_logger, fema_extractor, layer)
-                layer_df = utils.retry(_transform_layer, module_logger, layer, layer_df)
-                _delete_existing_gdb_item(gis, "palletjack Temporary gdb upload", module_logger)
-                features_loaded = utils.retry(_load_layer, module_logger, tempdir, gis, layer, layer_df)
-                del layer_df
+                hazard_area_result = _update_hazard_layer_symbology(gis)
             except Exception:
-                module_logger.exception("Error loading %s", name)
-                features_loaded = "error"
-            feature_counts[name] = features_loaded
-
-        module_logger.info("Updating hazard area symbology...")
-        try:
-            hazard_area_result = _update_hazard_layer_symbology(gis)
-        except Exception:
-            module_logger.exception("Error updating hazard area symbology")
-            hazard_area_result = False
+                module_logger.exception("Error updating hazard area symbology")
+                hazard_area_result = False
 
         end = datetime.now()
-        error_count = sum(count == "error" for count in feature_counts.values()) + int(not hazard_area_result)
+        repaired_geometries = sum(stage.counts.get("repaired", 0) for stage in run_metrics.stages)
+        dropped_geometries = sum(stage.counts.get("dropped", 0) for stage in run_metrics.stages)
+        error_count = (
+            sum(count in ["error", "skipped", "timed out"] for count in feature_counts.values())
+            + sum(stage.name in FILE_SINKS and stage.status == "error" for stage in run_metrics.stages)
+            + int(gis is not None and not hazard_area_result)
+        )
 
         summary_message = MessageDetails()
         summary_message.subject = f"{config.SKID_NAME} Update Summary"
@@ -316,9 +1375,45 @@ def process():  # pylint: disable=too-many-locals
         ]
         summary_rows.extend([f"{name}: {count}" for name, count in feature_counts.items()])
         summary_rows.append(f"Hazard Area Symbology Updated: {hazard_area_result}")
+        summary_rows.extend(["", "Stage Metrics:"])
+        summary_rows.extend(run_metrics.summary_rows())
+        summary_rows.append(
+            f"FEMA requests: {request_controller.requests} ({request_controller.failed_requests} failed)"
+        )
+        summary_rows.append(f"Invalid geometries: {repaired_geometries} repaired, {dropped_geometries} dropped")
+        summary_rows.append(f"Run budget: {run_budget}")
+        if profiler is not None:
+            summary_rows.append(f"Profiles: {profiler}")
 
         summary_message.message = "\n".join(summary_rows)
         summary_message.attachments = tempdir_path / log_name
+        if profiler is not None:
+            summary_message.attachments = profiler.profile_dir  #: the directory is zipped into one attachment
+
+        run_values = {
+            "duration_seconds": (end - start).total_seconds(),
+            "errors": error_count,
+            "requests": request_controller.requests,
+            "failed_requests": request_controller.failed_requests,
+            "repaired_geometries": repaired_geometries,
+            "dropped_geometries": dropped_geometries,
+            "retries": run_budget.retries,
+        }
+        try:
+            summary_message.attachments = run_metrics.write_report(
+                tempdir_path / f"{config.REPORT_FILE_NAME}_{start.strftime('%Y%m%d-%H%M%S')}.json",
+                skid=config.SKID_NAME,
+                version=version.__version__,
+                start=start.isoformat(),
+                end=end.isoformat(),
+                feature_counts=feature_counts,
+                hazard_area_symbology_updated=bool(hazard_area_result),
+                **run_values,
+            )
+            if config.PROMETHEUS_TEXTFILE_PATH:
+                run_metrics.write_prometheus(config.PROMETHEUS_TEXTFILE_PATH, config.SKID_NAME, **run_values)
+        except Exception:
+            module_logger.exception("Error writing run report")
 
         skid_supervisor.notify(summary_message)
 
@@ -327,5 +1422,23 @@ def process():  # pylint: disable=too-many-locals
         _remove_log_file_handlers(log_name, loggers)
 
 
+def cli(argv=None):
+    """The nfhl-skid command.
+
+    Args:
+        argv (list[str], optional): The command's arguments. Defaults to None (sys.argv).
+    """
+
+    parser = argparse.ArgumentParser(prog="nfhl-skid", description="Update the DEM Flood Map data from FEMA")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=None,
+        help="profile each layer's stages with cProfile and tracemalloc and attach the profiles to the summary",
+    )
+    arguments = parser.parse_args(argv)
+    process(profile=arguments.profile)
+
+
 if __name__ == "__main__":
-    process()
+    cli()
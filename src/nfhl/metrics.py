@@ -0,0 +1,241 @@
+"""
+metrics.py: Per-layer, per-stage timings and sizes for the summary message, a json run report, and Prometheus
+"""
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+#: resource is only available on unix-like systems, so peak memory isn't reported on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_memory():
+    """Get the process's peak resident set size (the high-water mark, not the current usage).
+
+    Returns:
+        int: Peak RSS in bytes, or None if it isn't available on this platform
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #: ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _megabytes(size):
+    return "unknown" if size is None else f"{size / 1024**2:.1f} MB"
+
+
+class Stage:
+    """Measurements for one stage (extract, validate, transform, or load) of one layer."""
+
+    def __init__(self, layer, name):
+        self.layer = layer
+        self.name = name
+        self.status = "running"
+        self.seconds = None
+        self.rows = None
+        self.memory_bytes = None  #: in-memory size of the stage's dataframe
+        self.attempts = 0
+        self.peak_rss_bytes = None
+        self.counts = {}  #: tallies specific to the stage, such as the geometries that validation repaired and dropped
+
+    def counted(self, function):
+        """Wrap function so that each call (ie, each utils.retry attempt) is counted in this stage's attempts.
+
+        Args:
+            function (callable): The function to count
+
+        Returns:
+            callable: The wrapped function
+        """
+
+        def _counted(*args, **kwargs):
+            self.attempts += 1
+            return function(*args, **kwargs)
+
+        return _counted
+
+    def measure(self, dataframe):
+        """Record the number of rows and the in-memory size of the stage's dataframe.
+
+        Args:
+            dataframe (pd.DataFrame): The stage's output (or for load, input) dataframe
+        """
+
+        self.rows = len(dataframe)
+        self.memory_bytes = int(dataframe.memory_usage(deep=True).sum())
+
+    def to_dict(self):
+        return {
+            "layer": self.layer,
+            "stage": self.name,
+            "status": self.status,
+            "seconds": self.seconds,
+            "rows": self.rows,
+            "memory_bytes": self.memory_bytes,
+            "attempts": self.attempts,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "counts": self.counts,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        """Rebuild a stage from to_dict(), such as one measured by a fan-out worker on another instance.
+
+        Args:
+            values (dict): The stage's to_dict()
+
+        Returns:
+            Stage: The stage
+        """
+
+        stage = cls(values["layer"], values["stage"])
+        for field in ["status", "seconds", "rows", "memory_bytes", "attempts", "peak_rss_bytes", "counts"]:
+            setattr(stage, field, values[field])
+        return stage
+
+    def __str__(self):
+        rows = "unknown" if self.rows is None else f"{self.rows:,}"
+        attempts = f"{self.attempts} attempt" + ("" if self.attempts == 1 else "s")
+        counts = "".join(f", {count:,} {name}" for name, count in self.counts.items())
+        status = "" if self.status == "ok" else f" ({self.status})"
+        memory = "unknown" if self.memory_bytes is None else f"{_megabytes(self.memory_bytes)} in memory"
+        return f"{self.name} {self.seconds:.1f}s, {rows} rows, {memory}, {attempts}{counts}{status}"
+
+
+class RunMetrics:
+    """Collects the stages of every layer in a run. Safe to share between the threads processing layers."""
+
+    def __init__(self, module_logger, profiler=None):
+        """
+        Args:
+            module_logger (logging.Logger): The skid's logger
+            profiler (profiling.StageProfiler, optional): Also profile each stage's CPU time and allocations. Defaults
+                to None (no profiling and no overhead).
+        """
+
+        self._logger = module_logger
+        self.profiler = profiler
+        self._lock = threading.Lock()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, layer, name):
+        """Time the code run inside the context as one of layer's stages.
+
+        The Stage is yielded so that the code can count attempts and measure its dataframe. The stage's status, time,
+        and the process's peak memory so far are recorded and logged when the context exits, even if it raises. With a
+        profiler, the stage is profiled as well and its time includes the profiling overhead.
+
+        Args:
+            layer (str): The layer's name
+            name (str): The stage's name
+
+        Yields:
+            Stage: The stage's measurements
+        """
+
+        stage = Stage(layer, name)
+        with self._lock:
+            self.stages.append(stage)
+
+        profile = nullcontext() if self.profiler is None else self.profiler.profile(layer, name)
+        start = time.perf_counter()
+        try:
+            with profile:
+                yield stage
+            stage.status = "ok"
+        except Exception:
+            stage.status = "error"
+            raise
+        finally:
+            stage.seconds = time.perf_counter() - start
+            stage.peak_rss_bytes = peak_memory()
+            self._logger.info("%s %s (peak process memory %s)", layer, stage, _megabytes(stage.peak_rss_bytes))
+
+    def summary_rows(self):
+        """Format the stages as one line per layer for the summary message.
+
+        Returns:
+            list[str]: A line for each layer with its stages in the order they ran
+        """
+
+        layers = {}
+        for stage in self.stages:
+            layers.setdefault(stage.layer, []).append(str(stage))
+        return [f"{layer}: {'; '.join(stages)}" for layer, stages in layers.items()]
+
+    def report(self, **run_info):
+        """Build the run report.
+
+        Args:
+            **run_info (keyword arguments): Run-level values (start, duration, errors, etc) to include in the report
+
+        Returns:
+            dict: run_info plus the run's peak memory and a list of every stage
+        """
+
+        return {**run_info, "peak_rss_bytes": peak_memory(), "stages": [stage.to_dict() for stage in self.stages]}
+
+    def write_report(self, report_path, **run_info):
+        """Write the run report as json.
+
+        Args:
+            report_path (str or Path): Path to the json file
+            **run_info (keyword arguments): Run-level values to include in the report
+
+        Returns:
+            Path: Path to the report
+        """
+
+        report_path = Path(report_path)
+        report_path.write_text(json.dumps(self.report(**run_info), indent=2, default=str), encoding="utf-8")
+        return report_path
+
+    def write_prometheus(self, textfile_path, prefix, **run_values):
+        """Write the stages and numeric run values in the Prometheus text format for node_exporter's textfile collector.
+
+        The file is written via a temporary file so the collector never reads a partial file.
+
+        Args:
+            textfile_path (str or Path): Path to the .prom file, in the collector's directory
+            prefix (str): Prefix for the metric names, such as the skid's name
+            **run_values (keyword arguments): Numeric run-level values, each written as {prefix}_{name}
+        """
+
+        lines = []
+        for field in ["seconds", "rows", "memory_bytes", "attempts"]:
+            metric = f"{prefix}_stage_{field}"
+            lines.extend(
+                [
+                    f"# HELP {metric} The {field.replace('_', ' ')} of each layer's extract, transform, and load",
+                    f"# TYPE {metric} gauge",
+                ]
+            )
+            for stage in self.stages:
+                value = getattr(stage, field)
+                if value is not None:
+                    lines.append(
+                        f'{metric}{{layer="{stage.layer}",stage="{stage.name}",status="{stage.status}"}} {value}'
+                    )
+
+        run_values = {**run_values, "peak_rss_bytes": peak_memory()}
+        for name, value in run_values.items():
+            if value is None:
+                continue
+            lines.extend([f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {float(value)}"])
+
+        textfile_path = Path(textfile_path)
+        textfile_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = textfile_path.with_suffix(".tmp")
+        temp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        temp_path.replace(textfile_path)
@@ -0,0 +1,305 @@
+"""
+paging.py: Page-checkpointed feature extraction so a failed request only costs the page it was fetching
+"""
+
+import copy
+import json
+import shutil
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+
+#: gpd.read_parquet arguments that read strings as pyarrow-backed pandas strings instead of python objects
+ARROW_STRING_KWARGS = {
+    "to_pandas_kwargs": {
+        "types_mapper": {pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}.get
+    }
+}
+
+
+def _read_parquet(path, arrow_strings):
+    return gpd.read_parquet(path, **(ARROW_STRING_KWARGS if arrow_strings else {}))
+
+
+def _get_object_ids(service_layer, scratch_dir, controller):
+    oids_path = scratch_dir / "object_ids.json"
+    if oids_path.exists():
+        return json.loads(oids_path.read_text(encoding="utf-8"))
+
+    oids = controller.call(_request, service_layer, service_layer.get_object_ids, controller)
+    oids_path.write_text(json.dumps(oids), encoding="utf-8")
+    return oids
+
+
+def _request(service_layer, method, controller, *args):
+    #: ServiceLayer reads its timeout for each request, so apply the controller's current timeout right before calling
+    service_layer.timeout = controller.timeout
+    return method(*args)
+
+
+def _completed_pages(scratch_dir):
+    #: Page files are named with the start and end positions of their OBJECTIDs in the layer's sorted OBJECTID list
+    completed = {}
+    for page_path in scratch_dir.glob("page_*.parquet"):
+        _, start, end = page_path.stem.split("_")
+        completed[int(start)] = (int(end), page_path)
+    return completed
+
+
+def get_features(module_logger, service_layer, scratch_dir, controller, warn_empty=True, arrow_strings=False):
+    """Download a layer's features page by page, saving each page to scratch_dir as soon as it arrives.
+
+    This mirrors palletjack's RESTServiceLoader.get_features, but pages (and the list of OBJECTIDs they're built from)
+    that are already in scratch_dir are not downloaded again. When a page still fails after its own retries, the
+    error is raised as usual; calling get_features again with the same scratch_dir only fetches the pages that are
+    missing. Once every page is present, they are put back together and scratch_dir is removed.
+
+    Every request goes through the run's RequestController, which sets the pacing, timeout, and retries. Up to the
+    controller's current concurrency pages are downloaded at the same time, and each page uses the controller's page
+    size at the time it's requested, so pages shrink and fewer are in flight while FEMA is struggling and they grow
+    (up to the layer's maxRecordCount) while it's healthy.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        service_layer (extract.ServiceLayer): The layer to download
+        scratch_dir (Path): Directory for this layer's downloaded pages, usually in the run's tempdir
+        controller (controller.RequestController): The run's request controller
+        warn_empty (bool, optional): Warn if the layer has no features. Defaults to True.
+        arrow_strings (bool, optional): Read the pages' strings as pyarrow-backed strings so the combined layer never
+            holds them as python objects. Defaults to False.
+
+    Returns:
+        gpd.GeoDataFrame: The layer's features with their geometry in the SHAPE column, or None if the layer has no
+            features
+    """
+
+    from palletjack import utils
+
+    scratch_dir = Path(scratch_dir)
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+
+    service_layer.check_capabilities("query")
+    oids = _get_object_ids(service_layer, scratch_dir, controller)
+    if not oids:
+        if warn_empty:
+            warnings.warn(f"Layer {service_layer.layer_url} has no features")
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        return None
+
+    completed = _completed_pages(scratch_dir)
+    module_logger.debug(
+        "Downloading %s features from %s (%s pages already downloaded)",
+        len(oids),
+        service_layer.layer_url,
+        len(completed),
+    )
+
+    def _get_page(start, end):
+        page_df = controller.call(
+            _request,
+            service_layer,
+            service_layer.get_unique_id_list_as_dataframe,
+            controller,
+            service_layer.oid_field,
+            oids[start:end],
+        )
+        page_path = scratch_dir / f"page_{start:07d}_{end:07d}.parquet"
+        temp_path = page_path.with_suffix(".tmp")
+        utils.convert_to_gdf(page_df).to_parquet(temp_path)
+        temp_path.replace(page_path)
+        return end, page_path
+
+    #: Keep as many pages in flight as the controller currently allows, planning each page only when it's submitted
+    #: so that it gets the controller's page size at the time. If a page fails, the pages already in flight still
+    #: finish (and are saved) before the error is raised.
+    in_flight = {}
+    position = 0
+    with ThreadPoolExecutor(max_workers=controller.max_concurrency) as executor:
+        while position < len(oids) or in_flight:
+            while position < len(oids) and len(in_flight) < controller.concurrency:
+                if position in completed:
+                    position = completed[position][0]
+                    continue
+
+                #: Don't overlap the next page that's already been downloaded
+                next_completed = min((start for start in completed if start > position), default=len(oids))
+                page_size = min(controller.page_size, service_layer.max_record_count)
+                end = min(position + page_size, next_completed)
+                in_flight[executor.submit(_get_page, position, end)] = position
+                position = end
+
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                completed[in_flight.pop(future)] = future.result()
+
+    page_paths = [completed[start][1] for start in sorted(completed)]
+    features_df = pd.concat([_read_parquet(page_path, arrow_strings) for page_path in page_paths], ignore_index=True)
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return features_df
+
+
+def _partition_layer(service_layer, partition):
+    #: Copy the layer instead of creating a new ServiceLayer so that the layer info isn't requested for every partition
+    partition_layer = copy.copy(service_layer)
+    partition_layer.where_clause = partition.get("where_clause", service_layer.where_clause)
+    if "envelope_params" in partition:
+        partition_layer.envelope_params = {"geometryType": "esriGeometryEnvelope", **partition["envelope_params"]}
+    return partition_layer
+
+
+def _get_partition(module_logger, service_layer, partition, scratch_dir, controller, arrow_strings):
+    partition_path = scratch_dir / f"{partition['name']}.parquet"
+    empty_marker = scratch_dir / f"{partition['name']}.empty"
+    if partition_path.exists():
+        return _read_parquet(partition_path, arrow_strings)
+    if empty_marker.exists():
+        return None
+
+    module_logger.debug("Extracting partition %s of %s", partition["name"], service_layer.layer_url)
+    #: Empty partitions are expected (not every county has every layer), so don't warn about each one
+    partition_df = get_features(
+        module_logger,
+        _partition_layer(service_layer, partition),
+        scratch_dir / partition["name"],
+        controller,
+        warn_empty=False,
+        arrow_strings=arrow_strings,
+    )
+
+    if partition_df is None:
+        empty_marker.touch()
+        return None
+
+    temp_path = partition_path.with_suffix(".tmp")
+    partition_df.to_parquet(temp_path)
+    temp_path.replace(partition_path)
+
+    return partition_df
+
+
+def get_partitioned_features(
+    module_logger, service_layer, partitions, scratch_dir, controller, max_workers=4, arrow_strings=False
+):
+    """Download a layer as several smaller queries, fetching up to max_workers partitions at the same time.
+
+    Each partition is a dictionary with a unique "name" and a "where_clause" and/or "envelope_params" that replace the
+    layer's own (see config.DFIRM_PARTITIONS and config.UTAH_TILES). Partitions are extracted with get_features and
+    saved to scratch_dir when complete, so a retry only downloads the partitions (and pages) that are missing. The
+    partitions are then concatenated and any feature returned by more than one partition (such as a feature crossing
+    a tile boundary) is only kept once.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        service_layer (extract.ServiceLayer): The layer to download
+        partitions (list[dict]): The partitions to split the layer into
+        scratch_dir (Path): Directory for this layer's downloaded partitions, usually in the run's tempdir
+        controller (controller.RequestController): The run's request controller, which also limits how many requests
+            are actually in flight
+        max_workers (int, optional): Number of partitions to download at the same time. Defaults to 4.
+        arrow_strings (bool, optional): Read strings as pyarrow-backed strings (see get_features). Defaults to False.
+
+    Returns:
+        gpd.GeoDataFrame: The layer's features with their geometry in the SHAPE column, or None if none of the
+            partitions have features
+    """
+
+    scratch_dir = Path(scratch_dir)
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        partition_dfs = list(
+            executor.map(
+                lambda partition: _get_partition(
+                    module_logger, service_layer, partition, scratch_dir, controller, arrow_strings
+                ),
+                partitions,
+            )
+        )
+
+    partition_dfs = [partition_df for partition_df in partition_dfs if partition_df is not None]
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    if not partition_dfs:
+        warnings.warn(f"Layer {service_layer.layer_url} has no features")
+        return None
+
+    features_df = pd.concat(partition_dfs, ignore_index=True)
+    duplicates = features_df.duplicated(subset=service_layer.oid_field)
+    if duplicates.any():
+        module_logger.debug("Dropping %s features returned by more than one partition", duplicates.sum())
+        features_df = features_df[~duplicates].reset_index(drop=True)
+
+    return features_df
+
+
+def iter_features(module_logger, service_layer, controller, batch_size, partitions=None):
+    """Yield a layer's features in batches of batch_size as they are downloaded instead of assembling the whole layer.
+
+    Pages are requested through the run's RequestController like get_features, but are held in memory only until
+    there are enough of them to fill a batch, so memory is bounded by batch_size instead of the size of the layer.
+    Pages aren't checkpointed to disk; if a request still fails after the controller's retries, the error is raised
+    from the generator.
+
+    If partitions are given (see get_partitioned_features), they are downloaded one after another and any feature
+    already returned by an earlier partition is skipped before its page is requested.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        service_layer (extract.ServiceLayer): The layer to download
+        controller (controller.RequestController): The run's request controller
+        batch_size (int): Number of features in each batch (the last batch may be smaller)
+        partitions (list[dict], optional): The partitions to split the layer into. Defaults to None.
+
+    Yields:
+        gpd.GeoDataFrame: The next batch of features with their geometry in the SHAPE column
+    """
+
+    from palletjack import utils
+
+    service_layer.check_capabilities("query")
+
+    seen_oids = set()
+    pages = []
+    pending = 0
+    for partition in partitions or [None]:
+        query_layer = service_layer if partition is None else _partition_layer(service_layer, partition)
+        oids = controller.call(_request, query_layer, query_layer.get_object_ids, controller) or []
+        oids = [oid for oid in oids if oid not in seen_oids]
+        seen_oids.update(oids)
+        module_logger.debug(
+            "Streaming %s features from %s%s",
+            len(oids),
+            service_layer.layer_url,
+            f" partition {partition['name']}" if partition else "",
+        )
+
+        position = 0
+        while position < len(oids):
+            #: Don't request more than is needed to fill the current batch
+            page_size = min(controller.page_size, service_layer.max_record_count, batch_size - pending)
+            page_oids = oids[position : position + page_size]
+            page_df = controller.call(
+                _request,
+                query_layer,
+                query_layer.get_unique_id_list_as_dataframe,
+                controller,
+                query_layer.oid_field,
+                page_oids,
+            )
+            pages.append(utils.convert_to_gdf(page_df))
+            pending += len(page_oids)
+            position += len(page_oids)
+
+            if pending >= batch_size:
+                yield pd.concat(pages, ignore_index=True)
+                pages = []
+                pending = 0
+
+    if pages:
+        yield pd.concat(pages, ignore_index=True)
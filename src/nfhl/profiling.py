@@ -0,0 +1,137 @@
+"""
+profiling.py: Opt-in cProfile and tracemalloc profiles of each layer's stages, for finding where a slow run's time went
+"""
+
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+#: Allocations made by tracemalloc itself and by the import machinery aren't the stage's
+ALLOCATION_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def _megabytes(size):
+    return f"{size / 1024**2:,.1f} MB"
+
+
+class StageProfiler:
+    """Profiles the CPU time and memory allocations of each stage that RunMetrics times.
+
+    Each stage's calls are recorded with cProfile and saved as {layer}_{stage}.pstats (open them with pstats or a
+    viewer like snakeviz). Its allocations are compared with tracemalloc snapshots taken before and after the stage and
+    the top lines by growth are saved in {layer}_{stage}_allocations.txt.
+
+    Only one stage is CPU-profiled at a time, because Python 3.12+ allows only one active profiler in the process.
+    A stage that starts while another is being profiled (when layers run concurrently or stages are nested) just gets
+    its allocation report. tracemalloc traces the whole process, so allocations from other threads, such as other
+    layers running at the same time, show up in every stage that overlaps them. Set MAX_WORKERS to 1 for clean
+    profiles.
+    """
+
+    def __init__(self, module_logger, profile_dir, top=25):
+        """
+        Args:
+            module_logger (logging.Logger): The skid's logger
+            profile_dir (str or Path): Directory for the profiles, usually in the run's tempdir
+            top (int, optional): Number of allocation sites listed in each report. Defaults to 25.
+        """
+
+        self._logger = module_logger
+        self.profile_dir = Path(profile_dir)
+        self.top = top
+        self.profiled = []  #: (layer, stage) of every stage profiled so far
+        self._cpu_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._started_tracing = False
+
+    def start(self):
+        """Create the profile directory and start tracing allocations if nothing else already is."""
+
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        """Stop tracing allocations if start() started it."""
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _snapshot(self):
+        if not tracemalloc.is_tracing():
+            return None
+        return tracemalloc.take_snapshot().filter_traces(ALLOCATION_FILTERS)
+
+    @contextmanager
+    def profile(self, layer, name):
+        """Profile the code run inside the context as one of layer's stages and save its profiles when it exits.
+
+        Args:
+            layer (str): The layer's name
+            name (str): The stage's name
+        """
+
+        before = self._snapshot()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start_size = tracemalloc.get_traced_memory()[0] if before is not None else 0
+
+        cpu_profile = None
+        if self._cpu_lock.acquire(blocking=False):
+            cpu_profile = cProfile.Profile()
+            try:
+                cpu_profile.enable()
+            except ValueError:  #: another profiler, such as a debugger's, is already active
+                self._cpu_lock.release()
+                cpu_profile = None
+
+        try:
+            yield
+        finally:
+            if cpu_profile is not None:
+                cpu_profile.disable()
+                self._cpu_lock.release()
+            try:
+                self._save(layer, name, cpu_profile, before, start_size)
+            except Exception:
+                self._logger.warning("Could not save the profiles of %s %s", layer, name, exc_info=True)
+
+    def _save(self, layer, name, cpu_profile, before, start_size):
+        stem = f"{layer}_{name}"
+        lines = [f"{layer} {name}"]
+        if cpu_profile is not None:
+            cpu_profile.dump_stats(self.profile_dir / f"{stem}.pstats")
+        else:
+            lines.append("Not CPU-profiled: another stage was being profiled at the same time")
+
+        after = self._snapshot()
+        if before is None or after is None:
+            lines.append("Allocations weren't traced")
+        else:
+            size, peak = tracemalloc.get_traced_memory()
+            growth, peak_growth = _megabytes(size - start_size), _megabytes(peak - start_size)
+            lines.extend(
+                [
+                    f"Traced memory grew by {growth}, peaking {peak_growth} above where it started (process-wide)",
+                    "",
+                    f"Top {self.top} allocation sites by growth:",
+                ]
+            )
+            lines.extend(str(statistic) for statistic in after.compare_to(before, "lineno")[: self.top])
+        (self.profile_dir / f"{stem}_allocations.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+        with self._lock:
+            self.profiled.append((layer, name))
+        self._logger.debug("Saved the profiles of %s %s to %s", layer, name, self.profile_dir)
+
+    def __str__(self):
+        return f"{len(self.profiled)} stages profiled, attached as {self.profile_dir.name}"
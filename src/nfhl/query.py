@@ -0,0 +1,537 @@
+"""
+query.py: FEMA layer queries over the run's pooled HTTP session, in json or Esri's compact protobuf (f=pbf) format
+"""
+
+import math
+import struct
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+#: Protobuf wire types
+VARINT, FIXED64, LENGTH_DELIMITED, FIXED32 = 0, 1, 2, 5
+
+#: Esri FeatureCollectionPBuffer enums (FeatureCollection.proto)
+POINT, MULTIPOINT, POLYLINE, POLYGON = 0, 1, 2, 3  #: GeometryType; esriGeometryTypeNone (127) is for tables
+LOWER_LEFT = 1  #: QuantizeOriginPostion; upperLeft (0) is the default
+
+#: The pandas dtype of each Esri field type, matching what the json path's spatially enabled dataframe uses. Field
+#: types that aren't listed are left as objects.
+FIELD_DTYPES = {
+    0: "Int32",  #: esriFieldTypeSmallInteger
+    1: "Int32",  #: esriFieldTypeInteger
+    2: "Float64",  #: esriFieldTypeSingle, sent as a float but widened like the json path does
+    3: "Float64",  #: esriFieldTypeDouble
+    4: "string",  #: esriFieldTypeString
+    5: "datetime64[us]",  #: esriFieldTypeDate, sent as milliseconds since the epoch
+    6: "Int64",  #: esriFieldTypeOID
+    10: "string",  #: esriFieldTypeGUID
+    11: "string",  #: esriFieldTypeGlobalID
+    13: "Int64",  #: esriFieldTypeBigInteger
+}
+DATE_FIELD = 5
+
+
+def make_session(pool_size):
+    """Build the HTTP session shared by every request to FEMA in a run.
+
+    Connections are kept alive and reused from a pool of up to pool_size per host instead of each request opening (and
+    TLS-handshaking) its own, and responses are gzip- or deflate-compressed when the server supports it. The adapter
+    doesn't retry on its own; retries are left to the RequestController and palletjack.
+
+    Args:
+        pool_size (int): Most connections kept open to FEMA's server, such as the most requests in flight at once
+
+    Returns:
+        requests.Session: The session
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+
+def _varint(buffer, position):
+    result = shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _fields(buffer, start=0, end=None):
+    #: Yield each (field number, wire type, value) in a message. Length-delimited values are yielded as their (start,
+    #: end) positions in buffer so that nested messages and packed arrays aren't copied.
+    position = start
+    end = len(buffer) if end is None else end
+    while position < end:
+        key, position = _varint(buffer, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == VARINT:
+            value, position = _varint(buffer, position)
+        elif wire_type == FIXED64:
+            value, position = buffer[position : position + 8], position + 8
+        elif wire_type == LENGTH_DELIMITED:
+            length, position = _varint(buffer, position)
+            value, position = (position, position + length), position + length
+        elif wire_type == FIXED32:
+            value, position = buffer[position : position + 4], position + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield number, wire_type, value
+    if position != end:
+        raise ValueError("Truncated protobuf message")
+
+
+def _value(buffer, start, end):
+    #: Decode a Value message (a oneof of every attribute type); an empty one is a null
+    for number, _, value in _fields(buffer, start, end):
+        if number == 1:
+            return bytes(buffer[value[0] : value[1]]).decode("utf-8")
+        if number == 2:
+            return struct.unpack("<f", value)[0]
+        if number == 3:
+            return struct.unpack("<d", value)[0]
+        if number in (4, 8):  #: sint32, sint64
+            return _zigzag(value)
+        if number == 6:  #: int64
+            return value - (1 << 64) if value >= 1 << 63 else value
+        if number == 9:
+            return bool(value)
+        return value  #: uint32, uint64
+    return None
+
+
+def _decode_varints(data):
+    #: Decode every varint in data at once: each ends with the first byte under 0x80, and its value is the low seven
+    #: bits of each of its bytes shifted into place
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    values = (data & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(values, starts)
+
+
+def _decode_zigzags(data):
+    values = _decode_varints(data)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+class _FeatureResult:
+    #: A FeatureResult's header and its features' attributes and raw geometry bytes, gathered column by column
+
+    def __init__(self, buffer):
+        self.oid_field = None
+        #: proto3 leaves out fields with their default value, so a missing geometryType or fieldType is the first in
+        #: its enum (point and small integer)
+        self.geometry_type = POINT
+        self.wkid = None
+        self.has_z = self.has_m = False
+        self.transform = None
+        self.fields = []
+        self.columns = []
+        self.lengths = []  #: each feature's part lengths, [] for a null geometry
+        self.coords = []  #: each feature's packed, delta-encoded coordinates
+        self._buffer = buffer
+
+    def read(self, start, end):
+        buffer = self._buffer
+        for number, _, value in _fields(buffer, start, end):
+            if number == 1:
+                self.oid_field = bytes(buffer[value[0] : value[1]]).decode("utf-8")
+            elif number == 7:
+                self.geometry_type = value
+            elif number == 8:
+                spatial_reference = {key: item for key, _, item in _fields(buffer, *value)}
+                self.wkid = spatial_reference.get(2) or spatial_reference.get(1)
+            elif number == 10:
+                self.has_z = bool(value)
+            elif number == 11:
+                self.has_m = bool(value)
+            elif number == 12:
+                self.transform = self._transform(*value)
+            elif number == 13:
+                field = {key: item for key, _, item in _fields(buffer, *value)}
+                self.fields.append((bytes(buffer[field[1][0] : field[1][1]]).decode("utf-8"), field.get(2, 0)))
+                self.columns.append([])
+            elif number == 15:
+                self._feature(*value)
+        return self
+
+    def _transform(self, start, end):
+        buffer = self._buffer
+        origin, scale, translate = 0, (1.0, 1.0), (0.0, 0.0)
+        for number, _, value in _fields(buffer, start, end):
+            if number == 1:
+                origin = value
+            elif number in (2, 3):
+                pair = {key: struct.unpack("<d", item)[0] for key, _, item in _fields(buffer, *value) if key in (1, 2)}
+                pair = (pair.get(1, 0.0), pair.get(2, 0.0))
+                scale, translate = (pair, translate) if number == 2 else (scale, pair)
+        return origin, scale, translate
+
+    def _feature(self, start, end):
+        buffer = self._buffer
+        attribute = 0
+        lengths, coords = [], b""
+        for number, _, value in _fields(buffer, start, end):
+            if number == 1:
+                self.columns[attribute].append(_value(buffer, *value))
+                attribute += 1
+            elif number == 2:
+                for key, wire_type, item in _fields(buffer, *value):
+                    if key == 2 and wire_type == LENGTH_DELIMITED:
+                        position, stop = item
+                        while position < stop:
+                            length, position = _varint(buffer, position)
+                            lengths.append(length)
+                    elif key == 2:
+                        lengths.append(item)
+                    elif key == 3:
+                        coords = buffer[item[0] : item[1]]
+            elif number == 3:
+                raise ValueError("esriShapeBuffer geometries aren't supported")
+        if attribute != len(self.fields):
+            raise ValueError(f"Feature has {attribute} attributes but the result has {len(self.fields)} fields")
+        self.lengths.append(lengths)
+        self.coords.append(coords)
+
+    def xy(self):
+        #: Undo the delta encoding and quantization of every feature's coordinates at once
+        data = b"".join(self.coords)
+        stride = 2 + self.has_z + self.has_m
+        values = _decode_zigzags(data).reshape(-1, stride)[:, :2]
+
+        #: Each feature's number of points, from how many varints end in its bytes
+        varint_ends = np.concatenate([[0], np.cumsum(np.frombuffer(data, dtype=np.uint8) < 0x80)])
+        counts = np.diff(varint_ends[np.cumsum([0] + [len(coords) for coords in self.coords])]) // stride
+        totals = np.cumsum(values, axis=0)
+        before = np.vstack([np.zeros((1, 2), dtype=np.int64), totals])[np.cumsum(counts) - counts]
+        quantized = totals - np.repeat(before, counts, axis=0)
+
+        origin, (x_scale, y_scale), (x_translate, y_translate) = self.transform or (LOWER_LEFT, (1, 1), (0, 0))
+        x = x_translate + quantized[:, 0] * x_scale
+        y = y_translate + quantized[:, 1] * y_scale if origin == LOWER_LEFT else y_translate - quantized[:, 1] * y_scale
+        return np.column_stack([x, y]), counts
+
+
+def _clockwise(xy, ring_offsets):
+    #: Shoelace signed area of each ring, relative to the ring's first point so the products stay small; Esri's outer
+    #: rings are clockwise (negative area) and its holes counterclockwise
+    starts, ends = ring_offsets[:-1], ring_offsets[1:]
+    relative = xy - np.repeat(xy[starts], ends - starts, axis=0)
+    cross = relative[:-1, 0] * relative[1:, 1] - relative[1:, 0] * relative[:-1, 1]
+    cumulative = np.concatenate([[0.0], np.cumsum(cross)])
+    return cumulative[np.maximum(ends - 1, starts)] - cumulative[starts] < 0
+
+
+def _geometries(result):
+    import shapely
+
+    feature_count = len(result.coords)
+    if result.geometry_type not in (POINT, MULTIPOINT, POLYLINE, POLYGON) or not feature_count:
+        return np.full(feature_count, None, dtype=object)
+
+    xy, counts = result.xy()
+    if result.geometry_type == POINT:
+        geometries = np.full(feature_count, None, dtype=object)
+        has_point = counts > 0
+        geometries[has_point] = shapely.points(xy)
+        return geometries
+    if result.geometry_type == MULTIPOINT:
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        geometries = shapely.from_ragged_array(shapely.GeometryType.MULTIPOINT, xy, offsets=(offsets,))
+        geometries[counts == 0] = None
+        return geometries
+
+    part_lengths = np.array([length for lengths in result.lengths for length in lengths], dtype=np.int64)
+    part_counts = np.array([len(lengths) for lengths in result.lengths], dtype=np.int64)
+    part_offsets = np.concatenate([[0], np.cumsum(part_lengths)])
+    feature_part_offsets = np.concatenate([[0], np.cumsum(part_counts)])
+
+    if result.geometry_type == POLYLINE:
+        #: The json path always makes polylines MultiLineStrings, so these do too
+        geometries = shapely.from_ragged_array(
+            shapely.GeometryType.MULTILINESTRING, xy, offsets=(part_offsets, feature_part_offsets)
+        )
+        geometries[part_counts == 0] = None
+        return geometries
+
+    #: Each outer ring starts a new polygon and the holes after it belong to it. A feature's first ring is always
+    #: treated as outer, even if it's wound the wrong way.
+    outer = _clockwise(xy, part_offsets)
+    outer[feature_part_offsets[:-1][part_counts > 0]] = True
+    polygon_offsets = np.concatenate([np.flatnonzero(outer), [len(part_lengths)]])
+    outer_offsets = np.concatenate([[0], np.cumsum(outer)])
+    polygon_counts = np.diff(outer_offsets[feature_part_offsets])
+    geometries = shapely.from_ragged_array(
+        shapely.GeometryType.MULTIPOLYGON,
+        xy,
+        offsets=(part_offsets, polygon_offsets, np.concatenate([[0], np.cumsum(polygon_counts)])),
+    )
+    #: Like the json path, a polygon with a single outer ring isn't a MultiPolygon
+    single = polygon_counts == 1
+    geometries[single] = shapely.get_geometry(geometries[single], 0)
+    geometries[polygon_counts == 0] = None
+    return geometries
+
+
+def decode_features(content):
+    """Decode a FeatureCollectionPBuffer query response into a GeoDataFrame like the json path's.
+
+    Attributes are gathered into a list per field and converted to the same pandas dtypes as the json path's spatially
+    enabled dataframe. The coordinates of every feature are decoded together in numpy and the geometries are built
+    from the resulting arrays with shapely.from_ragged_array rather than one feature at a time.
+
+    Args:
+        content (bytes): The response's body
+
+    Raises:
+        ValueError: If content isn't a FeatureCollectionPBuffer with a feature result
+
+    Returns:
+        gpd.GeoDataFrame: The features with their geometry in the SHAPE column
+    """
+
+    import geopandas as gpd
+
+    buffer = memoryview(content)
+    feature_result = None
+    for number, wire_type, value in _fields(buffer):
+        if number == 2 and wire_type == LENGTH_DELIMITED:
+            for result_number, _, result_value in _fields(buffer, *value):
+                if result_number == 1:
+                    feature_result = _FeatureResult(buffer).read(*result_value)
+    if feature_result is None:
+        raise ValueError("Response doesn't have a feature result")
+
+    columns = {}
+    for (name, field_type), values in zip(feature_result.fields, feature_result.columns):
+        dtype = FIELD_DTYPES.get(field_type, object)
+        if field_type == DATE_FIELD:
+            values = pd.to_datetime(pd.Series(values, dtype="Float64"), unit="ms")
+        columns[name] = pd.Series(values, dtype=dtype) if dtype is not object else pd.Series(values, dtype=object)
+
+    features_df = gpd.GeoDataFrame(
+        columns, geometry=gpd.GeoSeries(_geometries(feature_result), crs=feature_result.wkid), crs=feature_result.wkid
+    )
+    features_df = features_df.rename_geometry("SHAPE")
+    if feature_result.oid_field in features_df.columns:
+        features_df = features_df.sort_values(by=feature_result.oid_field, ignore_index=True)
+    #: The coordinates are only as precise as their quantization, which _difference allows for
+    _, scale, _ = feature_result.transform or (LOWER_LEFT, (0.0, 0.0), (0.0, 0.0))
+    features_df.attrs["xy_resolution"] = max(scale)
+    return features_df
+
+
+def _same_value(pbf_value, json_value):
+    if pd.isna(pbf_value) or pd.isna(json_value):
+        return pd.isna(pbf_value) and pd.isna(json_value)
+    if isinstance(pbf_value, float) or isinstance(json_value, float):
+        #: esriFieldTypeSingle values are sent as 32-bit floats in pbf
+        return math.isclose(pbf_value, json_value, rel_tol=1e-6)
+    return pbf_value == json_value
+
+
+def _difference(pbf_df, json_df):
+    #: Describe the first difference between a page decoded from pbf and the same page as json (both sorted by
+    #: OBJECTID, with shapely geometries in SHAPE), or return None if they match
+    import shapely
+
+    if set(pbf_df.columns) != set(json_df.columns):
+        return f"fields {sorted(set(pbf_df.columns) ^ set(json_df.columns))} are only in one of them"
+    if len(pbf_df) != len(json_df):
+        return f"{len(pbf_df)} features from pbf but {len(json_df)} from json"
+
+    for column in pbf_df.columns.drop("SHAPE"):
+        pairs = zip(pbf_df[column].astype(object), json_df[column].astype(object))
+        for row, (pbf_value, json_value) in enumerate(pairs):
+            if not _same_value(pbf_value, json_value):
+                return f"{column} is {pbf_value!r} from pbf but {json_value!r} from json in row {row}"
+
+    pbf_shapes, json_shapes = pbf_df["SHAPE"].to_numpy(), json_df["SHAPE"].to_numpy()
+    missing = shapely.is_missing(pbf_shapes)
+    if (missing != shapely.is_missing(json_shapes)).any():
+        return (
+            f"row {np.flatnonzero(missing != shapely.is_missing(json_shapes))[0]} is missing a geometry in one of them"
+        )
+    distances = np.zeros(len(pbf_shapes))
+    distances[~missing] = shapely.hausdorff_distance(pbf_shapes[~missing], json_shapes[~missing])
+    #: Rounding each coordinate to the quantization grid moves it by up to half a step on each axis
+    tolerance = pbf_df.attrs.get("xy_resolution", 0.0) + 1e-9
+    if (distances > tolerance).any():
+        row = np.flatnonzero(distances > tolerance)[0]
+        return f"the geometry in row {row} is {distances[row]:g} from json's"
+    return None
+
+
+class ServiceLayer:
+    """A FEMA MapServer layer queried through the run's shared session, optionally in Esri's protobuf format.
+
+    This stands in for palletjack's extract.ServiceLayer (with the same attributes and the methods paging uses), which
+    makes every request with a new connection and only downloads json. With query_format "pbf", pages are requested as
+    f=pbf if the layer lists PBF in its supportedQueryFormats, and are decoded with decode_features. The layer's first
+    pbf page is also requested as json and the two are compared, so that decode_features is checked against the
+    server's actual responses before the rest of the layer relies on it. If a pbf page can't be decoded or doesn't
+    match its json, the page's json is used and the rest of the layer's pages are requested as json too.
+    """
+
+    def __init__(self, module_logger, layer_url, session, timeout=5, where_clause="1=1", query_format="json"):
+        """
+        Args:
+            module_logger (logging.Logger): The skid's logger
+            layer_url (str): The layer's REST endpoint
+            session (requests.Session): The run's session, from make_session
+            timeout (int, optional): Timeout for HTTP requests in seconds. Defaults to 5.
+            where_clause (str, optional): Where clause limiting the layer's features. Defaults to "1=1".
+            query_format (str, optional): "json" or "pbf". Defaults to "json".
+
+        Raises:
+            ValueError: If query_format isn't json or pbf
+        """
+
+        from palletjack import utils
+
+        if query_format not in ["json", "pbf"]:
+            raise ValueError(f"Unknown query format {query_format}, use json or pbf")
+        self._logger = module_logger
+        self.layer_url = layer_url.rstrip("/")
+        self.session = session
+        self.timeout = timeout
+        self.where_clause = where_clause
+        self.envelope_params = None
+        self.feature_params = {"outFields": "*", "returnGeometry": "true"}
+
+        response = utils.retry(self.session.get, self.layer_url, params={"f": "json"}, timeout=self.timeout)
+        self.layer_properties_json = response.json()
+        if "capabilities" not in self.layer_properties_json or "maxRecordCount" not in self.layer_properties_json:
+            raise RuntimeError(f"Response from {self.layer_url} does not contain layer information")
+        if self.layer_properties_json.get("type") not in ["Feature Layer", "Table"]:
+            raise RuntimeError(f"Layer {self.layer_url} is not a feature layer or table")
+        self.max_record_count = self.layer_properties_json["maxRecordCount"]
+        self.oid_field = self.layer_properties_json.get("objectIdField", "OBJECTID")
+
+        supported_formats = self.layer_properties_json.get("supportedQueryFormats", "").replace(" ", "").lower()
+        self.query_format = query_format if query_format in supported_formats.split(",") else "json"
+        self.pbf_checked = False  #: whether a pbf page has matched the same page as json
+        if self.query_format != query_format:
+            module_logger.debug("%s doesn't support %s queries, using json", self.layer_url, query_format)
+
+    def check_capabilities(self, capability):
+        """Raise an error if the layer doesn't support capability.
+
+        Args:
+            capability (str): The capability, such as "query"
+
+        Raises:
+            RuntimeError: If the layer doesn't list the capability
+        """
+
+        capabilities = self.layer_properties_json["capabilities"].casefold().replace(" ", "").split(",")
+        if capability.casefold() not in capabilities:
+            raise RuntimeError(f"{capability.casefold()} capability not in layer's capabilities ({capabilities})")
+
+    def get_object_ids(self):
+        """Get the layer's sorted OBJECTIDs that match the where clause and envelope, if there is one.
+
+        Raises:
+            RuntimeError: If the response doesn't have the OBJECTIDs
+
+        Returns:
+            list[int]: The OBJECTIDs
+        """
+
+        params = {"returnIdsOnly": "true", "f": "json", "where": self.where_clause, **(self.envelope_params or {})}
+        response = self.session.get(f"{self.layer_url}/query", params=params, timeout=self.timeout)
+        response.raise_for_status()
+        try:
+            return sorted(response.json()["objectIds"] or [])
+        except (KeyError, ValueError) as error:
+            raise RuntimeError(f"Could not get object IDs from {self.layer_url}") from error
+
+    def get_unique_id_list_as_dataframe(self, unique_id_field, unique_id_list):
+        """Download the features with the given ids in one request.
+
+        Args:
+            unique_id_field (str): The field the ids are in, usually the OBJECTID field
+            unique_id_list (list): The ids to download
+
+        Raises:
+            RuntimeError: If the request fails, the response can't be parsed, or features are missing from it
+
+        Returns:
+            pd.DataFrame: The features, sorted by unique_id_field, as a GeoDataFrame (pbf) or a spatially enabled
+                dataframe (json)
+        """
+
+        if self.query_format == "pbf":
+            try:
+                features_df = decode_features(self._query(unique_id_field, unique_id_list, "pbf").content)
+            except (ValueError, IndexError, KeyError, struct.error) as error:
+                self._logger.warning(
+                    "Could not decode pbf features from %s, using json instead: %s", self.layer_url, error
+                )
+                self.query_format = "json"
+            else:
+                if self.pbf_checked:
+                    return self._check_count(features_df, unique_id_list)
+                return self._check_count(self._check_pbf(features_df, unique_id_field, unique_id_list), unique_id_list)
+
+        return self._check_count(self._json_features(unique_id_field, unique_id_list), unique_id_list)
+
+    def _json_features(self, unique_id_field, unique_id_list):
+        from arcgis.features import FeatureSet
+
+        response = self._query(unique_id_field, unique_id_list, "json")
+        try:
+            return FeatureSet.from_json(response.text).sdf.sort_values(by=unique_id_field)
+        except ValueError as error:
+            raise RuntimeError("Could not parse chunk features from response") from error
+
+    def _check_pbf(self, features_df, unique_id_field, unique_id_list):
+        from palletjack import utils
+
+        json_df = self._json_features(unique_id_field, unique_id_list)
+        difference = _difference(features_df, utils.convert_to_gdf(json_df))
+        if difference is None:
+            self.pbf_checked = True
+            return features_df
+        self._logger.warning(
+            "pbf features from %s don't match json, using json instead: %s", self.layer_url, difference
+        )
+        self.query_format = "json"
+        return json_df
+
+    def _query(self, unique_id_field, unique_id_list, query_format):
+        data = {
+            "f": query_format,
+            **self.feature_params,
+            "where": f"{unique_id_field} in ({','.join(str(oid) for oid in unique_id_list)})",
+        }
+        response = self.session.post(f"{self.layer_url}/query", data=data, timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"Bad chunk response HTTP status code ({response.status_code})")
+        return response
+
+    @staticmethod
+    def _check_count(features_df, unique_id_list):
+        if len(features_df) != len(unique_id_list):
+            raise RuntimeError(
+                f"Missing features. {len(unique_id_list)} OIDs requested, but {len(features_df)} features downloaded"
+            )
+        return features_df
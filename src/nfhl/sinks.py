@@ -0,0 +1,212 @@
+"""
+sinks.py: File outputs (a GeoParquet archive and vector tile packages) written alongside the hosted AGOL layers
+"""
+
+import json
+import shutil
+from pathlib import Path
+
+#: File extension and MapLibre source url scheme for each supported vector tile format
+TILE_FORMATS = {
+    "pmtiles": {"extension": ".pmtiles", "scheme": "pmtiles://"},
+    "mbtiles": {"extension": ".mbtiles", "scheme": "mbtiles://"},
+}
+
+
+def _is_url(path):
+    return "://" in str(path)
+
+
+def publish(local_path, output_dir):
+    """Copy a finished file into output_dir, which can be a local directory or an fsspec url such as gs://bucket/nfhl.
+
+    Local copies go through a temporary file that is renamed into place so that readers never see a partial file.
+    Urls need fsspec and the filesystem's implementation (eg, gcsfs for gs://) to be installed.
+
+    Args:
+        local_path (Path): The file to publish
+        output_dir (str or Path): The destination directory or url
+
+    Returns:
+        str: The published file's path or url
+    """
+
+    if _is_url(output_dir):
+        import fsspec
+
+        filesystem, root = fsspec.core.url_to_fs(str(output_dir))
+        filesystem.put_file(str(local_path), f"{root.rstrip('/')}/{local_path.name}")
+        return f"{str(output_dir).rstrip('/')}/{local_path.name}"
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    temp_path = output_dir / f"{local_path.name}.tmp"
+    shutil.copyfile(local_path, temp_path)
+    temp_path.replace(output_dir / local_path.name)
+    return str(output_dir / local_path.name)
+
+
+def write_geoparquet(layer_name, layer_df, scratch_dir, output_dir):
+    """Archive a transformed layer as GeoParquet.
+
+    The file is zstd-compressed and has a bbox covering column so that readers can filter it spatially without
+    decoding every geometry. Categoricals are kept as dictionary-encoded columns.
+
+    Args:
+        layer_name (str): The layer's name, used for the file name
+        layer_df (gpd.GeoDataFrame): The transformed layer
+        scratch_dir (Path): Local directory to write the file in before publishing it
+        output_dir (str or Path): Directory or fsspec url to publish {layer_name}.parquet to
+
+    Returns:
+        str: The published file's path or url
+    """
+
+    scratch_dir = Path(scratch_dir)
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    parquet_path = scratch_dir / f"{layer_name}.parquet"
+    layer_df.to_parquet(parquet_path, compression="zstd", write_covering_bbox=True)
+
+    published = publish(parquet_path, output_dir)
+    parquet_path.unlink()
+    return published
+
+
+def write_vector_tiles(
+    layer_name, layer_df, scratch_dir, output_dir, tile_format="pmtiles", fields=None, min_zoom=0, max_zoom=14
+):
+    """Build a vector tile package of a transformed layer with GDAL's PMTiles or MBTiles driver.
+
+    The features are reprojected to web mercator and cut into tiles between min_zoom and max_zoom, keeping only the
+    fields needed to draw and identify them so the tiles stay small.
+
+    Args:
+        layer_name (str): The layer's name, used for the file name and the tiles' layer name
+        layer_df (gpd.GeoDataFrame): The transformed layer
+        scratch_dir (Path): Local directory to build the package in before publishing it
+        output_dir (str or Path): Directory or fsspec url to publish the package to
+        tile_format (str, optional): "pmtiles" or "mbtiles". Defaults to "pmtiles".
+        fields (list[str], optional): Fields to include in the tiles. Defaults to None (all fields).
+        min_zoom (int, optional): Lowest zoom level to build. Defaults to 0.
+        max_zoom (int, optional): Highest zoom level to build. Defaults to 14.
+
+    Raises:
+        ValueError: If tile_format isn't one of TILE_FORMATS
+
+    Returns:
+        str: The published package's path or url
+    """
+
+    import pyogrio
+
+    try:
+        extension = TILE_FORMATS[tile_format]["extension"]
+    except KeyError:
+        raise ValueError(f"Unknown vector tile format {tile_format}, expected one of {list(TILE_FORMATS)}") from None
+
+    if fields is not None:
+        layer_df = layer_df[[field for field in fields if field in layer_df.columns] + [layer_df.geometry.name]]
+
+    scratch_dir = Path(scratch_dir)
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    tiles_path = scratch_dir / f"{layer_name}{extension}"
+    tiles_path.unlink(missing_ok=True)  #: the tile drivers can't overwrite an existing package
+    pyogrio.write_dataframe(
+        layer_df,
+        tiles_path,
+        layer=layer_name,
+        dataset_options={"NAME": layer_name, "MINZOOM": min_zoom, "MAXZOOM": max_zoom},
+    )
+
+    published = publish(tiles_path, output_dir)
+    tiles_path.unlink()
+    return published
+
+
+def _cim_color(color):
+    #: CIM colors are [r, g, b, alpha 0-100]
+    red, green, blue, alpha = color
+    return f"rgba({red}, {green}, {blue}, {min(alpha, 100) / 100:g})"
+
+
+def _symbol_colors(symbol):
+    #: Use the symbol's solid fill, or for hatched symbols the color of the hatch lines, and its outline's color
+    fill = outline = None
+    for symbol_layer in symbol["symbol"]["symbolLayers"]:
+        if not symbol_layer.get("enable", True):
+            continue
+        if symbol_layer["type"] == "CIMSolidFill" and fill is None:
+            fill = symbol_layer["color"]
+        elif symbol_layer["type"] == "CIMHatchFill" and fill is None:
+            fill = symbol_layer["lineSymbol"]["symbolLayers"][0]["color"]
+        elif symbol_layer["type"] == "CIMSolidStroke" and outline is None:
+            outline = symbol_layer["color"]
+    return _cim_color(fill or [0, 0, 0, 0]), _cim_color(outline or [0, 0, 0, 0])
+
+
+def maplibre_style(drawing_info, layer_name, tiles_url):
+    """Translate a unique value renderer's drawingInfo (as used for the hosted layer) into a MapLibre style.
+
+    Each unique value becomes a branch of a match expression on the renderer's field, so the tiles are drawn with the
+    same colors as the feature service. Hatch fills are drawn as solid fills in the hatch lines' color. The "<Null>"
+    value matches empty strings, which is how the transform stores missing labels.
+
+    Args:
+        drawing_info (dict): The layer's drawingInfo, such as fld_haz_ar_drawingInfo.json
+        layer_name (str): The tiles' layer name
+        tiles_url (str): The source url for the tiles, such as pmtiles://https://example.com/S_Fld_Haz_Ar.pmtiles
+
+    Returns:
+        dict: A MapLibre style with one vector source and a fill layer
+    """
+
+    renderer = drawing_info["renderer"]
+    field = renderer["field1"]
+    default_fill, default_outline = _symbol_colors(renderer["defaultSymbol"])
+    fill_match = ["match", ["get", field]]
+    outline_match = ["match", ["get", field]]
+    for value_info in renderer["uniqueValueInfos"]:
+        fill, outline = _symbol_colors(value_info["symbol"])
+        value = "" if value_info["value"] == "<Null>" else value_info["value"]
+        fill_match.extend([value, fill])
+        outline_match.extend([value, outline])
+    fill_match.append(default_fill)
+    outline_match.append(default_outline)
+
+    return {
+        "version": 8,
+        "name": layer_name,
+        "sources": {layer_name: {"type": "vector", "url": tiles_url}},
+        "layers": [
+            {
+                "id": layer_name,
+                "type": "fill",
+                "source": layer_name,
+                "source-layer": layer_name,
+                "paint": {"fill-color": fill_match, "fill-outline-color": outline_match},
+            }
+        ],
+    }
+
+
+def write_style(layer_name, style, scratch_dir, output_dir):
+    """Publish a MapLibre style next to its tiles as {layer_name}.style.json.
+
+    Args:
+        layer_name (str): The layer's name, used for the file name
+        style (dict): The style from maplibre_style
+        scratch_dir (Path): Local directory to write the file in before publishing it
+        output_dir (str or Path): Directory or fsspec url to publish the style to
+
+    Returns:
+        str: The published style's path or url
+    """
+
+    scratch_dir = Path(scratch_dir)
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    style_path = scratch_dir / f"{layer_name}.style.json"
+    style_path.write_text(json.dumps(style, indent=2), encoding="utf-8")
+
+    published = publish(style_path, output_dir)
+    style_path.unlink()
+    return published
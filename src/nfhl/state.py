@@ -0,0 +1,104 @@
+"""
+state.py: Cheap upstream change probes and the persisted manifest of what was loaded in the last successful run
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+import requests
+
+
+def config_digest(layer, skid_version=None):
+    """Digest a layer's settings and the skid's version so that changing how the layer is processed forces a reload.
+
+    Args:
+        layer (dict): The layer's entry in config.FEMA_LAYERS
+        skid_version (str, optional): The skid's version. Defaults to None.
+
+    Returns:
+        str: A short digest of the layer's entry and the version
+    """
+
+    settings = {"layer": layer, "version": skid_version}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def probe_layer(service_url, layer, timeout, skid_version=None):
+    """Fingerprint a MapServer layer with a single statistics query instead of downloading its features.
+
+    The fingerprint holds the number of features, the max OBJECTID, and the max of the layer's change_date_field (if
+    it has one) for the features matching the layer's where clause. The where clause and a digest of the layer's
+    config.py entry and the skid's version are included as well, so that changing the layer's settings (or upgrading
+    the skid) forces a reload even if FEMA hasn't changed the layer.
+
+    Args:
+        service_url (str): The MapServer's REST endpoint
+        layer (dict): The layer's entry in config.FEMA_LAYERS
+        timeout (int): Timeout for the HTTP request in seconds
+        skid_version (str, optional): The skid's version. Defaults to None.
+
+    Raises:
+        RuntimeError: If the service responds with an error or without the statistics
+
+    Returns:
+        dict: The layer's fingerprint
+    """
+
+    statistics = [
+        {"statisticType": "count", "onStatisticField": "OBJECTID", "outStatisticFieldName": "feature_count"},
+        {"statisticType": "max", "onStatisticField": "OBJECTID", "outStatisticFieldName": "max_oid"},
+    ]
+    if "change_date_field" in layer:
+        statistics.append(
+            {
+                "statisticType": "max",
+                "onStatisticField": layer["change_date_field"],
+                "outStatisticFieldName": "max_date",
+            }
+        )
+
+    params = {"where": layer["where_clause"], "outStatistics": json.dumps(statistics), "f": "json"}
+    response = requests.get(f"{service_url}/{layer['number']}/query", params=params, timeout=timeout)
+    response.raise_for_status()
+
+    try:
+        attributes = response.json()["features"][0]["attributes"]
+    except (KeyError, IndexError, ValueError) as error:
+        raise RuntimeError(f"Could not get statistics for {layer['name']} from {service_url}") from error
+
+    fingerprint = {"where_clause": layer["where_clause"], "config": config_digest(layer, skid_version)}
+    fingerprint.update({key.lower(): value for key, value in attributes.items()})
+
+    return fingerprint
+
+
+def load_manifest(manifest_path):
+    """Load the fingerprints of the layers loaded in previous runs.
+
+    Args:
+        manifest_path (str or Path): Path to the manifest json file
+
+    Returns:
+        dict: Fingerprint for each layer name, or an empty dictionary if the manifest doesn't exist or can't be read
+    """
+
+    try:
+        return json.loads(Path(manifest_path).read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    """Write the manifest via a temporary file so that a run killed partway through can't leave a truncated manifest.
+
+    Args:
+        manifest_path (str or Path): Path to the manifest json file
+        manifest (dict): Fingerprint for each layer name
+    """
+
+    manifest_path = Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = manifest_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    temp_path.replace(manifest_path)
@@ -0,0 +1,160 @@
+"""
+sync.py: Incremental (delta) loading of a layer by comparing feature hashes with the live hosted data
+"""
+
+import pandas as pd
+import shapely
+
+#: Fields that are generated by the source or AGOL and shouldn't be used to decide if a feature changed
+GENERATED_FIELDS = ["OBJECTID", "SHAPE", "Shape__Area", "Shape__Length", "shape__area", "shape__length"]
+
+
+def hash_features(dataframe, key_field, fields, grid_size):
+    """Hash each feature's attributes and geometry into a single value indexed by the key field.
+
+    Values are normalized before hashing so that the same feature hashes the same whether it came from FEMA or from
+    the hosted layer: nulls and empty strings are equal, numbers are compared as rounded floats, datetimes are
+    compared as timezone-naive epoch values, and geometries are snapped to grid_size and normalized.
+
+    Args:
+        dataframe (pd.DataFrame): Spatially-enabled or geo-dataframe with a SHAPE column
+        key_field (str): Column holding each feature's unique key
+        fields (list[str]): Attribute columns to include in the hash
+        grid_size (float): Grid size (in the data's coordinate units) to snap coordinates to before hashing
+
+    Returns:
+        pd.Series: uint64 hash of each feature, indexed by key_field
+    """
+
+    from palletjack import utils
+
+    normalized = pd.DataFrame(index=dataframe.index)
+    for field in fields:
+        column = dataframe[field]
+        if pd.api.types.is_datetime64_any_dtype(column):
+            if getattr(column.dt, "tz", None) is not None:
+                column = column.dt.tz_convert(None)
+            normalized[field] = column.astype("datetime64[ns]").astype("int64")
+        elif pd.api.types.is_numeric_dtype(column):
+            normalized[field] = pd.to_numeric(column).astype("float64").round(6)
+        else:
+            normalized[field] = column.fillna("").astype(str)
+
+    geometries = utils.convert_to_gdf(dataframe[["SHAPE"]]).geometry.values
+    geometries = shapely.normalize(shapely.set_precision(geometries, grid_size))
+    normalized["SHAPE"] = shapely.to_wkb(geometries)
+
+    hashes = pd.util.hash_pandas_object(normalized, index=False)
+    hashes.index = dataframe[key_field].values
+
+    return hashes
+
+
+def diff_features(new_dataframe, live_dataframe, key_field, grid_size):
+    """Compare new and live features by key and hash to find the features that must be added, updated, and deleted.
+
+    Args:
+        new_dataframe (pd.DataFrame): The freshly extracted and transformed features
+        live_dataframe (pd.DataFrame): The hosted layer's current features, including OBJECTID
+        key_field (str): Column holding each feature's unique key in both dataframes
+        grid_size (float): Grid size used to snap coordinates before hashing
+
+    Returns:
+        tuple(pd.DataFrame, pd.DataFrame, list[int]): New features to add, changed features to update, and OBJECTIDs of
+            live features to delete
+    """
+
+    fields = [
+        column
+        for column in new_dataframe.columns
+        if column in live_dataframe.columns and column != key_field and column not in GENERATED_FIELDS
+    ]
+    new_hashes = hash_features(new_dataframe, key_field, fields, grid_size)
+    live_hashes = hash_features(live_dataframe, key_field, fields, grid_size)
+
+    new_keys = new_dataframe[key_field]
+    live_keys = live_dataframe[key_field]
+
+    adds = new_dataframe[~new_keys.isin(live_keys)]
+
+    common_keys = new_hashes.index.intersection(live_hashes.index)
+    changed_keys = common_keys[new_hashes[common_keys].values != live_hashes[common_keys].values]
+    updates = new_dataframe[new_keys.isin(changed_keys)]
+
+    deletes = live_dataframe.loc[~live_keys.isin(new_keys), "OBJECTID"].astype(int).tolist()
+
+    return adds, updates, deletes
+
+
+def _get_live_features(service_updater, fields, out_sr):
+    from palletjack import utils
+
+    feature_set = utils.retry(
+        service_updater.service.query, out_fields=",".join(fields), out_sr=out_sr, return_geometry=True
+    )
+    return feature_set.sdf
+
+
+def _spatial_reference(dataframe):
+    try:
+        return dataframe.crs.to_epsg()
+    except AttributeError:
+        spatial_reference = dataframe.spatial.sr
+        return spatial_reference.get("latestWkid", spatial_reference.get("wkid"))
+
+
+def delta_load(module_logger, service_updater, new_dataframe, key_field, grid_size):
+    """Update a hosted layer by sending only the features that were added, changed, or deleted since the last load.
+
+    Adds and updates are sent before deletes so that the hosted layer is never empty partway through the load. Updates
+    are matched on key_field, which must have a unique index in the hosted layer. Falls back to truncate and load if
+    the key field is missing, null, or not unique in the new data or the hosted layer, or the hosted layer is empty.
+
+    Args:
+        module_logger (logging.Logger): The skid's logger
+        service_updater (palletjack.load.ServiceUpdater): Updater for the hosted layer
+        new_dataframe (pd.DataFrame): The freshly extracted and transformed features
+        key_field (str): Column holding each feature's unique key
+        grid_size (float): Grid size used to snap coordinates before hashing
+
+    Returns:
+        int: Number of features added, updated, and deleted (or loaded, when falling back to truncate and load)
+    """
+
+    if key_field not in new_dataframe.columns:
+        module_logger.warning("Key field %s not in new data, falling back to truncate and load", key_field)
+        return service_updater.truncate_and_load(new_dataframe, save_old=False)
+
+    new_keys = new_dataframe[key_field]
+    if new_keys.isnull().any() or new_keys.duplicated().any():
+        module_logger.warning("Key field %s has nulls or duplicates, falling back to truncate and load", key_field)
+        return service_updater.truncate_and_load(new_dataframe, save_old=False)
+
+    module_logger.info("Getting live features to compare against...")
+    live_fields = [field["name"] for field in service_updater.service.properties.fields]
+    fields = ["OBJECTID", key_field] + [
+        column
+        for column in new_dataframe.columns
+        if column in live_fields and column not in GENERATED_FIELDS and column != key_field
+    ]
+    live_dataframe = _get_live_features(service_updater, fields, _spatial_reference(new_dataframe))
+    if live_dataframe.empty:
+        module_logger.info("Live layer is empty, loading all features")
+        return service_updater.truncate_and_load(new_dataframe, save_old=False)
+
+    live_keys = live_dataframe[key_field]
+    if live_keys.isnull().any() or live_keys.duplicated().any():
+        module_logger.warning(
+            "Key field %s has nulls or duplicates in the live layer, falling back to truncate and load", key_field
+        )
+        return service_updater.truncate_and_load(new_dataframe, save_old=False)
+
+    adds, updates, deletes = diff_features(new_dataframe, live_dataframe, key_field, grid_size)
+    module_logger.info("Delta: %s adds, %s updates, %s deletes", len(adds), len(updates), len(deletes))
+
+    added = service_updater.add(adds) if not adds.empty else 0
+    updated = service_updater.update(updates, matching_field=key_field) if not updates.empty else 0
+    deleted = service_updater.remove(deletes) if deletes else 0
+    module_logger.info("Delta sync sent %s added, %s updated, %s deleted", added, updated, deleted)
+
+    return added + updated + deleted
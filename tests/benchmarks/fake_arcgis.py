@@ -0,0 +1,1137 @@
+"""
+fake_arcgis.py: A local stand-in for FEMA's NFHL MapServer and the AGOL org for offline end-to-end benchmarks
+
+FakeArcGIS serves synthetic features for every layer in config.FEMA_LAYERS at the same layer numbers, plus just enough
+of the AGOL sharing and hosted feature service REST APIs for palletjack's ServiceUpdater to truncate and load them. With
+blue_green, each layer's item is a hosted view of one of two source layers that it can be switched between. Queries
+can be answered as json or, like ArcGIS Server, as Esri's FeatureCollectionPBuffer protobuf (f=pbf), gzipped if the
+client accepts it.
+Point config.SERVICE_URL at its service_url and config.AGOL_ORG at its org_url to run process() with no network.
+
+The ArcGIS API for Python only talks https, so the server uses a self-signed certificate for 127.0.0.1. Set the
+REQUESTS_CA_BUNDLE (for requests) and SSL_CERT_FILE (for the ArcGIS API for Python) environment variables to its
+cert_path so that both trust it.
+
+Run it on its own with `python tests/benchmarks/fake_arcgis.py --features 5000 --latency 0.2` and set SERVICE_URL,
+AGOL_ORG, REQUESTS_CA_BUNDLE, and SSL_CERT_FILE to the values it prints.
+"""
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import ipaddress
+import json
+import random
+import re
+import sqlite3
+import ssl
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import numpy as np
+import pyogrio
+import shapely
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from nfhl import config, geometry, main
+
+ORG_ID = "FakeOrg0123456789"
+USERNAME = "nfhl_skid"
+SERVICE_PATH = "/arcgis/rest/services/public/NFHL/MapServer"
+
+#: Esri field type of each kind of synthetic field
+ESRI_TYPES = {
+    "oid": "esriFieldTypeOID",
+    "string": "esriFieldTypeString",
+    "date": "esriFieldTypeDate",
+    "double": "esriFieldTypeDouble",
+    "int": "esriFieldTypeInteger",
+}
+#: FeatureCollectionPBuffer FieldType of each kind of synthetic field
+PBF_TYPES = {"oid": 6, "string": 4, "date": 5, "double": 3, "int": 1}
+PBF_GEOMETRY_TYPES = {"esriGeometryPoint": 0, "esriGeometryPolyline": 2, "esriGeometryPolygon": 3}
+PBF_SCALE = 1e-9  #: quantization of the pbf coordinates, in degrees
+SQL_TYPES = {"oid": "INTEGER", "string": "TEXT", "date": "INTEGER", "double": "REAL", "int": "INTEGER"}
+
+POLYGON_LAYERS = ["S_LOMR", "S_FIRM_Pan", "S_Fld_Haz_Ar"]
+POINT_LAYERS = ["S_LOMAs"]
+
+#: Countywide and community DFIRM_IDs in Utah, plus a few from neighboring states that the where clauses filter out
+DFIRM_IDS = [f"{fips}C" for fips in config.UTAH_COUNTY_FIPS] + ["490065", "490099", "490082", "08077C", "32003C"]
+HAZARD_ZONES = [(zone, subtype) for zone, subtype in main.HAZARD_AREA_LABELS if subtype is not main.ANY_SUBTYPE]
+HAZARD_ZONES += [("D", None), ("AREA NOT INCLUDED", None), ("X", "AREA OF MINIMAL FLOOD HAZARD")]
+EPOCH_2000_MS = 946_684_800_000
+DAY_MS = 86_400_000
+
+
+def _certificate(directory):
+    #: Write a short-lived self-signed certificate and key for 127.0.0.1 and localhost
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "nfhl-skid fake arcgis")])
+    now = datetime.datetime.now(datetime.UTC)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = Path(directory) / "fake_arcgis.pem"
+    key_path = Path(directory) / "fake_arcgis.key"
+    cert_path.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    )
+    return cert_path, key_path
+
+
+def _varint(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _zigzag(value):
+    return _varint(value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def _pbf_field(number, payload):
+    #: A length-delimited protobuf field (a string, nested message, or packed array)
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _pbf_value(value, kind):
+    if value is None:
+        return _pbf_field(1, b"")
+    if kind == "string":
+        value = _pbf_field(1, value.encode("utf-8"))
+    elif kind == "double":
+        value = _varint(3 << 3 | 1) + struct.pack("<d", value)
+    elif kind == "oid":
+        value = _varint(5 << 3) + _varint(value)
+    elif kind == "date":
+        value = _varint(8 << 3) + _zigzag(value)
+    else:
+        value = _varint(4 << 3) + _zigzag(value)
+    return _pbf_field(1, value)
+
+
+def _pbf_feature(attributes, geometry, schema, origin):
+    #: Encode a feature as a FeatureCollectionPBuffer Feature, with its coordinates quantized from the upper left origin
+    #: and delta-encoded across all of its parts
+    encoded = b"".join(_pbf_value(attributes[name], kind) for name, kind, _ in schema)
+    parts = geometry.get("rings") or geometry.get("paths") or [[[geometry["x"], geometry["y"]]]]
+    coords = []
+    previous = (0, 0)
+    for part in parts:
+        for x, y in part:
+            point = (round((x - origin[0]) / PBF_SCALE), round((origin[1] - y) / PBF_SCALE))
+            coords.extend([point[0] - previous[0], point[1] - previous[1]])
+            previous = point
+    lengths = b"" if "x" in geometry else _pbf_field(2, b"".join(_varint(len(part)) for part in parts))
+    encoded += _pbf_field(2, lengths + _pbf_field(3, b"".join(_zigzag(value) for value in coords)))
+    return _pbf_field(15, encoded)
+
+
+def _schema(layer):
+    #: The source fields of a synthetic layer as (name, kind, length) tuples
+    fields = [("OBJECTID", "oid", None)]
+    if layer["name"] == "S_LOMAs":
+        fields += [
+            ("CASE_NO", "string", 13),
+            ("STATUS", "string", 25),
+            ("LAT", "double", None),
+            ("LON", "double", None),
+        ]
+    else:
+        fields += [("DFIRM_ID", "string", 6), ("VERSION_ID", "string", 11), ("SOURCE_CIT", "string", 11)]
+    if layer["name"] == "S_Fld_Haz_Ar":
+        fields += [("FLD_ZONE", "string", 17), ("ZONE_SUBTY", "string", 76), ("SFHA_TF", "string", 1)]
+    if layer["name"] == "S_FIRM_Pan":
+        fields.append(("FIRM_PAN", "string", 11))
+    fields += [(name.upper(), "date", None) for name in layer.get("date_fields", [])]
+    fields += [(name.upper(), "double", None) for name in layer.get("double_fields", []) if name not in ["lat", "lon"]]
+    fields += [(name.upper(), "int", None) for name in layer.get("int_fields", [])]
+    fields.append(("GLOBALID", "string", 38))
+    return fields
+
+
+def _hosted_fields(layer):
+    #: The hosted layer's fields, named and typed like the dataframe _transform_layer hands to the load
+    fields = []
+    for name, kind, length in _schema(layer):
+        if name != "OBJECTID":
+            name = "global_id" if name == "GLOBALID" else name.lower()
+        if kind == "int":
+            kind = "int"
+        fields.append((name, kind, length))
+    if layer["name"] == "S_Fld_Haz_Ar":
+        fields.append(("label", "string", 50))
+    #: The fields added by enrichment, which have to exist in the hosted layer before it's turned on
+    for enrichment_fields in layer.get("enrich", {}).values():
+        fields.extend((new_field, "string", 50) for new_field in enrichment_fields.values())
+    return [
+        {
+            "name": name,
+            "type": ESRI_TYPES[kind],
+            "alias": name,
+            "nullable": kind != "oid",
+            "editable": kind != "oid",
+            "defaultValue": None,
+            **({"length": length} if length else {}),
+        }
+        for name, kind, length in fields
+    ]
+
+
+def _geometry_type(layer):
+    if layer["name"] in POLYGON_LAYERS:
+        return "esriGeometryPolygon"
+    if layer["name"] in POINT_LAYERS:
+        return "esriGeometryPoint"
+    return "esriGeometryPolyline"
+
+
+def _synthetic_features(layer, count, rng):
+    #: Build count features for layer as (attributes, esri json geometry, bounding box) laid out on a grid over Utah
+    xmin, ymin, xmax, ymax = config.UTAH_EXTENT
+    columns = max(int(np.ceil(np.sqrt(count))), 1)
+    cell = min((xmax - xmin), (ymax - ymin)) / columns
+    geometry_type = _geometry_type(layer)
+    schema = _schema(layer)
+
+    features = []
+    for index in range(count):
+        x = xmin + (index % columns) * cell
+        y = ymin + (index // columns) * cell
+        if geometry_type == "esriGeometryPolygon":
+            #: Densified square with tiny wiggles along its edges, so generalization has something to remove
+            steps = np.linspace(0, cell, 9)
+            wiggle = rng.uniform(-cell / 1000, cell / 1000, 9)
+            ring = (
+                [(x + step, y + wiggle[i]) for i, step in enumerate(steps)]
+                + [(x + cell + wiggle[i], y + step) for i, step in enumerate(steps[1:], 1)]
+                + [(x + cell - step, y + cell + wiggle[i]) for i, step in enumerate(steps[1:], 1)]
+                + [(x + wiggle[i], y + cell - step) for i, step in enumerate(steps[1:-1], 1)]
+            )
+            ring = [(x, y)] + ring[1:][::-1] + [(x, y)]  #: clockwise, closed
+            geometry = {"rings": [[[round(px, 8), round(py, 8)] for px, py in ring]]}
+            bounds = (x, y, x + cell, y + cell)
+        elif geometry_type == "esriGeometryPoint":
+            geometry = {"x": round(x + cell / 2, 8), "y": round(y + cell / 2, 8)}
+            bounds = (x + cell / 2, y + cell / 2, x + cell / 2, y + cell / 2)
+        else:
+            steps = np.linspace(0, cell * 0.9, 20)
+            path = [[round(x + step, 8), round(y + cell / 2 + rng.uniform(-cell / 20, cell / 20), 8)] for step in steps]
+            geometry = {"paths": [path]}
+            bounds = (x, y + cell / 2 - cell / 20, x + cell * 0.9, y + cell / 2 + cell / 20)
+
+        attributes = {}
+        for name, kind, _ in schema:
+            if kind == "oid":
+                value = index + 1
+            elif name == "DFIRM_ID":
+                value = DFIRM_IDS[rng.integers(len(DFIRM_IDS))]
+            elif name == "VERSION_ID":
+                value = "1.1.1.0"
+            elif name == "SOURCE_CIT":
+                value = f"STUDY{rng.integers(1, 6)}"
+            elif name == "FLD_ZONE":
+                zone, subtype = HAZARD_ZONES[rng.integers(len(HAZARD_ZONES))]
+                attributes.update(FLD_ZONE=zone, ZONE_SUBTY=subtype, SFHA_TF="T" if subtype is None else "F")
+                continue
+            elif name in ["ZONE_SUBTY", "SFHA_TF"]:
+                continue
+            elif name == "FIRM_PAN":
+                value = f"{attributes['DFIRM_ID'][:5]}C{index:04d}"
+            elif name == "CASE_NO":
+                value = f"{rng.integers(10, 25)}-08-{rng.integers(1000):04d}A"
+            elif name == "STATUS":
+                value = "Effective"
+            elif name == "LAT":
+                value = round(bounds[1], 6)
+            elif name == "LON":
+                value = round(bounds[0], 6)
+            elif name == "GLOBALID":
+                value = "{" + str(uuid.UUID(bytes=rng.bytes(16), version=4)).upper() + "}"
+            elif kind == "date":
+                value = None if rng.random() < 0.05 else EPOCH_2000_MS + int(rng.integers(0, 9000)) * DAY_MS
+            elif kind == "double":
+                value = None if rng.random() < 0.1 else round(float(rng.uniform(4000, 9000)), 2)
+            elif kind == "int":
+                value = None if rng.random() < 0.1 else int(rng.integers(1, 500))
+            attributes[name] = value
+        features.append((attributes, geometry, bounds))
+
+    #: A few LOMAs are across the state line, some outside LAT_LON_WHERE's box and some (in Arizona) inside it, so that
+    #: both the where clause and the clip to the state boundary have something to filter out
+    if layer["name"] == "S_LOMAs":
+        for number, (attributes, geometry, _) in enumerate(features[:: max(count // 20, 1)]):
+            if number % 2:
+                attributes["LAT"] = geometry["y"] = 36.97
+            else:
+                attributes["LON"] = geometry["x"] = -114.5
+    return features
+
+
+class FakeArcGIS:
+    """A local https server standing in for FEMA's NFHL MapServer and an AGOL org with the skid's hosted layers.
+
+    Every FEMA request can be slowed by latency seconds, and a share of the query requests can be made to fail
+    (error_rate, answered with a 503) or to hang for hang_seconds so that the client times out (timeout_rate). Which
+    requests fail is drawn from a random generator seeded with seed, so a run is repeatable.
+
+    Request counts and the injected failures are kept in stats, and the number of features in each hosted layer is
+    kept in hosted_counts. With blue_green, views maps each layer's name to the source service its view uses. The
+    connections the server accepted are counted in stats as well, so that tests can check that clients reuse them.
+    """
+
+    def __init__(
+        self,
+        features_per_layer=1000,
+        layers=None,
+        max_record_count=1000,
+        latency=0,
+        error_rate=0,
+        timeout_rate=0,
+        hang_seconds=30,
+        seed=42,
+        blue_green=False,
+        pbf=True,
+    ):
+        """
+        Args:
+            features_per_layer (int, optional): Number of synthetic features in each layer. Defaults to 1000.
+            layers (dict, optional): Layers to serve, keyed by name. Defaults to config.FEMA_LAYERS.
+            max_record_count (int, optional): Most features returned by one query. Defaults to 1000.
+            latency (float, optional): Seconds added to every FEMA request. Defaults to 0.
+            error_rate (float, optional): Share of FEMA query requests that fail with a 503. Defaults to 0.
+            timeout_rate (float, optional): Share of FEMA query requests that hang for hang_seconds. Defaults to 0.
+            hang_seconds (float, optional): How long a hanging request waits before answering. Defaults to 30.
+            seed (int, optional): Seed for the synthetic data and the injected failures. Defaults to 42.
+            blue_green (bool, optional): Make each layer's item a view of {name}_blue, with a {name}_green source to
+                switch it to (their item ids are in source_itemids). Defaults to False.
+            pbf (bool, optional): List PBF in the layers' supportedQueryFormats and answer f=pbf queries. Without it,
+                f=pbf queries get an error like an older ArcGIS Server. Defaults to True.
+        """
+
+        self.layers = {layer["number"]: layer for layer in (layers or config.FEMA_LAYERS).values()}
+        self.max_record_count = max_record_count
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.pbf = pbf
+        self.stats = {
+            "requests": 0,
+            "fema_requests": 0,
+            "agol_requests": 0,
+            "pbf_requests": 0,
+            "connections": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "swaps": 0,
+        }
+        self.hosted_counts = {}
+        self.views = {}
+        self.source_itemids = {}
+
+        self._lock = threading.Lock()
+        self._failures = random.Random(seed)
+        self._database = sqlite3.connect(":memory:", check_same_thread=False)
+        self._features = {}
+        self._pbf_features = {}
+        rng = np.random.default_rng(seed)
+        for number, layer in self.layers.items():
+            self._add_source_layer(number, layer, _synthetic_features(layer, features_per_layer, rng))
+
+        self._items = {}
+        self._services = {}  #: the layer each hosted service (including the blue/green sources) has the schema of
+        for layer in self.layers.values():
+            self._add_hosted_layer(layer["itemid"], layer["name"], layer)
+            if blue_green:
+                self.source_itemids[layer["name"]] = [
+                    self._add_hosted_layer(
+                        hashlib.md5(f"{layer['itemid']}{color}".encode()).hexdigest(), f"{layer['name']}_{color}", layer
+                    )
+                    for color in ["blue", "green"]
+                ]
+                self.views[layer["name"]] = f"{layer['name']}_blue"
+        self._jobs = {}
+
+        self._tempdir = tempfile.TemporaryDirectory(prefix="fake_arcgis_")
+        self.cert_path, key_path = _certificate(self._tempdir.name)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._server.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._server.ssl_context.load_cert_chain(self.cert_path, key_path)
+        self._server.finish_request = self._finish_request
+        self._thread = None
+
+        for item in self._items.values():
+            item["url"] = f"{self.org_url}/{ORG_ID}/arcgis/rest/services/{item['title']}/FeatureServer"
+
+    @property
+    def org_url(self):
+        return f"https://127.0.0.1:{self._server.server_port}"
+
+    @property
+    def service_url(self):
+        return f"{self.org_url}{SERVICE_PATH}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake_arcgis", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._tempdir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _finish_request(self, request, client_address):
+        #: Do the TLS handshake in the request's own thread instead of the thread accepting connections
+        self.count("connections")
+        try:
+            request = self._server.ssl_context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, OSError):
+            return
+        _Handler(request, client_address, self._server)
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def inject_failure(self):
+        """Decide whether the current FEMA query should fail, hang, or succeed.
+
+        Returns:
+            str: "error", "timeout", or None
+        """
+
+        with self._lock:
+            draw = self._failures.random()
+        if draw < self.error_rate:
+            self.count("errors")
+            return "error"
+        if draw < self.error_rate + self.timeout_rate:
+            self.count("timeouts")
+            return "timeout"
+        return None
+
+    # FEMA MapServer
+
+    def _add_source_layer(self, number, layer, features):
+        schema = _schema(layer)
+        columns = ", ".join(f"{name} {SQL_TYPES[kind]}" for name, kind, _ in schema)
+        with self._lock:
+            self._database.execute(
+                f"CREATE TABLE layer_{number} ({columns}, _xmin REAL, _ymin REAL, _xmax REAL, _ymax REAL)"
+            )
+            placeholders = ", ".join("?" * (len(schema) + 4))
+            self._database.executemany(
+                f"INSERT INTO layer_{number} VALUES ({placeholders})",
+                [[attributes[name] for name, _, _ in schema] + list(bounds) for attributes, _, bounds in features],
+            )
+        #: Serialize each feature once up front; queries just join the ones they return
+        self._features[number] = {
+            attributes["OBJECTID"]: json.dumps({"attributes": attributes, "geometry": geometry})
+            for attributes, geometry, _ in features
+        }
+        if self.pbf:
+            origin = (config.UTAH_EXTENT[0], config.UTAH_EXTENT[3])
+            self._pbf_features[number] = {
+                attributes["OBJECTID"]: _pbf_feature(attributes, geometry, schema, origin)
+                for attributes, geometry, _ in features
+            }
+
+    def layer_info(self, number):
+        layer = self.layers[number]
+        schema = _schema(layer)
+        return {
+            "currentVersion": 11.3,
+            "id": number,
+            "name": layer["name"],
+            "type": "Feature Layer",
+            "geometryType": _geometry_type(layer),
+            "capabilities": "Map,Query,Data",
+            "maxRecordCount": self.max_record_count,
+            "objectIdField": "OBJECTID",
+            "supportsStatistics": True,
+            "supportsPagination": True,
+            "supportedQueryFormats": "JSON, geoJSON, PBF" if self.pbf else "JSON, geoJSON",
+            "extent": dict(zip(["xmin", "ymin", "xmax", "ymax"], config.UTAH_EXTENT), spatialReference={"wkid": 4269}),
+            "fields": [
+                {"name": name, "type": ESRI_TYPES[kind], "alias": name, **({"length": length} if length else {})}
+                for name, kind, length in schema
+            ],
+        }
+
+    def _select(self, number, params, select):
+        where = params.get("where") or "1=1"
+        arguments = []
+        if params.get("objectIds"):
+            oids = [int(oid) for oid in params["objectIds"].split(",")]
+            where = f"({where}) AND OBJECTID IN ({','.join('?' * len(oids))})"
+            arguments.extend(oids)
+        if params.get("geometry") and params.get("geometryType", "esriGeometryEnvelope") == "esriGeometryEnvelope":
+            envelope = params["geometry"]
+            if envelope.lstrip().startswith("{"):
+                envelope = json.loads(envelope)
+                envelope = [envelope[key] for key in ["xmin", "ymin", "xmax", "ymax"]]
+            else:
+                envelope = [float(value) for value in envelope.split(",")]
+            where = f"({where}) AND _xmax >= ? AND _xmin <= ? AND _ymax >= ? AND _ymin <= ?"
+            arguments.extend([envelope[0], envelope[2], envelope[1], envelope[3]])
+        with self._lock:
+            return self._database.execute(
+                f"SELECT {select} FROM layer_{number} WHERE {where} ORDER BY OBJECTID", arguments
+            ).fetchall()
+
+    def query(self, number, params):
+        """Answer a MapServer layer query: object ids only, a count, statistics, or features by where clause.
+
+        Args:
+            number (int): The layer's number
+            params (dict): The query's parameters
+
+        Returns:
+            dict, str, or bytes: The response, already serialized when it's features (bytes for f=pbf)
+        """
+
+        if params.get("outStatistics"):
+            statistics = json.loads(params["outStatistics"])
+            select = ", ".join(
+                f"{statistic['statisticType'].upper()}({statistic['onStatisticField']})" for statistic in statistics
+            )
+            values = self._select(number, params, select)[0]
+            attributes = {statistic["outStatisticFieldName"]: value for statistic, value in zip(statistics, values)}
+            return {"features": [{"attributes": attributes}]}
+
+        if params.get("returnCountOnly", "").lower() == "true":
+            return {"count": self._select(number, params, "COUNT(*)")[0][0]}
+
+        oids = [row[0] for row in self._select(number, params, "OBJECTID")]
+        if params.get("returnIdsOnly", "").lower() == "true":
+            return {"objectIdFieldName": "OBJECTID", "objectIds": oids or None}
+
+        offset = int(params.get("resultOffset") or 0)
+        record_count = min(int(params.get("resultRecordCount") or self.max_record_count), self.max_record_count)
+        page = oids[offset : offset + record_count]
+        info = self.layer_info(number)
+        if params.get("f") == "pbf":
+            if not self.pbf:
+                return {"error": {"code": 400, "message": "Invalid or missing input parameters.", "details": []}}
+            self.count("pbf_requests")
+            return self._pbf_page(number, info, page)
+        header = {
+            "objectIdFieldName": "OBJECTID",
+            "geometryType": info["geometryType"],
+            "spatialReference": {"wkid": 4269, "latestWkid": 4269},
+            "fields": info["fields"],
+            "exceededTransferLimit": len(oids) > offset + record_count,
+        }
+        features = ",".join(self._features[number][oid] for oid in page)
+        return json.dumps(header)[:-1] + f', "features": [{features}]}}'
+
+    def _pbf_page(self, number, info, page):
+        header = _pbf_field(1, b"OBJECTID") + _varint(7 << 3) + _varint(PBF_GEOMETRY_TYPES[info["geometryType"]])
+        header += _pbf_field(8, _varint(1 << 3) + _varint(4269) + _varint(2 << 3) + _varint(4269))
+        scale = _varint(1 << 3 | 1) + struct.pack("<d", PBF_SCALE) + _varint(2 << 3 | 1) + struct.pack("<d", PBF_SCALE)
+        translate = _varint(1 << 3 | 1) + struct.pack("<d", config.UTAH_EXTENT[0])
+        translate += _varint(2 << 3 | 1) + struct.pack("<d", config.UTAH_EXTENT[3])
+        header += _pbf_field(12, _pbf_field(2, scale) + _pbf_field(3, translate))  #: upper left origin, the default
+        header += b"".join(
+            _pbf_field(13, _pbf_field(1, name.encode("utf-8")) + _varint(2 << 3) + _varint(PBF_TYPES[kind]))
+            for name, kind, _ in _schema(self.layers[number])
+        )
+        feature_result = header + b"".join(self._pbf_features[number][oid] for oid in page)
+        return _pbf_field(2, _pbf_field(1, feature_result))
+
+    # AGOL
+
+    def _add_hosted_layer(self, itemid, name, layer):
+        self._items[itemid] = {
+            "id": itemid,
+            "title": name,
+            "type": "Feature Service",
+            "owner": USERNAME,
+            "url": None,  #: set once the port is known
+            "data": {"layers": [{"id": 0, "layerDefinition": {}}]},
+        }
+        self._services[name] = layer
+        self.hosted_counts[name] = 0
+        return itemid
+
+    def hosted_count(self, name):
+        """The number of features a hosted layer (or for views, the source it uses) has.
+
+        Args:
+            name (str): The hosted layer's service name
+
+        Returns:
+            int: Number of features
+        """
+
+        with self._lock:
+            return self.hosted_counts[self.views.get(name, name)]
+
+    def switch_view(self, name, source):
+        with self._lock:
+            self.views[name] = source
+            self.stats["swaps"] += 1
+
+    def item(self, itemid):
+        with self._lock:
+            return self._items.get(itemid)
+
+    def hosted_layer_info(self, name):
+        layer = self._services[name]
+        view = {}
+        if name in self.views:
+            view = {"isView": True, "adminLayerInfo": {"viewLayerDefinition": {"sourceServiceName": self.views[name]}}}
+        return {
+            "currentVersion": 11.3,
+            "id": 0,
+            "name": name,
+            "type": "Feature Layer",
+            "geometryType": _geometry_type(layer),
+            "capabilities": "Create,Delete,Query,Update,Editing",
+            "maxRecordCount": 2000,
+            "objectIdField": "OBJECTID",
+            "globalIdField": "",
+            "supportsAppend": True,
+            "supportedAppendFormats": "filegdb",
+            "supportsTruncate": True,
+            "hasAttachments": False,
+            "fields": _hosted_fields(layer),
+            "extent": dict(zip(["xmin", "ymin", "xmax", "ymax"], config.UTAH_EXTENT), spatialReference={"wkid": 4326}),
+            **view,
+        }
+
+    def add_item(self, properties, data):
+        """Add an uploaded item. Its file is either uploaded with it (data) or in parts and then committed.
+
+        Args:
+            properties (dict): The item's properties from the addItem request
+            data (bytes): The item's file, or empty when it's uploaded in parts
+
+        Returns:
+            dict: The new item
+        """
+
+        itemid = uuid.uuid4().hex
+        item = {
+            "id": itemid,
+            "title": properties.get("title", ""),
+            "type": properties.get("type", "File Geodatabase"),
+            "owner": USERNAME,
+            "url": None,
+            "path": Path(self._tempdir.name) / f"{itemid}.zip",
+            "parts": {},
+        }
+        item["path"].write_bytes(data)
+        with self._lock:
+            self._items[itemid] = item
+        return item
+
+    def add_part(self, itemid, number, data):
+        with self._lock:
+            self._items[itemid]["parts"][int(number)] = data
+
+    def commit(self, itemid):
+        with self._lock:
+            item = self._items[itemid]
+            parts, item["parts"] = item["parts"], {}
+        item["path"].write_bytes(b"".join(parts[number] for number in sorted(parts)))
+
+    def delete_item(self, itemid):
+        with self._lock:
+            item = self._items.pop(itemid, None)
+        if item and item.get("path"):
+            item["path"].unlink(missing_ok=True)
+        return item is not None
+
+    def search(self, query):
+        """Find items by title, ignoring any other field:value filters in the query.
+
+        Args:
+            query (str): The search's q parameter
+
+        Returns:
+            list[dict]: Items whose title contains the query's title
+        """
+
+        title = re.search(r'title:"([^"]*)"', query)
+        if title:
+            title = title.group(1)
+        else:
+            title = re.sub(r'\b\w+:("[^"]*"|\S+)', "", query).replace(" AND ", " ").strip().strip('"')
+        with self._lock:
+            return [item for item in self._items.values() if title.lower() in item["title"].lower()]
+
+    def expected_count(self, name):
+        """The number of features in a layer that match its where clause in config, ie, what a run should load.
+
+        Layers that are clipped to the state boundary only count the features within the bundled boundary.
+
+        Args:
+            name (str): The layer's name
+
+        Returns:
+            int: Number of features
+        """
+
+        number, layer = next((number, layer) for number, layer in self.layers.items() if layer["name"] == name)
+        if not layer.get("clip_to_boundary"):
+            return self._select(number, {"where": layer["where_clause"]}, "COUNT(*)")[0][0]
+
+        boundary, _ = geometry.read_boundary(Path(main.__file__).parent / "utah_boundary.geojson")
+        points = np.array(self._select(number, {"where": layer["where_clause"]}, "LON, LAT"), dtype=float)
+        return int(shapely.contains_xy(boundary, points[:, 0], points[:, 1]).sum())
+
+    def truncate(self, name):
+        with self._lock:
+            self.hosted_counts[name] = 0
+
+    def append(self, name, itemid):
+        """Append the features in an uploaded, zipped upload.gdb to a hosted layer.
+
+        Args:
+            name (str): The hosted layer's name
+            itemid (str): The uploaded File Geodatabase item
+
+        Returns:
+            int: Number of features appended
+        """
+
+        item = self.item(itemid)
+        info = pyogrio.read_info(f"/vsizip/{item['path']}/upload.gdb", layer="upload")
+        with self._lock:
+            self.hosted_counts[name] += info["features"]
+        return info["features"]
+
+    def add_job(self, result):
+        jobid = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[jobid] = result
+        return jobid
+
+    def job(self, jobid):
+        with self._lock:
+            return self._jobs.get(jobid)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeArcGIS/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        params = {key: values[-1] for key, values in parse_qs(urlsplit(self.path).query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        files = {}
+        if content_type.startswith("multipart/form-data"):
+            fields, files = _parse_multipart(body, content_type)
+            params.update(fields)
+        elif body:
+            params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+        return params, files
+
+    def _send(self, response, status=200, content_type="application/json; charset=utf-8", headers=None):
+        body = response if isinstance(response, (str, bytes)) else json.dumps(response)
+        body = body.encode() if isinstance(body, str) else body
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError, ssl.SSLError):
+            self.close_connection = True
+
+    def _error(self, message, code=400):
+        self._send({"error": {"code": code, "message": message, "details": []}})
+
+    def do_GET(self):
+        self._route()
+
+    def do_POST(self):
+        self._route()
+
+    def _route(self):
+        fake = self.server.fake
+        fake.count("requests")
+        path = urlsplit(self.path).path.rstrip("/")
+        params, files = self._params()
+
+        if path.startswith(SERVICE_PATH):
+            fake.count("fema_requests")
+            return self._fema(fake, path[len(SERVICE_PATH) :], params)
+        fake.count("agol_requests")
+        return self._agol(fake, path, params, files)
+
+    def _fema(self, fake, path, params):
+        if fake.latency:
+            time.sleep(fake.latency)
+        match = re.fullmatch(r"(?:/(\d+))?(/query)?", path)
+        if not match:
+            return self._error(f"Invalid URL {path}", 404)
+        number, query = match.groups()
+        if number is None:
+            return self._send(
+                {
+                    "currentVersion": 11.3,
+                    "layers": [{"id": n, "name": layer["name"]} for n, layer in fake.layers.items()],
+                }
+            )
+        number = int(number)
+        if number not in fake.layers:
+            return self._error("Invalid or missing input parameters.", 400)
+        if not query:
+            return self._send(fake.layer_info(number))
+
+        failure = fake.inject_failure()
+        if failure == "error":
+            return self._send("Service Unavailable", 503)
+        if failure == "timeout":
+            time.sleep(fake.hang_seconds)
+        try:
+            response = fake.query(number, params)
+        except sqlite3.Error as error:
+            return self._error(f"Unable to perform query. {error}")
+        content_type = "application/x-protobuf" if isinstance(response, bytes) else "application/json; charset=utf-8"
+        response = response if isinstance(response, (str, bytes)) else json.dumps(response)
+        response = response.encode() if isinstance(response, str) else response
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            return self._send(
+                gzip.compress(response, 1), content_type=content_type, headers={"Content-Encoding": "gzip"}
+            )
+        return self._send(response, content_type=content_type)
+
+    def _agol(self, fake, path, params, files):
+        routes = [
+            (r"/sharing/rest", self._version),
+            (r"/sharing/rest/info", self._info),
+            (r"/sharing/rest/generateToken", self._token),
+            (r"/sharing/rest/oauth2/token", self._token),
+            (r"/sharing/rest/oauth2/authorize", self._authorize),
+            (r"/sharing/oauth2/signin", self._signin),
+            (r"/sharing/rest/portals/self", self._portal),
+            (r"/sharing/rest/portals/[^/]+", self._portal),
+            (r"/sharing/rest/community/self", self._user),
+            (r"/sharing/rest/community/users/[^/]+", self._user),
+            (r"/sharing/rest/search", self._search),
+            (r"/sharing/rest/content/items/(?P<itemid>\w+)", self._item),
+            (r"/sharing/rest/content/items/(?P<itemid>\w+)/data", self._item_data),
+            (r"/sharing/rest/content/users/[^/]+(?:/[^/]+)?/items/(?P<itemid>\w+)/delete", self._delete_item),
+            (r"/sharing/rest/content/users/[^/]+(?:/[^/]+)?/items/(?P<itemid>\w+)/update", self._update_item),
+            (r"/sharing/rest/content/users/[^/]+(?:/[^/]+)?/items/(?P<itemid>\w+)/status", self._item_status),
+            (r"/sharing/rest/content/users/[^/]+(?:/[^/]+)?/items/(?P<itemid>\w+)/addPart", self._add_part),
+            (r"/sharing/rest/content/users/[^/]+(?:/[^/]+)?/items/(?P<itemid>\w+)/commit", self._commit),
+            (r"/sharing/rest/content/users/[^/]+(?:/[^/]+)?/addItem", self._add_item),
+            (r"/sharing/rest/content/users/[^/]+", self._user_content),
+            (rf"/{ORG_ID}/arcgis/rest/services/(?P<name>\w+)/FeatureServer", self._feature_service),
+            (rf"/{ORG_ID}/arcgis/rest/services/(?P<name>\w+)/FeatureServer/0", self._feature_layer),
+            (rf"/{ORG_ID}/arcgis/rest/services/(?P<name>\w+)/FeatureServer/0/query", self._feature_query),
+            (rf"/{ORG_ID}/arcgis/rest/services/(?P<name>\w+)/FeatureServer/0/append", self._append),
+            (rf"/{ORG_ID}/arcgis/rest/services/(?P<name>\w+)/FeatureServer/0/deleteFeatures", self._delete_features),
+            (rf"/{ORG_ID}/arcgis/rest/admin/services/(?P<name>\w+)/FeatureServer", self._feature_service),
+            (rf"/{ORG_ID}/arcgis/rest/admin/services/(?P<name>\w+)/FeatureServer/0", self._feature_layer),
+            (rf"/{ORG_ID}/arcgis/rest/admin/services/(?P<name>\w+)/FeatureServer(?:/0)?/refresh", self._success),
+            (rf"/{ORG_ID}/arcgis/rest/admin/services/(?P<name>\w+)/FeatureServer/0/truncate", self._truncate),
+            (rf"/{ORG_ID}/arcgis/rest/admin/services/(?P<name>\w+)/FeatureServer/deleteFromDefinition", self._success),
+            (rf"/{ORG_ID}/arcgis/rest/admin/services/(?P<name>\w+)/FeatureServer/addToDefinition", self._add_layer),
+            (rf"/{ORG_ID}/arcgis/rest/services/(?P<name>\w+)/FeatureServer/jobs/(?P<jobid>\w+)(?:/status)?", self._job),
+            (
+                rf"/{ORG_ID}/arcgis/rest/admin/services/(?P<name>\w+)/FeatureServer/0/jobs/(?P<jobid>\w+)(?:/status)?",
+                self._job,
+            ),
+        ]
+        for pattern, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if match:
+                return handler(fake, params=params, files=files, **match.groupdict())
+        return self._error(f"fake_arcgis has no route for {path}", 404)
+
+    def _version(self, fake, **_):
+        self._send({"currentVersion": "2025.1"})
+
+    def _info(self, fake, **_):
+        self._send(
+            {
+                "owningSystemUrl": fake.org_url,
+                "authInfo": {
+                    "isTokenBasedSecurity": True,
+                    "tokenServicesUrl": f"{fake.org_url}/sharing/rest/generateToken",
+                },
+            }
+        )
+
+    def _authorize(self, fake, params, **_):
+        #: The ArcGIS API for Python logs in with the OAuth implicit flow, reading oauth_state from the sign in page
+        oauth_state = fake.add_job({"state": params.get("state"), "redirect_uri": params.get("redirect_uri")})
+        self._send(
+            f'<html><script>var oAuthInfo = {{"oauth_state":"{oauth_state}"}};</script></html>',
+            content_type="text/html",
+        )
+
+    def _signin(self, fake, params, **_):
+        #: Redirect back with the token in the url's fragment, like AGOL does after a successful sign in
+        oauth = fake.job(params.get("oauth_state")) or {}
+        fragment = urlencode(
+            {"access_token": "fake-token", "expires_in": 7200, "username": USERNAME, "state": oauth.get("state")}
+        )
+        self._send("", status=302, headers={"Location": f"{oauth.get('redirect_uri')}#{fragment}"})
+
+    def _token(self, fake, **_):
+        expires = int((time.time() + 7200) * 1000)
+        self._send({"token": "fake-token", "access_token": "fake-token", "expires": expires, "ssl": True})
+
+    def _portal(self, fake, **_):
+        self._send(
+            {
+                "id": ORG_ID,
+                "name": "Fake Org",
+                "portalName": "ArcGIS Online",
+                "portalMode": "multitenant",
+                "isPortal": False,
+                "urlKey": "fake",
+                "customBaseUrl": "127.0.0.1",
+                "portalHostname": f"127.0.0.1:{fake._server.server_port}",
+                "allSSL": True,
+                "currentVersion": "2025.1",
+                "helperServices": {},
+                "user": self._user_info(),
+            }
+        )
+
+    @staticmethod
+    def _user_info():
+        return {
+            "id": "0123456789abcdef0123456789abcdef",
+            "username": USERNAME,
+            "fullName": USERNAME,
+            "role": "org_admin",
+            "orgId": ORG_ID,
+            "privileges": [],
+            "groups": [],
+        }
+
+    def _user(self, fake, **_):
+        self._send(self._user_info())
+
+    def _user_content(self, fake, **_):
+        self._send({"username": USERNAME, "currentFolder": None, "folders": [], "items": [], "total": 0})
+
+    def _search(self, fake, params, **_):
+        results = [_item_json(fake, item) for item in fake.search(params.get("q", ""))]
+        self._send({"total": len(results), "start": 1, "num": len(results), "nextStart": -1, "results": results})
+
+    def _item(self, fake, itemid, **_):
+        item = fake.item(itemid)
+        if item is None:
+            return self._error("Item does not exist or is inaccessible.", 400)
+        self._send(_item_json(fake, item))
+
+    def _item_data(self, fake, itemid, **_):
+        item = fake.item(itemid)
+        if item is None:
+            return self._error("Item does not exist or is inaccessible.", 400)
+        self._send(item.get("data") or {})
+
+    def _update_item(self, fake, itemid, params, **_):
+        item = fake.item(itemid)
+        if item is None:
+            return self._error("Item does not exist or is inaccessible.", 400)
+        if "text" in params:
+            item["data"] = json.loads(params["text"])
+        self._send({"success": True, "id": itemid})
+
+    def _delete_item(self, fake, itemid, **_):
+        if not fake.delete_item(itemid):
+            return self._error("Item does not exist or is inaccessible.", 400)
+        self._send({"success": True, "itemId": itemid})
+
+    def _item_status(self, fake, itemid, **_):
+        self._send({"id": itemid, "itemId": itemid, "status": "completed"})
+
+    def _add_part(self, fake, itemid, params, files, **_):
+        fake.add_part(itemid, params["partNum"], files.get("file", b""))
+        self._send({"success": True})
+
+    def _commit(self, fake, itemid, **_):
+        fake.commit(itemid)
+        self._send({"success": True, "itemId": itemid})
+
+    def _add_item(self, fake, params, files, **_):
+        data = files.get("file", b"")
+        item = fake.add_item(params, data)
+        self._send({"success": True, "id": item["id"], "folder": None})
+
+    def _feature_service(self, fake, name, **_):
+        self._send(
+            {
+                "currentVersion": 11.3,
+                "serviceItemId": next(item["id"] for item in fake._items.values() if item["title"] == name),
+                "layers": [{"id": 0, "name": name}],
+                "tables": [],
+                "capabilities": "Create,Delete,Query,Update,Editing",
+            }
+        )
+
+    def _feature_layer(self, fake, name, **_):
+        self._send(fake.hosted_layer_info(name))
+
+    def _feature_query(self, fake, name, params, **_):
+        if params.get("returnCountOnly", "").lower() == "true":
+            return self._send({"count": fake.hosted_count(name)})
+        info = fake.hosted_layer_info(name)
+        self._send(
+            {
+                "objectIdFieldName": "OBJECTID",
+                "geometryType": info["geometryType"],
+                "spatialReference": {"wkid": 4326},
+                "fields": info["fields"],
+                "features": [],
+            }
+        )
+
+    def _append(self, fake, name, params, **_):
+        try:
+            count = fake.append(name, params["appendItemId"])
+        except Exception as error:  # noqa: BLE001 - reported to the client like AGOL does
+            return self._error(f"Append failed: {error}", 500)
+        result = {"status": "Completed", "recordCount": count, "layerName": name, "messages": {"recordCount": count}}
+        jobid = fake.add_job(result)
+        self._send({"statusUrl": f"{fake.org_url}/{ORG_ID}/arcgis/rest/services/{name}/FeatureServer/jobs/{jobid}"})
+
+    def _success(self, fake, **_):
+        self._send({"success": True})
+
+    def _add_layer(self, fake, name, params, **_):
+        #: The second half of switching a view's source: its layer is added back with the new source's name
+        layer = json.loads(params["addToDefinition"])["layers"][0]
+        fake.switch_view(name, layer["adminLayerInfo"]["viewLayerDefinition"]["sourceServiceName"])
+        self._send({"success": True})
+
+    def _delete_features(self, fake, name, params, **_):
+        self._send({"deleteResults": []})
+
+    def _truncate(self, fake, name, **_):
+        fake.truncate(name)
+        jobid = fake.add_job({"status": "Completed", "submissionTime": int(time.time() * 1000)})
+        self._send(
+            {
+                "submissionTime": int(time.time() * 1000),
+                "statusURL": f"{fake.org_url}/{ORG_ID}/arcgis/rest/admin/services/{name}/FeatureServer/0/jobs/{jobid}",
+            }
+        )
+
+    def _job(self, fake, name, jobid, **_):
+        result = fake.job(jobid)
+        if result is None:
+            return self._error("Job not found", 404)
+        self._send(result)
+
+
+def _item_json(fake, item):
+    return {
+        "id": item["id"],
+        "owner": item["owner"],
+        "title": item["title"],
+        "type": item["type"],
+        "url": item["url"],
+        "typeKeywords": [],
+        "access": "private",
+        "ownerFolder": None,
+        "orgId": ORG_ID,
+    }
+
+
+def _parse_multipart(body, content_type):
+    #: Split a multipart/form-data body into text fields and file contents by field name
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    fields, files = {}, {}
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        headers, content = part.split(b"\r\n\r\n", 1)
+        content = content[:-2] if content.endswith(b"\r\n") else content
+        name = re.search(rb'name="([^"]*)"', headers)
+        if not name:
+            continue
+        if b"filename=" in headers:
+            files[name.group(1).decode()] = content
+        else:
+            fields[name.group(1).decode()] = content.decode()
+    return fields, files
+
+
+def _arguments(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--features", type=int, default=1000, help="synthetic features in each layer")
+    parser.add_argument("--max-record-count", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to each FEMA request")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of FEMA queries that fail with a 503")
+    parser.add_argument("--timeout-rate", type=float, default=0, help="share of FEMA queries that hang")
+    parser.add_argument("--hang-seconds", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = _arguments(sys.argv[1:])
+    with FakeArcGIS(
+        features_per_layer=arguments.features,
+        max_record_count=arguments.max_record_count,
+        latency=arguments.latency,
+        error_rate=arguments.error_rate,
+        timeout_rate=arguments.timeout_rate,
+        hang_seconds=arguments.hang_seconds,
+        seed=arguments.seed,
+    ) as fake:
+        print(f"SERVICE_URL={fake.service_url}")
+        print(f"AGOL_ORG={fake.org_url}")
+        print(f"REQUESTS_CA_BUNDLE={fake.cert_path}")
+        print(f"SSL_CERT_FILE={fake.cert_path}")
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
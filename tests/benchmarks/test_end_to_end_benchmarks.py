@@ -0,0 +1,161 @@
+import logging
+
+import pytest
+from fake_arcgis import FakeArcGIS
+
+from nfhl import config, main
+
+#: Requests to the fake server don't need pacing, and its injected timeouts should be caught quickly
+CONTROLLER_SETTINGS = {
+    "concurrency": 2,
+    "page_size": 250,
+    "timeout": 2,
+    "pause": 0,
+    "min_pause": 0,
+    "min_timeout": 1,
+    "max_timeout": 10,
+    "target_latency": 1,
+    "max_tries": 6,
+}
+
+
+@pytest.fixture
+def run_process(monkeypatch, mocker):
+    """Run process() against a FakeArcGIS with config settings overridden, returning the summary message it sent."""
+
+    loggers = [logging.getLogger(config.SKID_NAME), logging.getLogger("palletjack")]
+    handlers = {logger.name: list(logger.handlers) for logger in loggers}
+
+    def _run(fake, **settings):
+        monkeypatch.setenv("REQUESTS_CA_BUNDLE", str(fake.cert_path))
+        monkeypatch.setenv("SSL_CERT_FILE", str(fake.cert_path))  #: the ArcGIS API for Python uses the OS trust store
+        monkeypatch.setattr(config, "SERVICE_URL", fake.service_url)
+        monkeypatch.setattr(config, "AGOL_ORG", fake.org_url)
+        monkeypatch.setattr(config, "SENDGRID_SETTINGS", {"from_address": "", "to_addresses": []}, raising=False)
+        monkeypatch.setattr(config, "REQUEST_CONTROLLER_SETTINGS", CONTROLLER_SETTINGS)
+        monkeypatch.setattr(config, "TIMEOUT", 5)
+        for name, value in settings.items():
+            monkeypatch.setattr(config, name, value)
+        mocker.patch.object(
+            main,
+            "_get_secrets",
+            return_value={"AGOL_USER": "user", "AGOL_PASSWORD": "password", "SENDGRID_API_KEY": ""},
+        )
+        send_mock = mocker.patch("supervisor.message_handlers.SendGridHandler.send_message")
+
+        main.process()
+
+        #: _initialize adds a console handler every run
+        for logger in loggers:
+            for handler in logger.handlers[len(handlers[logger.name]) :]:
+                logger.removeHandler(handler)
+        return send_mock.call_args.args[0]
+
+    return _run
+
+
+def _assert_every_layer_loaded(fake, summary_message):
+    for name in config.FEMA_LAYERS:
+        assert fake.hosted_count(name) == fake.expected_count(name), name
+        assert f"{name}: {fake.expected_count(name)}\n" in summary_message.message
+    assert "Errors: 0" in summary_message.message
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {},
+        {"MAX_WORKERS": 4},
+        {"ARROW_DTYPES": True},
+        {"STREAM_BATCH_SIZE": 200},
+        {"ENRICHMENT": True, "MAX_WORKERS": 4},
+        {"QUERY_FORMAT": "pbf"},
+    ],
+    ids=["sequential", "concurrent", "arrow", "streaming", "enriched", "pbf"],
+)
+#: Runs on the larger dataset take a minute or more each, so they're also marked slow like the largest benchmarks
+@pytest.mark.parametrize("features", [1_000, pytest.param(10_000, marks=pytest.mark.slow)])
+@pytest.mark.e2e
+def test_process_end_to_end_benchmark(benchmark, run_process, features, settings):
+    with FakeArcGIS(features_per_layer=features, latency=0.01) as fake:
+        summary_message = benchmark.pedantic(run_process, args=(fake,), kwargs=settings, rounds=1, iterations=1)
+
+        _assert_every_layer_loaded(fake, summary_message)
+
+
+def test_process_downloads_pbf_over_pooled_connections(run_process):
+    with FakeArcGIS(features_per_layer=500, max_record_count=100) as fake:
+        summary_message = run_process(fake, QUERY_FORMAT="pbf", MAX_WORKERS=4)
+
+        _assert_every_layer_loaded(fake, summary_message)
+        assert fake.stats["pbf_requests"] >= 5 * len(config.FEMA_LAYERS)
+        #: The ArcGIS API for Python opens a few of its own for AGOL, but FEMA's requests share the run's session
+        assert fake.stats["connections"] < fake.stats["fema_requests"] / 4
+
+
+@pytest.mark.e2e
+def test_process_falls_back_to_json_without_pbf_support(run_process):
+    with FakeArcGIS(features_per_layer=200, pbf=False) as fake:
+        summary_message = run_process(fake, QUERY_FORMAT="pbf")
+
+        _assert_every_layer_loaded(fake, summary_message)
+        assert fake.stats["pbf_requests"] == 0
+
+
+@pytest.mark.e2e
+def test_process_recovers_from_fema_errors_and_timeouts(run_process, monkeypatch):
+    #: palletjack's own retries wait 2, 4, 8... seconds between tries, so shorten them to keep the test quick
+    monkeypatch.setattr("palletjack.utils.RETRY_DELAY_TIME", 0.1)
+
+    #: Small pages so that every layer makes enough requests for some of them to fail and hang
+    with FakeArcGIS(
+        features_per_layer=300, max_record_count=50, error_rate=0.1, timeout_rate=0.05, hang_seconds=3
+    ) as fake:
+        summary_message = run_process(fake)
+
+        assert fake.stats["errors"] > 0
+        assert fake.stats["timeouts"] > 0
+        _assert_every_layer_loaded(fake, summary_message)
+        assert "failed)" in summary_message.message
+
+
+@pytest.mark.e2e
+def test_process_blue_green_switches_views_between_sources(run_process):
+    with FakeArcGIS(features_per_layer=500, blue_green=True) as fake:
+        layers = {
+            name: {**layer, "source_itemids": fake.source_itemids[name]} for name, layer in config.FEMA_LAYERS.items()
+        }
+
+        summary_message = run_process(fake, BLUE_GREEN=True, FEMA_LAYERS=layers)
+
+        _assert_every_layer_loaded(fake, summary_message)
+        assert fake.views == {name: f"{name}_green" for name in layers}
+        assert not any(fake.hosted_counts[f"{name}_blue"] for name in layers)  #: the previous load, left for rollback
+
+        #: The next run loads the other source and switches back to it
+        summary_message = run_process(fake, BLUE_GREEN=True, FEMA_LAYERS=layers)
+
+        _assert_every_layer_loaded(fake, summary_message)
+        assert fake.views == {name: f"{name}_blue" for name in layers}
+        assert fake.stats["swaps"] == 2 * len(layers)
+
+
+def test_process_sends_the_summary_when_fema_is_down(run_process, monkeypatch):
+    monkeypatch.setattr("palletjack.utils.RETRY_DELAY_TIME", 0.1)
+
+    with FakeArcGIS(features_per_layer=100, error_rate=1.0) as fake:
+        summary_message = run_process(fake, BREAKER_THRESHOLD=2, RETRY_BUDGET=4, RUN_SECONDS=120, SUMMARY_SECONDS=10)
+
+        skipped = len(config.FEMA_LAYERS) - 2
+        assert f"Errors: {len(config.FEMA_LAYERS)}" in summary_message.message
+        assert summary_message.message.count(": skipped\n") == skipped
+        assert "Run budget: 4 of 4 retries used, circuit breaker open" in summary_message.message
+
+
+@pytest.mark.e2e
+def test_process_fans_layers_out_to_local_workers(run_process):
+    with FakeArcGIS(features_per_layer=500) as fake:
+        summary_message = run_process(fake, FANOUT_TOPIC="local", FANOUT_POLL_SECONDS=0.1, ENRICHMENT=True)
+
+        _assert_every_layer_loaded(fake, summary_message)
+        assert "S_XS: extract " in summary_message.message  #: the workers' stage metrics are in the summary
@@ -0,0 +1,58 @@
+import os
+import re
+import subprocess
+import sys
+
+#: Cumulative import time budget for nfhl.main in milliseconds. pandas and geopandas alone take most of it; arcgis,
+#: palletjack, and supervisor would add a couple of seconds more if they were imported at module level again.
+IMPORT_BUDGET_MS = int(os.environ.get("NFHL_IMPORT_BUDGET_MS", "1500"))
+
+#: Modules that should only be imported when the stage that needs them runs
+DEFERRED_MODULES = ["arcgis", "palletjack", "supervisor"]
+
+
+def _import_times(module):
+    #: Import module in a fresh interpreter and parse -X importtime's "self | cumulative | name" lines from stderr
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=os.environ,
+    )
+    times = {}
+    for match in re.finditer(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$", result.stderr, re.MULTILINE):
+        times[match.group(4)] = int(match.group(2)) / 1000  #: cumulative microseconds to milliseconds
+    return times
+
+
+def test_main_import_does_not_import_heavy_modules():
+    times = _import_times("nfhl.main")
+
+    imported = {name.split(".")[0] for name in times}
+
+    assert "nfhl.main" in times
+    assert not imported.intersection(DEFERRED_MODULES)
+
+
+def test_main_import_time_is_within_budget():
+    #: Take the best of a few runs so that a busy machine doesn't fail the test
+    best = min(_import_times("nfhl.main")["nfhl.main"] for _ in range(3))
+
+    assert best < IMPORT_BUDGET_MS, f"importing nfhl.main took {best:.0f} ms, over the {IMPORT_BUDGET_MS} ms budget"
+
+
+def test_config_import_does_not_resolve_host_name():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, nfhl.config as c; print('HOST_NAME' in vars(c), 'urllib.request' in sys.modules)",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=os.environ,
+    )
+
+    assert result.stdout.split() == ["False", "False"]
@@ -0,0 +1,139 @@
+import logging
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from shapely import box, points
+
+from nfhl import config, enrich, geometry, main
+
+ZONES_AND_SUBTYPES = [(zone, subtype) for zone, subtype in main.HAZARD_AREA_LABELS if subtype is not main.ANY_SUBTYPE]
+ZONES_AND_SUBTYPES += [("D", None), ("AREA NOT INCLUDED", None), ("X", "AREA OF MINIMAL FLOOD HAZARD"), ("AE", "")]
+
+#: Only the smallest size runs by default; the larger ones take tens of seconds to minutes each
+SIZES = [10_000, pytest.param(100_000, marks=pytest.mark.slow), pytest.param(1_000_000, marks=pytest.mark.slow)]
+GENERALIZE_SIZES = [10_000, pytest.param(100_000, marks=pytest.mark.slow)]
+#: Generalization is opt-in, so benchmark it with the example settings from the README
+GENERALIZE_SETTINGS = {"simplify_tolerance": 0.00001, "xy_precision": 0.000001}
+
+
+def _hazard_areas_df(rows, arrow_dtypes=False):
+    #: Synthetic S_Fld_Haz_Ar extract with every labelling rule represented, shaped like the data from FEMA
+    rng = np.random.default_rng(42)
+    choices = rng.integers(0, len(ZONES_AND_SUBTYPES), rows)
+    zones, subtypes = zip(*ZONES_AND_SUBTYPES)
+    #: Hazard areas tile the map without overlapping, so lay the polygons out as a grid like a real coverage
+    columns = int(np.ceil(np.sqrt(rows)))
+    x = -114 + (np.arange(rows) % columns) * 0.001
+    y = 37 + (np.arange(rows) // columns) * 0.001
+
+    hazard_areas_df = gpd.GeoDataFrame(
+        {
+            "OBJECTID": np.arange(1, rows + 1),
+            "FLD_ZONE": pd.array(np.array(zones, dtype=object)[choices], dtype="string"),
+            "ZONE_SUBTY": pd.array(np.array(subtypes, dtype=object)[choices], dtype="string"),
+            "DFIRM_ID": pd.array(np.where(choices % 3, "49035C", None), dtype="string"),
+            "STATIC_BFE": rng.uniform(4000, 6000, rows).astype(str),
+            "DEPTH": rng.uniform(0, 3, rows).astype(str),
+            "VELOCITY": rng.uniform(0, 3, rows).astype(str),
+            "BFE_REVERT": rng.uniform(0, 3, rows).astype(str),
+            "DEP_REVERT": rng.uniform(0, 3, rows).astype(str),
+            "GlobalID": [f"{{{i:08d}}}" for i in range(rows)],
+            "SHAPE.STArea()": rng.uniform(0, 1, rows),
+            "SHAPE": box(x, y, x + 0.001, y + 0.001),
+        },
+        geometry="SHAPE",
+        crs=4269,
+    )
+    if arrow_dtypes:
+        hazard_areas_df = main._compact_dtypes(config.FEMA_LAYERS["S_Fld_Haz_Ar"], hazard_areas_df)
+    return hazard_areas_df
+
+
+@pytest.mark.parametrize("arrow_dtypes", [False, True], ids=["object", "arrow"])
+@pytest.mark.parametrize("rows", SIZES)
+def test_hazard_areas_benchmark(benchmark, rows, arrow_dtypes):
+    #: Build a fresh frame for each round because _hazard_areas modifies it in place
+    benchmark.pedantic(
+        main._hazard_areas, setup=lambda: ((_hazard_areas_df(rows, arrow_dtypes),), {}), rounds=5, warmup_rounds=1
+    )
+
+
+@pytest.mark.parametrize("arrow_dtypes", [False, True], ids=["object", "arrow"])
+@pytest.mark.parametrize("rows", SIZES)
+def test_transform_layer_benchmark(benchmark, rows, arrow_dtypes):
+    #: Geometry generalization is benchmarked separately below
+    layer = config.FEMA_LAYERS["S_Fld_Haz_Ar"]
+    logger = logging.getLogger("benchmark")
+
+    result = benchmark.pedantic(
+        main._transform_layer,
+        setup=lambda: ((logger, layer, _hazard_areas_df(rows, arrow_dtypes)), {}),
+        rounds=5,
+        warmup_rounds=1,
+    )
+
+    assert len(result) == rows
+
+
+@pytest.mark.parametrize("rows", GENERALIZE_SIZES)
+def test_generalize_benchmark(benchmark, rows):
+    layer = config.FEMA_LAYERS["S_Fld_Haz_Ar"]
+    logger = logging.getLogger("benchmark")
+
+    result = benchmark.pedantic(
+        geometry.generalize,
+        setup=lambda: ((logger, layer["name"], _hazard_areas_df(rows)["SHAPE"]), GENERALIZE_SETTINGS),
+        rounds=3,
+        warmup_rounds=1,
+    )
+
+    assert len(result) == rows
+
+
+@pytest.mark.parametrize("rows", SIZES)
+def test_validate_benchmark(benchmark, rows):
+    #: Turn one in every thousand hazard areas into a self-intersecting bow tie so the repair path is timed too
+    geometries = _hazard_areas_df(rows)["SHAPE"]
+    bow_ties = np.arange(0, rows, 1000)
+    minx, miny, maxx, maxy = shapely.bounds(geometries.values[bow_ties]).T
+    geometries.values[bow_ties] = shapely.polygons(
+        np.stack([np.c_[minx, miny], np.c_[maxx, maxy], np.c_[maxx, miny], np.c_[minx, maxy]], axis=1)
+    )
+    logger = logging.getLogger("benchmark")
+
+    _, repaired, unfixable = benchmark.pedantic(
+        geometry.validate, args=(logger, "S_Fld_Haz_Ar", geometries), rounds=3, warmup_rounds=1
+    )
+
+    assert repaired.sum() == len(bow_ties)
+    assert not unfixable.any()
+
+
+@pytest.mark.parametrize("rows", SIZES)
+def test_enrich_benchmark(benchmark, rows):
+    #: Index rows hazard areas and rows / 100 panels covering them, then look up the panel and zone of rows points
+    hazard_areas_df = main._hazard_areas(_hazard_areas_df(rows))
+    hazard_areas_df.columns = [column.lower() if column != "SHAPE" else column for column in hazard_areas_df.columns]
+    panels_df = hazard_areas_df.dissolve(by=np.arange(rows) // 100).reset_index(names="firm_pan")
+    bounds = hazard_areas_df.total_bounds
+    rng = np.random.default_rng(7)
+    points_df = gpd.GeoDataFrame(
+        {"OBJECTID": np.arange(rows)},
+        geometry=points(rng.uniform(bounds[0], bounds[2], rows), rng.uniform(bounds[1], bounds[3], rows)),
+        crs=4269,
+    )
+    logger = logging.getLogger("benchmark")
+
+    def _index_and_enrich(target_df):
+        lookups = {
+            "S_FIRM_Pan": enrich.SpatialLookup("S_FIRM_Pan", panels_df, ["firm_pan"]),
+            "S_Fld_Haz_Ar": enrich.SpatialLookup("S_Fld_Haz_Ar", hazard_areas_df, ["fld_zone", "label"]),
+        }
+        return enrich.enrich(logger, "S_LOMAs", target_df, lookups, config.PANEL_AND_ZONE_ENRICHMENT)
+
+    result = benchmark.pedantic(_index_and_enrich, setup=lambda: ((points_df.copy(),), {}), rounds=3, warmup_rounds=1)
+
+    assert result["zone_label"].notna().mean() > 0.9
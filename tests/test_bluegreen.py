@@ -0,0 +1,61 @@
+import pytest
+
+from nfhl import bluegreen
+
+SOURCE_URLS = {
+    "blue": "https://services.arcgis.com/org/arcgis/rest/services/S_XS_blue/FeatureServer",
+    "green": "https://services.arcgis.com/org/arcgis/rest/services/S_XS_green/FeatureServer/",
+}
+
+
+def _patch_collections(mocker, view_source):
+    #: Stand in for the view and source feature layer collections, keyed by item id
+    collections = {
+        itemid: mocker.Mock(url=url, layers=[mocker.Mock(name=f"{itemid} layer")])
+        for itemid, url in SOURCE_URLS.items()
+    }
+    view = mocker.Mock(layers=[mocker.Mock()])
+    view.layers[0].manager.properties = {"adminLayerInfo": {"viewLayerDefinition": {"sourceServiceName": view_source}}}
+    collections["view"] = view
+    gis = mocker.Mock()
+    gis.content.get.side_effect = lambda itemid: mocker.Mock(itemid=itemid)
+    mocker.patch("arcgis.features.FeatureLayerCollection.fromitem", side_effect=lambda item: collections[item.itemid])
+    return gis, collections
+
+
+@pytest.mark.parametrize("view_source, expected", [("S_XS_blue", ("green", "blue")), ("S_XS_green", ("blue", "green"))])
+def test_find_standby_returns_the_source_the_view_isnt_using(mocker, view_source, expected):
+    gis, _ = _patch_collections(mocker, view_source)
+
+    assert bluegreen.find_standby(gis, "view", ["blue", "green"]) == expected
+
+
+def test_find_standby_raises_if_the_view_uses_neither_source(mocker):
+    gis, _ = _patch_collections(mocker, "S_XS_original")
+
+    with pytest.raises(ValueError, match="View view uses S_XS_original, which isn't one of \\['blue', 'green'\\]"):
+        bluegreen.find_standby(gis, "view", ["blue", "green"])
+
+
+def test_hosted_count_queries_the_first_layer_for_a_count(mocker):
+    gis, collections = _patch_collections(mocker, "S_XS_blue")
+    collections["green"].layers[0].query.return_value = 42
+
+    assert bluegreen.hosted_count(gis, "green") == 42
+    collections["green"].layers[0].query.assert_called_once_with(return_count_only=True)
+
+
+def test_hosted_count_raises_for_a_missing_item(mocker):
+    gis = mocker.Mock()
+    gis.content.get.return_value = None
+
+    with pytest.raises(ValueError, match="Item gone not found"):
+        bluegreen.hosted_count(gis, "gone")
+
+
+def test_switch_view_swaps_the_views_layer_to_the_new_source(mocker):
+    gis, collections = _patch_collections(mocker, "S_XS_blue")
+
+    bluegreen.switch_view(gis, "view", "green")
+
+    collections["view"].manager.swap_view.assert_called_once_with(0, collections["green"].layers[0])
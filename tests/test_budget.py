@@ -0,0 +1,90 @@
+import pytest
+
+from nfhl import budget
+
+
+@pytest.fixture(autouse=True)
+def _no_sleep(mocker):
+    return mocker.patch("palletjack.utils.sleep")
+
+
+def test_unlimited_budget_has_no_deadline_or_limits(mocker):
+    run_budget = budget.RunBudget(mocker.Mock())
+
+    run_budget.check("anything")
+
+    assert not run_budget.limited
+    assert run_budget.timeout() is None
+    assert str(run_budget) == "0 retries used, circuit breaker closed"
+
+
+def test_check_raises_once_the_deadline_passes(mocker):
+    run_budget = budget.RunBudget(mocker.Mock(), run_seconds=60, summary_seconds=60)
+
+    with pytest.raises(budget.BudgetExhausted, match="Not starting S_XS: the run is out of time"):
+        run_budget.check("S_XS")
+    assert run_budget.timeout() == 0
+
+
+def test_retry_retries_like_palletjack_without_limits(mocker, _no_sleep):
+    worker = mocker.Mock(side_effect=[RuntimeError("one"), RuntimeError("two"), 42], __name__="worker")
+    run_budget = budget.RunBudget(mocker.Mock())
+
+    assert run_budget.retry(worker, "arg", keyword=1) == 42
+    assert worker.call_count == 3
+    worker.assert_called_with("arg", keyword=1)
+    assert [call.args[0] for call in _no_sleep.call_args_list] == [2, 4]
+    assert run_budget.retries == 2
+
+
+def test_retry_shares_the_retry_budget_between_calls(mocker):
+    worker = mocker.Mock(side_effect=RuntimeError("down"), __name__="worker")
+    run_budget = budget.RunBudget(mocker.Mock(), max_retries=2)
+
+    with pytest.raises(RuntimeError, match="down") as first:
+        run_budget.retry(worker)
+    with pytest.raises(RuntimeError, match="down") as second:
+        run_budget.retry(worker)
+
+    assert worker.call_count == 4  #: three tries using both retries, then one try with none left
+    assert isinstance(first.value.__cause__, budget.BudgetExhausted)
+    assert "all 2 retries have been used" in str(second.value.__cause__)
+    assert str(run_budget) == "2 of 2 retries used, circuit breaker closed"
+
+
+def test_retry_does_not_wait_past_the_deadline(mocker, _no_sleep):
+    worker = mocker.Mock(side_effect=RuntimeError("down"), __name__="worker")
+    run_budget = budget.RunBudget(mocker.Mock(), run_seconds=3, summary_seconds=0)
+
+    with pytest.raises(RuntimeError) as error:
+        run_budget.retry(worker)
+
+    assert worker.call_count == 2
+    assert [call.args[0] for call in _no_sleep.call_args_list] == [2]  #: the next wait, 4s, is past the deadline
+    assert "would be out of time" in str(error.value.__cause__)
+
+
+def test_retry_does_not_retry_budget_exhausted(mocker):
+    worker = mocker.Mock(side_effect=budget.BudgetExhausted("out of time"), __name__="worker")
+    run_budget = budget.RunBudget(mocker.Mock())
+
+    with pytest.raises(budget.BudgetExhausted):
+        run_budget.retry(worker)
+
+    assert worker.call_count == 1
+
+
+def test_record_layer_opens_the_breaker_after_consecutive_failures(mocker):
+    run_budget = budget.RunBudget(mocker.Mock(), breaker_threshold=2)
+
+    run_budget.record_layer("one", False)
+    run_budget.record_layer("two", True)
+    run_budget.record_layer("three", False)
+    assert not run_budget.breaker_open
+
+    run_budget.record_layer("four", False)
+
+    assert run_budget.breaker_open
+    assert "circuit breaker open" in str(run_budget)
+    with pytest.raises(budget.BudgetExhausted, match="2 layers failed in a row"):
+        run_budget.check("five")
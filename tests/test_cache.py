@@ -0,0 +1,88 @@
+import os
+import time
+
+import geopandas as gpd
+from shapely.geometry import Point
+
+from nfhl import cache
+
+
+def _extract(count=2):
+    return gpd.GeoDataFrame(
+        {"OBJECTID": range(count), "DFIRM_ID": ["49001C"] * count, "SHAPE": [Point(x, x) for x in range(count)]},
+        geometry="SHAPE",
+        crs=4269,
+    )
+
+
+def _age(path, seconds):
+    modified = time.time() - seconds
+    os.utime(path, (modified, modified))
+
+
+def test_cache_key_changes_with_query_parameters():
+    layer = {"name": "S_XS", "number": 14, "where_clause": "DFIRM_ID LIKE '49%'"}
+
+    key = cache.cache_key("https://fema/MapServer", layer)
+
+    assert key.startswith("S_XS_")
+    assert key == cache.cache_key("https://fema/MapServer", dict(layer))
+    assert key != cache.cache_key("https://other/MapServer", layer)
+    assert key != cache.cache_key("https://fema/MapServer", {**layer, "number": 15})
+    assert key != cache.cache_key("https://fema/MapServer", {**layer, "where_clause": "1=1"})
+    assert key != cache.cache_key("https://fema/MapServer", layer, {"feature_count": 1, "max_oid": 2})
+    assert key == cache.cache_key("https://fema/MapServer", layer, None)
+
+
+def test_write_and_read_round_trip(tmp_path):
+    cache.write(tmp_path, "S_XS_abc", _extract(), ttl=60, max_bytes=1024**3)
+
+    cached = cache.read(tmp_path, "S_XS_abc", ttl=60)
+
+    assert cached.geometry.name == "SHAPE"
+    assert cached.crs.to_epsg() == 4269
+    assert cached["DFIRM_ID"].tolist() == ["49001C", "49001C"]
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_read_passes_read_kwargs_to_read_parquet(tmp_path):
+    cache.write(tmp_path, "S_XS_abc", _extract(), ttl=60, max_bytes=1024**3)
+
+    cached = cache.read(tmp_path, "S_XS_abc", ttl=60, columns=["OBJECTID", "SHAPE"])
+
+    assert cached.columns.tolist() == ["OBJECTID", "SHAPE"]
+
+
+def test_read_misses_and_removes_expired_entry(tmp_path):
+    cache_path = cache.write(tmp_path, "S_XS_abc", _extract(), ttl=60, max_bytes=1024**3)
+    _age(cache_path, 120)
+
+    assert cache.read(tmp_path, "S_XS_abc", ttl=60) is None
+    assert not cache_path.exists()
+
+
+def test_read_misses_on_missing_entry(tmp_path):
+    assert cache.read(tmp_path, "S_XS_abc", ttl=60) is None
+
+
+def test_evict_removes_oldest_entries_until_under_max_bytes(tmp_path):
+    oldest = cache.write(tmp_path, "oldest", _extract(), ttl=60, max_bytes=1024**3)
+    middle = cache.write(tmp_path, "middle", _extract(), ttl=60, max_bytes=1024**3)
+    newest = cache.write(tmp_path, "newest", _extract(), ttl=60, max_bytes=1024**3)
+    _age(oldest, 30)
+    _age(middle, 20)
+
+    evicted = cache.evict(tmp_path, ttl=60, max_bytes=newest.stat().st_size * 2)
+
+    assert evicted == [oldest]
+    assert middle.exists()
+    assert newest.exists()
+
+
+def test_evict_removes_expired_entries(tmp_path):
+    expired = cache.write(tmp_path, "expired", _extract(), ttl=60, max_bytes=1024**3)
+    fresh = cache.write(tmp_path, "fresh", _extract(), ttl=60, max_bytes=1024**3)
+    _age(expired, 120)
+
+    assert cache.evict(tmp_path, ttl=60, max_bytes=1024**3) == [expired]
+    assert fresh.exists()
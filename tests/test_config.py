@@ -0,0 +1,58 @@
+import sqlite3
+
+import pytest
+
+from nfhl import config
+
+
+@pytest.fixture
+def fresh_config(monkeypatch):
+    #: Forget any lazy settings that an earlier test already resolved and cached
+    for name in config._LAZY_SETTINGS:
+        monkeypatch.delitem(vars(config), name, raising=False)
+    config.get_host_name.cache_clear()
+    yield config
+    config.get_host_name.cache_clear()
+
+
+def test_host_name_is_resolved_on_first_access_and_cached(fresh_config, mocker):
+    urlopen_mock = mocker.patch("urllib.request.urlopen", side_effect=OSError("not in GCP"))
+    mocker.patch("nfhl.config.socket.gethostname", return_value="my-machine")
+
+    assert "HOST_NAME" not in vars(fresh_config)
+    assert fresh_config.HOST_NAME == "my-machine"
+    assert fresh_config.SENDGRID_SETTINGS["prefix"] == "nfhl_skid on my-machine: "
+    assert vars(fresh_config)["HOST_NAME"] == "my-machine"
+    urlopen_mock.assert_called_once()
+
+
+def test_host_name_uses_gcp_project_id(fresh_config, mocker):
+    response = mocker.patch("urllib.request.urlopen").return_value.__enter__.return_value
+    response.read.return_value = b"ut-dts-agrc-nfhl-prod"
+
+    assert fresh_config.HOST_NAME == "ut-dts-agrc-nfhl-prod"
+
+
+def test_unknown_setting_raises_attribute_error():
+    with pytest.raises(AttributeError, match="NOT_A_SETTING"):
+        config.NOT_A_SETTING  # noqa: B018
+
+
+def test_dfirm_partitions_split_countywide_and_community_ids():
+    #: Community IDs like 490010 share their first digits with a county's FIPS code but aren't countywide
+    dfirm_ids = ["49001C", "49057C", "490010", "495517", "490570"]
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE layer (DFIRM_ID TEXT)")
+    connection.executemany("INSERT INTO layer VALUES (?)", [(dfirm_id,) for dfirm_id in dfirm_ids + ["56001C"]])
+
+    matches = {
+        partition["name"]: [
+            row[0] for row in connection.execute(f"SELECT DFIRM_ID FROM layer WHERE {partition['where_clause']}")
+        ]
+        for partition in config.DFIRM_PARTITIONS
+    }
+
+    assert matches["49001"] == ["49001C"]
+    assert matches["49057"] == ["49057C"]
+    assert sorted(matches["other"]) == ["490010", "490570", "495517"]
+    assert sorted(dfirm_id for ids in matches.values() for dfirm_id in ids) == sorted(dfirm_ids)
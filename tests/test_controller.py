@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+
+from nfhl import budget, controller
+
+
+@pytest.fixture(autouse=True)
+def _no_sleep(mocker):
+    mocker.patch("nfhl.controller.time.sleep")
+
+
+def _controller(mocker, **settings):
+    return controller.RequestController(mocker.Mock(), **settings)
+
+
+def test_record_increases_limits_after_a_healthy_round(mocker):
+    request_controller = _controller(mocker, concurrency=2, page_size=100, pause=1.0, target_latency=5)
+
+    request_controller.record(1, True)
+    assert request_controller.concurrency == 2
+
+    request_controller.record(1, True)
+
+    assert request_controller.concurrency == 3
+    assert request_controller.page_size == 125
+    assert request_controller.pause == pytest.approx(0.8)
+    assert request_controller.timeout == 10  #: 4x the latency, but no lower than min_timeout
+    assert "Speeding up" in request_controller._logger.info.call_args.args[1]
+
+
+def test_record_does_not_increase_when_latency_is_over_target(mocker):
+    request_controller = _controller(mocker, concurrency=1, target_latency=5, timeout=60)
+
+    request_controller.record(10, True)
+
+    assert request_controller.concurrency == 1
+    assert request_controller.page_size == 100
+
+
+def test_record_backs_off_multiplicatively_on_failure(mocker):
+    request_controller = _controller(mocker, concurrency=8, page_size=400, timeout=20, pause=1.0)
+
+    request_controller.record(1, False)
+
+    assert request_controller.concurrency == 4
+    assert request_controller.page_size == 200
+    assert request_controller.timeout == 30
+    assert request_controller.pause == 2.0
+    assert request_controller.error_rate == pytest.approx(0.2)
+    assert "Backing off after request failed" in request_controller._logger.info.call_args.args[1]
+
+
+def test_record_counts_requests_and_failures(mocker):
+    request_controller = _controller(mocker)
+
+    request_controller.record(1, True)
+    request_controller.record(1, False)
+    request_controller.record(1, True)
+
+    assert request_controller.requests == 3
+    assert request_controller.failed_requests == 1
+
+
+def test_record_backs_off_on_slow_request(mocker):
+    request_controller = _controller(mocker, concurrency=4, timeout=20)
+
+    request_controller.record(19, True)
+
+    assert request_controller.concurrency == 2
+
+
+def test_record_only_backs_off_once_for_a_burst_of_failures(mocker):
+    request_controller = _controller(mocker, concurrency=8)
+
+    for _ in range(4):
+        request_controller.record(1, False)
+
+    assert request_controller.concurrency == 4
+
+
+def test_record_respects_limits(mocker):
+    request_controller = _controller(mocker, concurrency=1, page_size=25, max_timeout=30, timeout=30, max_pause=2)
+
+    request_controller.record(1, False)
+
+    assert request_controller.concurrency == 1
+    assert request_controller.page_size == 25
+    assert request_controller.timeout == 30
+    assert request_controller.pause == 2
+
+
+def test_call_retries_until_success(mocker):
+    request_controller = _controller(mocker, max_tries=4)
+    worker = mocker.Mock(side_effect=[RuntimeError("one"), RuntimeError("two"), 42])
+
+    assert request_controller.call(worker, "arg", key="value") == 42
+    assert worker.call_count == 3
+    worker.assert_called_with("arg", key="value")
+
+
+def test_call_raises_final_error(mocker):
+    request_controller = _controller(mocker, max_tries=2)
+    worker = mocker.Mock(side_effect=[RuntimeError("one"), RuntimeError("two")])
+
+    with pytest.raises(RuntimeError, match="two"):
+        request_controller.call(worker)
+
+
+def test_slot_limits_requests_in_flight(mocker):
+    request_controller = _controller(mocker, concurrency=2, min_concurrency=2, max_concurrency=2)
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def _request():
+        with request_controller.slot():
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.pop()
+
+    threads = [threading.Thread(target=_request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) <= 2
+
+
+def test_call_checks_the_run_budget_before_each_attempt(mocker):
+    run_budget = budget.RunBudget(mocker.Mock(), breaker_threshold=1)
+    request_controller = _controller(mocker, run_budget=run_budget)
+    run_budget.record_layer("one", False)
+    worker = mocker.Mock()
+
+    with pytest.raises(budget.BudgetExhausted):
+        request_controller.call(worker)
+
+    worker.assert_not_called()
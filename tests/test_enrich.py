@@ -0,0 +1,95 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString, Point, box
+
+from nfhl import enrich
+
+
+def _panels():
+    return gpd.GeoDataFrame(
+        {"firm_pan": ["49035C0100G", "49035C0200G"], "SHAPE": [box(0, 0, 1, 1), box(1, 0, 2, 1)]},
+        geometry="SHAPE",
+        crs=4269,
+    )
+
+
+def _zones():
+    return gpd.GeoDataFrame(
+        {
+            "fld_zone": pd.Categorical(["AE", "X"]),
+            "label": ["1% Annual Chance Flood Hazard", ""],
+            "SHAPE": [box(0, 0, 0.5, 1), box(0.5, 0, 2, 1)],
+        },
+        geometry="SHAPE",
+        crs=4269,
+    )
+
+
+def test_representative_points_uses_points_line_midpoints_and_points_inside_polygons():
+    geometries = gpd.GeoSeries([Point(3, 4), LineString([(0, 0), (10, 0)]), box(0, 0, 2, 2), None])
+
+    points = enrich.representative_points(geometries)
+
+    assert points[0].equals(Point(3, 4))
+    assert points[1].equals(Point(5, 0))
+    assert box(0, 0, 2, 2).contains(points[2])
+    assert points[3] is None
+
+
+def test_spatial_lookup_matches_each_point_once_and_misses_with_minus_one():
+    lookup = enrich.SpatialLookup("S_FIRM_Pan", _panels(), ["firm_pan"])
+
+    matches = lookup.match(np.array([Point(0.5, 0.5), Point(1, 0.5), Point(5, 5), None], dtype=object))
+
+    assert len(lookup) == 2
+    assert matches.tolist() == [0, 0, -1, -1]  #: the point on the shared edge goes to the first panel
+
+
+def test_spatial_lookup_take_keeps_dtype_and_fills_misses_with_nulls():
+    lookup = enrich.SpatialLookup("S_Fld_Haz_Ar", _zones(), ["fld_zone"])
+
+    values = lookup.take("fld_zone", np.array([1, -1, 0]), pd.Index([7, 8, 9]))
+
+    assert isinstance(values.dtype, pd.CategoricalDtype)
+    assert values.index.tolist() == [7, 8, 9]
+    assert values[7] == "X"
+    assert pd.isna(values[8])
+    assert values[9] == "AE"
+
+
+def test_enrich_adds_fields_from_each_reference_layer(mocker):
+    lookups = {
+        "S_FIRM_Pan": enrich.SpatialLookup("S_FIRM_Pan", _panels(), ["firm_pan"]),
+        "S_Fld_Haz_Ar": enrich.SpatialLookup("S_Fld_Haz_Ar", _zones(), ["fld_zone", "label"]),
+    }
+    cross_sections = gpd.GeoDataFrame(
+        {
+            "OBJECTID": [1, 2, 3],
+            "SHAPE": [LineString([(0, 0.5), (0.4, 0.5)]), LineString([(1.2, 0.1), (1.8, 0.1)]), Point(9, 9)],
+        },
+        geometry="SHAPE",
+        crs=4269,
+        index=[10, 11, 12],
+    )
+    enrichment = {
+        "S_FIRM_Pan": {"firm_pan": "firm_pan"},
+        "S_Fld_Haz_Ar": {"fld_zone": "fld_zone", "label": "zone_label"},
+    }
+
+    enriched = enrich.enrich(mocker.Mock(), "S_XS", cross_sections, lookups, enrichment)
+
+    assert enriched["firm_pan"].tolist()[:2] == ["49035C0100G", "49035C0200G"]
+    assert enriched["fld_zone"].tolist()[:2] == ["AE", "X"]
+    assert enriched["zone_label"].tolist()[:2] == ["1% Annual Chance Flood Hazard", ""]
+    assert enriched.loc[12, ["firm_pan", "fld_zone", "zone_label"]].isna().all()
+
+
+def test_enrich_reprojects_to_the_reference_layers_crs(mocker):
+    panels = gpd.GeoDataFrame({"firm_pan": ["A"], "SHAPE": [box(-112, 40, -111, 41)]}, geometry="SHAPE", crs=4326)
+    lookups = {"S_FIRM_Pan": enrich.SpatialLookup("S_FIRM_Pan", panels, ["firm_pan"])}
+    lomas = gpd.GeoDataFrame({"SHAPE": [Point(-111.5, 40.5)]}, geometry="SHAPE", crs=4326).to_crs(26912)
+
+    enriched = enrich.enrich(mocker.Mock(), "S_LOMAs", lomas, lookups, {"S_FIRM_Pan": {"firm_pan": "firm_pan"}})
+
+    assert enriched["firm_pan"].tolist() == ["A"]
@@ -0,0 +1,68 @@
+import base64
+import threading
+
+from nfhl import fanout
+
+
+def test_decode_reads_encoded_messages_from_background_and_push_events():
+    data = fanout.encode("run", ["S_XS", "S_FIRM_Pan"], "gs://bucket/results", {"S_XS": {"max_oid": 1}})
+    message = {"data": base64.b64encode(data).decode("ascii"), "attributes": {}}
+
+    expected = {
+        "run_id": "run",
+        "layers": ["S_XS", "S_FIRM_Pan"],
+        "results_dir": "gs://bucket/results",
+        "fingerprints": {"S_XS": {"max_oid": 1}},
+    }
+    assert fanout.decode(message) == expected
+    assert fanout.decode({"message": message, "subscription": "projects/p/subscriptions/s"}) == expected
+
+
+def test_write_result_and_read_results_round_trip_under_the_run(tmp_path):
+    fanout.write_result(tmp_path, "run", ["S_XS", "S_BFE"], {"feature_counts": {"S_XS": 1, "S_BFE": 2}})
+    fanout.write_result(tmp_path, "other_run", ["S_LOMR"], {"feature_counts": {"S_LOMR": 3}})
+
+    results = fanout.read_results(tmp_path, "run")
+
+    assert results == {"S_XS.json": {"feature_counts": {"S_XS": 1, "S_BFE": 2}}}
+    assert not list((tmp_path / "run").glob("*.tmp"))
+
+
+def test_read_results_is_empty_before_any_worker_reports(tmp_path):
+    assert fanout.read_results(tmp_path, "run") == {}
+
+
+def test_wait_for_results_returns_once_every_group_has_reported(tmp_path, mocker):
+    sleep_mock = mocker.patch("nfhl.fanout.time.sleep")
+    sleep_mock.side_effect = lambda seconds: fanout.write_result(tmp_path, "run", ["S_LOMR"], {"worker": 2})
+    fanout.write_result(tmp_path, "run", ["S_XS", "S_BFE"], {"worker": 1})
+
+    results = fanout.wait_for_results(tmp_path, "run", [["S_XS", "S_BFE"], ["S_LOMR"]], poll_seconds=5)
+
+    assert results == {("S_XS", "S_BFE"): {"worker": 1}, ("S_LOMR",): {"worker": 2}}
+    sleep_mock.assert_called_once_with(5)
+
+
+def test_wait_for_results_returns_what_it_has_at_the_timeout(tmp_path):
+    fanout.write_result(tmp_path, "run", ["S_XS"], {"worker": 1})
+
+    results = fanout.wait_for_results(tmp_path, "run", [["S_XS"], ["S_LOMR"]], timeout=0)
+
+    assert results == {("S_XS",): {"worker": 1}}
+
+
+def test_local_queue_delivers_events_to_the_subscriber():
+    delivered = []
+    done = threading.Event()
+
+    def _subscriber(event):
+        delivered.append(fanout.decode(event))
+        done.set()
+
+    queue = fanout.LocalQueue(_subscriber)
+    message_id = queue.publish(fanout.encode("run", ["S_XS"], "results"))
+    done.wait(5)
+    queue.close()
+
+    assert message_id == "1"
+    assert delivered == [{"run_id": "run", "layers": ["S_XS"], "results_dir": "results", "fingerprints": {}}]
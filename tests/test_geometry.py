@@ -0,0 +1,186 @@
+from pathlib import Path
+
+import geopandas as gpd
+import pytest
+import shapely
+from shapely.geometry import LineString, Point, Polygon, box
+
+from nfhl import geometry
+
+#: The edge shared by two adjacent squares, with small wiggles that simplification should remove
+SHARED_EDGE = [(1 + (0.001 if step % 2 else 0), step / 10) for step in range(11)]
+
+
+def _squares():
+    left = Polygon([(0, 0)] + SHARED_EDGE + [(0, 1)])
+    right = Polygon([(2, 0), (2, 1)] + SHARED_EDGE[::-1])
+    return left, right
+
+
+def test_generalize_simplifies_shared_edges_without_gaps_or_overlaps(mocker):
+    geometries = gpd.GeoSeries(_squares(), index=[5, 6], crs=4269, name="SHAPE")
+
+    generalized = geometry.generalize(mocker.Mock(), "S_Fld_Haz_Ar", geometries, simplify_tolerance=0.01)
+
+    assert generalized.index.tolist() == [5, 6]
+    assert generalized.crs.to_epsg() == 4269
+    assert generalized.name == "SHAPE"
+    assert shapely.get_num_coordinates(generalized.values).sum() < shapely.get_num_coordinates(geometries.values).sum()
+    assert generalized.is_valid.all()
+    assert generalized.iloc[0].intersection(generalized.iloc[1]).area == 0
+    assert generalized.union_all().area == geometries.union_all().area
+    assert geometries.iloc[0].equals(_squares()[0])
+
+
+def test_generalize_simplifies_polygons_one_at_a_time_when_they_are_not_the_whole_coverage(mocker):
+    geometries = gpd.GeoSeries(_squares())
+    coverage_simplify = mocker.spy(shapely, "coverage_simplify")
+
+    generalized = geometry.generalize(
+        mocker.Mock(), "S_Fld_Haz_Ar", geometries, simplify_tolerance=0.01, coverage=False
+    )
+
+    coverage_simplify.assert_not_called()
+    assert generalized.iloc[0].equals(Polygon([(0, 0), (1, 0), (1, 1), (0, 1)]))
+    assert generalized.is_valid.all()
+
+
+def test_generalize_simplifies_lines_and_snaps_to_grid(mocker):
+    geometries = gpd.GeoSeries([LineString([(0, 0), (1, 0.0001), (2, 0)]), LineString([(0.123456, 0), (1, 1)])])
+
+    generalized = geometry.generalize(
+        mocker.Mock(), "S_Wtr_Ln", geometries, simplify_tolerance=0.001, xy_precision=0.01
+    )
+
+    assert generalized.iloc[0].equals(LineString([(0, 0), (2, 0)]))
+    assert generalized.iloc[1].coords[0] == (0.12, 0)
+
+
+def test_generalize_nulls_geometries_that_collapse_and_keeps_missing_ones(mocker):
+    module_logger = mocker.Mock()
+    geometries = gpd.GeoSeries([box(0, 0, 0.0001, 0.0001), None, box(0, 0, 1, 1)])
+
+    generalized = geometry.generalize(module_logger, "S_Fld_Haz_Ar", geometries, xy_precision=0.01)
+
+    assert generalized.isna().tolist() == [True, True, False]
+    assert module_logger.info.call_args.args[-1] == 1
+
+
+def test_generalize_leaves_invalid_geometries_alone(mocker):
+    module_logger = mocker.Mock()
+    bow_tie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1), (0, 0)])
+    geometries = gpd.GeoSeries([*_squares(), bow_tie])
+
+    generalized = geometry.generalize(
+        module_logger, "S_Fld_Haz_Ar", geometries, simplify_tolerance=0.01, xy_precision=0.0001
+    )
+
+    assert generalized.iloc[2].equals(bow_tie)
+    assert generalized.iloc[:2].is_valid.all()
+    assert shapely.get_num_coordinates(generalized.values[:2]).sum() < shapely.get_num_coordinates(_squares()).sum()
+    assert "invalid geometries" in module_logger.warning.call_args.args[0]
+
+
+UTAH_BOUNDARY = Path(geometry.__file__).parent / "utah_boundary.geojson"
+
+
+def test_read_boundary_prepares_and_caches_the_bundled_utah_boundary():
+    boundary, crs = geometry.read_boundary(UTAH_BOUNDARY)
+
+    assert shapely.is_prepared(boundary)
+    assert crs.to_epsg() == 4326
+    assert boundary.contains(Point(-111.89, 40.76))  #: Salt Lake City
+    assert geometry.read_boundary(UTAH_BOUNDARY)[0] is boundary
+
+
+def test_read_boundary_queries_an_arcgis_layer_for_geojson(mocker):
+    read_file = mocker.patch(
+        "nfhl.geometry.gpd.read_file", return_value=gpd.GeoDataFrame(geometry=[box(0, 0, 1, 1)], crs=4326)
+    )
+
+    boundary, crs = geometry.read_boundary("https://example.com/arcgis/rest/services/Boundary/FeatureServer/0/")
+
+    assert read_file.call_args.args[0] == (
+        "https://example.com/arcgis/rest/services/Boundary/FeatureServer/0/query"
+        "?where=1%3D1&outFields=*&outSR=4326&f=geojson"
+    )
+    assert boundary.equals(box(0, 0, 1, 1))
+    assert crs.to_epsg() == 4326
+
+
+def test_read_boundary_raises_without_a_polygon(tmp_path):
+    boundary_path = tmp_path / "points.geojson"
+    gpd.GeoDataFrame(geometry=[Point(0, 0)], crs=4326).to_file(boundary_path)
+
+    with pytest.raises(ValueError, match="doesn't have a boundary polygon"):
+        geometry.read_boundary(boundary_path)
+
+
+def test_clip_to_boundary_drops_points_outside_the_state_that_the_where_clause_keeps(mocker):
+    geometries = gpd.GeoSeries(
+        [
+            Point(-111.89, 40.76),  #: Salt Lake City
+            Point(-111.5, 36.97),  #: Arizona, inside LAT_LON_WHERE's box
+            Point(-109.3, 41.5),  #: Wyoming, outside the box
+            None,
+            Point(-113.6, 37.1),  #: St. George
+        ],
+        crs=4269,
+    )
+
+    keep = geometry.clip_to_boundary(mocker.Mock(), "S_LOMAs", geometries, *geometry.read_boundary(UTAH_BOUNDARY))
+
+    assert keep.tolist() == [True, False, False, True, True]
+
+
+def test_clip_to_boundary_keeps_other_geometries_that_intersect_it(mocker):
+    boundary = box(0, 0, 10, 10)
+    shapely.prepare(boundary)
+    geometries = gpd.GeoSeries([box(9, 9, 11, 11), box(20, 20, 21, 21), LineString([(5, 5), (6, 6)])])
+
+    keep = geometry.clip_to_boundary(mocker.Mock(), "S_LOMR", geometries, boundary, None)
+
+    assert keep.tolist() == [True, False, True]
+
+
+def test_clip_to_boundary_reprojects_the_boundary_to_the_geometries_crs(mocker):
+    geometries = gpd.GeoSeries([Point(-111.89, 40.76), Point(-111.5, 36.97)], crs=4326).to_crs(26912)
+
+    keep = geometry.clip_to_boundary(mocker.Mock(), "S_LOMAs", geometries, *geometry.read_boundary(UTAH_BOUNDARY))
+
+    assert keep.tolist() == [True, False]
+
+
+def test_validate_repairs_self_intersecting_polygons_and_flags_unfixable_geometries(mocker):
+    bow_tie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1)])
+    single_point_line = LineString([(0, 0), (0, 0)])
+    geometries = gpd.GeoSeries(
+        [box(0, 0, 1, 1), bow_tie, single_point_line, Point(float("nan"), float("nan")), None],
+        index=[10, 11, 12, 13, 14],
+        crs=4269,
+    )
+    logger = mocker.Mock()
+
+    validated, repaired, unfixable = geometry.validate(logger, "S_Fld_Haz_Ar", geometries)
+
+    assert repaired.tolist() == [False, True, False, False, False]
+    assert unfixable.tolist() == [False, False, True, True, False]
+    assert validated.index.tolist() == [10, 11, 12, 13, 14]
+    assert validated.crs == geometries.crs
+    assert validated[10].equals(box(0, 0, 1, 1))
+    assert validated[11].geom_type == "MultiPolygon"
+    assert validated[11].is_valid
+    assert validated[11].area == 0.5  #: both triangles are kept, not just the one buffer(0) would keep
+    assert validated[12].equals(single_point_line)  #: left as-is for quarantining
+    assert validated[14] is None
+    assert "Self-intersection" in logger.warning.call_args.args[-1]
+
+
+def test_validate_leaves_valid_geometries_alone(mocker):
+    geometries = gpd.GeoSeries([box(0, 0, 1, 1), LineString([(0, 0), (1, 1)])], crs=4269)
+
+    validated, repaired, unfixable = geometry.validate(mocker.Mock(), "S_XS", geometries)
+
+    assert not repaired.any()
+    assert not unfixable.any()
+    assert validated.equals(geometries)
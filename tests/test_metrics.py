@@ -0,0 +1,150 @@
+import json
+import logging
+
+import pandas as pd
+import pytest
+
+from nfhl import metrics
+
+
+def test_stage_records_time_size_attempts_and_peak_memory(mocker, caplog):
+    caplog.set_level("INFO")
+    mocker.patch("nfhl.metrics.peak_memory", return_value=512 * 1024**2)
+    run_metrics = metrics.RunMetrics(logging.getLogger("test"))
+
+    with run_metrics.stage("S_XS", "transform") as stage:
+        stage.counted(lambda: None)()
+        stage.measure(pd.DataFrame({"a": range(10)}))
+
+    assert stage.status == "ok"
+    assert stage.seconds >= 0
+    assert stage.rows == 10
+    assert stage.memory_bytes > 0
+    assert stage.attempts == 1
+    assert stage.peak_rss_bytes == 512 * 1024**2
+    assert "S_XS transform " in caplog.text
+    assert "10 rows" in caplog.text
+    assert "1 attempt (peak" in caplog.text
+    assert "(peak process memory 512.0 MB)" in caplog.text
+
+
+def test_stage_records_error_and_reraises(mocker):
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    with pytest.raises(RuntimeError, match="load failed"), run_metrics.stage("S_XS", "load") as stage:
+        stage.counted(lambda: None)()
+        stage.counted(lambda: None)()
+        raise RuntimeError("load failed")
+
+    assert stage.status == "error"
+    assert stage.seconds is not None
+    assert run_metrics.summary_rows() == [f"S_XS: load {stage.seconds:.1f}s, unknown rows, unknown, 2 attempts (error)"]
+
+
+def test_stage_is_profiled_only_with_a_profiler(mocker):
+    profiler = mocker.MagicMock()
+    profiled_metrics = metrics.RunMetrics(mocker.Mock(), profiler)
+
+    with pytest.raises(RuntimeError, match="load failed"), profiled_metrics.stage("S_XS", "load") as stage:
+        raise RuntimeError("load failed")
+
+    profiler.profile.assert_called_once_with("S_XS", "load")
+    profiler.profile.return_value.__exit__.assert_called_once()
+    assert stage.status == "error"
+    assert metrics.RunMetrics(mocker.Mock()).profiler is None
+
+
+def test_summary_rows_groups_stages_by_layer(mocker):
+    mocker.patch("nfhl.metrics.time.perf_counter", side_effect=[0, 1.5, 0, 2, 0, 3])
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    for layer, stage_name in [("one", "extract"), ("two", "extract"), ("one", "transform")]:
+        with run_metrics.stage(layer, stage_name) as stage:
+            stage.rows = 1234
+            stage.memory_bytes = 2 * 1024**2
+
+    assert run_metrics.summary_rows() == [
+        (
+            "one: extract 1.5s, 1,234 rows, 2.0 MB in memory, 0 attempts; "
+            "transform 3.0s, 1,234 rows, 2.0 MB in memory, 0 attempts"
+        ),
+        "two: extract 2.0s, 1,234 rows, 2.0 MB in memory, 0 attempts",
+    ]
+
+
+def test_stage_counts_are_shown_before_the_status(mocker):
+    mocker.patch("nfhl.metrics.time.perf_counter", side_effect=[0, 0.5])
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    with run_metrics.stage("S_XS", "validate") as stage:
+        stage.rows = 2000
+        stage.counts["repaired"] = 1200
+        stage.counts["dropped"] = 1
+
+    assert str(stage) == "validate 0.5s, 2,000 rows, unknown, 0 attempts, 1,200 repaired, 1 dropped"
+    assert stage.to_dict()["counts"] == {"repaired": 1200, "dropped": 1}
+
+
+def test_stage_from_dict_rebuilds_a_stage_from_to_dict(mocker):
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+    with run_metrics.stage("S_XS", "validate") as stage:
+        stage.measure(pd.DataFrame({"a": range(3)}))
+        stage.counts["repaired"] = 2
+
+    rebuilt = metrics.Stage.from_dict(json.loads(json.dumps(stage.to_dict())))
+
+    assert rebuilt.to_dict() == stage.to_dict()
+    assert str(rebuilt) == str(stage)
+
+
+def test_write_report_includes_run_info_and_stages(mocker, tmp_path):
+    mocker.patch("nfhl.metrics.peak_memory", return_value=1024)
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+    with run_metrics.stage("one", "extract") as stage:
+        stage.measure(pd.DataFrame({"a": [1, 2]}))
+
+    report_path = run_metrics.write_report(tmp_path / "report.json", skid="nfhl_skid", errors=0)
+
+    report = json.loads(report_path.read_text(encoding="utf-8"))
+    assert report["skid"] == "nfhl_skid"
+    assert report["errors"] == 0
+    assert report["peak_rss_bytes"] == 1024
+    assert report["stages"][0]["layer"] == "one"
+    assert report["stages"][0]["stage"] == "extract"
+    assert report["stages"][0]["rows"] == 2
+
+
+def test_write_prometheus_writes_stage_and_run_gauges(mocker, tmp_path):
+    mocker.patch("nfhl.metrics.peak_memory", return_value=None)
+    mocker.patch("nfhl.metrics.time.perf_counter", side_effect=[0, 2.5])
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+    with run_metrics.stage("one", "load") as stage:
+        stage.rows = 5
+    textfile_path = tmp_path / "collector" / "nfhl.prom"
+
+    run_metrics.write_prometheus(textfile_path, "nfhl_skid", duration_seconds=10, errors=1)
+
+    lines = textfile_path.read_text(encoding="utf-8").splitlines()
+    assert "# TYPE nfhl_skid_stage_seconds gauge" in lines
+    assert 'nfhl_skid_stage_seconds{layer="one",stage="load",status="ok"} 2.5' in lines
+    assert 'nfhl_skid_stage_rows{layer="one",stage="load",status="ok"} 5' in lines
+    assert "# TYPE nfhl_skid_stage_memory_bytes gauge" in lines
+    assert not [line for line in lines if line.startswith("nfhl_skid_stage_memory_bytes{")]
+    assert "nfhl_skid_duration_seconds 10.0" in lines
+    assert "nfhl_skid_errors 1.0" in lines
+    assert not [line for line in lines if line.startswith("nfhl_skid_peak_rss_bytes")]
+    assert not list(textfile_path.parent.glob("*.tmp"))
+
+
+def test_peak_memory_is_none_without_resource_module(mocker):
+    mocker.patch("nfhl.metrics.resource", None)
+
+    assert metrics.peak_memory() is None
+
+
+def test_peak_memory_converts_linux_kilobytes_to_bytes(mocker):
+    mocker.patch("nfhl.metrics.sys.platform", "linux")
+    resource_mock = mocker.patch("nfhl.metrics.resource")
+    resource_mock.getrusage.return_value.ru_maxrss = 2048
+
+    assert metrics.peak_memory() == 2048 * 1024
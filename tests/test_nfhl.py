@@ -1,4 +1,55 @@
-from nfhl import main
+import base64
+import json
+import logging
+import threading
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+import shapely
+from shapely.geometry import Point, Polygon, box
+
+from nfhl import budget, fanout, main, metrics
+
+
+def _patch_config(mocker, **settings):
+    #: Patch main's config with the optional stages turned off, overridden by settings
+    defaults = {
+        "SKID_NAME": "foo",
+        "MAX_WORKERS": 1,
+        "STATE_MANIFEST_PATH": None,
+        "EXTRACT_CACHE_DIR": None,
+        "ARROW_DTYPES": False,
+        "REPORT_FILE_NAME": "run_report",
+        "PROMETHEUS_TEXTFILE_PATH": None,
+        "STREAM_BATCH_SIZE": None,
+        "DELTA_SYNC": False,
+        "OUTPUT_SINKS": ["agol"],
+        "ENRICHMENT": False,
+        "GEOMETRY_QUARANTINE_DIR": None,
+        "BLUE_GREEN": False,
+        "RUN_SECONDS": None,
+        "SUMMARY_SECONDS": 60,
+        "RETRY_BUDGET": None,
+        "BREAKER_THRESHOLD": None,
+        "FANOUT_TOPIC": None,
+        "REQUEST_CONTROLLER_SETTINGS": {},
+        "HTTP_POOL_SIZE": 10,
+        "QUERY_FORMAT": "json",
+        "PROFILE": False,
+        "PROFILE_DIR_NAME": "profiles",
+        "PROFILE_TOP_ALLOCATIONS": 5,
+    }
+    defaults.update(settings)
+    return mocker.patch("nfhl.main.config", **defaults)
+
+
+def _patch_validation(mocker):
+    #: The transform is mocked with stand-ins that don't have geometries, so pass them through validation unchanged
+    return mocker.patch(
+        "nfhl.main._validate_geometries",
+        side_effect=lambda module_logger, layer, layer_df, stage: (layer_df, pd.DataFrame()),
+    )
 
 
 def test_get_secrets_from_gcp_location(mocker):
@@ -31,11 +82,14 @@ def test_process_continues_on_one_layer_failure(mocker, caplog):
         _transform_layer=mocker.DEFAULT,
         _load_layer=mocker.DEFAULT,
     )
-    mocker.patch("nfhl.main.arcgis")
-    mocker.patch("nfhl.main.extract")
-    mocker.patch("nfhl.main.config", FEMA_LAYERS={"one": {"name": "one"}, "two": {"name": "two"}}, SKID_NAME="foo")
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    _patch_config(mocker, FEMA_LAYERS={"one": {"name": "one"}, "two": {"name": "two"}})
+    _patch_validation(mocker)
     mocker.patch("palletjack.utils.sleep")
 
+    mocker.patch("nfhl.main.metrics.Stage.measure")
+
     extract_mock = mocker.patch("nfhl.main._extract_layer")
     extract_mock.side_effect = [Exception("one_1"), Exception("one_2"), Exception("one_3"), Exception("one_4"), 42]
 
@@ -59,9 +113,10 @@ def test_process_continues_on_failed_area_hazard_symbology_update(mocker, caplog
         _load_layer=mocker.DEFAULT,
         SimpleNamespace=mocker.DEFAULT,
     )
-    mocker.patch("nfhl.main.arcgis")
-    mocker.patch("nfhl.main.extract")
-    mocker.patch("nfhl.main.config", FEMA_LAYERS={"one": {"name": "one"}, "two": {"name": "two"}}, SKID_NAME="foo")
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    _patch_config(mocker, FEMA_LAYERS={"one": {"name": "one"}, "two": {"name": "two"}})
+    _patch_validation(mocker)
     # mocker.patch('palletjack.utils.sleep')
 
     update_mock = mocker.patch("nfhl.main._update_hazard_layer_symbology")
@@ -74,3 +129,1088 @@ def test_process_continues_on_failed_area_hazard_symbology_update(mocker, caplog
     summary_message = patched["_initialize"].return_value.notify.call_args.args[0]
     assert summary_message.subject == "foo Update Summary (1 error)"
     assert "Errors: 1" in summary_message.message
+
+
+def test_process_isolates_layer_failures_when_running_in_parallel(mocker, caplog):
+    patched = mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        _delete_existing_gdb_item=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    _patch_config(
+        mocker, FEMA_LAYERS={"one": {"name": "one"}, "two": {"name": "two"}, "three": {"name": "three"}}, MAX_WORKERS=3
+    )
+    _patch_validation(mocker)
+    mocker.patch("palletjack.utils.sleep")
+
+    def _extract(module_logger, fema_extractor, layer, tempdir, request_controller):
+        if layer["name"] == "two":
+            raise RuntimeError("two failed")
+        return layer["name"]
+
+    mocker.patch("nfhl.main._extract_layer", side_effect=_extract)
+    mocker.patch("nfhl.main.metrics.Stage.measure")
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    mocker.patch("nfhl.main._load_layer", side_effect=lambda *args: len(args[4]))
+
+    main.process()
+
+    assert "Error loading two" in caplog.text
+    summary_message = patched["_initialize"].return_value.notify.call_args.args[0]
+    assert summary_message.subject == "foo Update Summary (1 error)"
+    assert "one: 3\ntwo: error\nthree: 5" in summary_message.message
+    deleted_items = {call.args[1] for call in patched["_delete_existing_gdb_item"].call_args_list}
+    assert deleted_items == {"palletjack one Temporary gdb upload", "palletjack three Temporary gdb upload"}
+
+
+def test_process_reports_stage_metrics_in_summary_report_and_prometheus_file(mocker, tmp_path):
+    patched = mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        _delete_existing_gdb_item=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    prometheus_path = tmp_path / "textfiles" / "nfhl.prom"
+    _patch_config(mocker, FEMA_LAYERS={"one": {"name": "one"}}, PROMETHEUS_TEXTFILE_PATH=prometheus_path)
+    _patch_validation(mocker)
+    mocker.patch("nfhl.main._extract_layer", return_value=pd.DataFrame({"a": [1, 2, 3]}))
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    mocker.patch("nfhl.main._load_layer", return_value=3)
+    report_spy = mocker.spy(main.metrics.RunMetrics, "write_report")
+
+    main.process()
+
+    summary_message = patched["_initialize"].return_value.notify.call_args.args[0]
+    assert "Stage Metrics:\none: extract " in summary_message.message
+    assert "3 rows" in summary_message.message
+    assert "FEMA requests: 0 (0 failed)" in summary_message.message
+    assert "Invalid geometries: 0 repaired, 0 dropped" in summary_message.message
+    assert summary_message.attachments[1].name.startswith("run_report_")
+    assert report_spy.call_args.kwargs["feature_counts"] == {"one": 3}
+    assert report_spy.call_args.kwargs["errors"] == 0
+    prometheus_text = prometheus_path.read_text(encoding="utf-8")
+    assert 'foo_stage_rows{layer="one",stage="transform",status="ok"} 3' in prometheus_text
+    assert "foo_errors 0.0" in prometheus_text
+    assert "foo_dropped_geometries 0.0" in prometheus_text
+
+
+def test_process_attaches_stage_profiles_when_profiling(mocker):
+    patched = mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        _delete_existing_gdb_item=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    _patch_config(mocker, FEMA_LAYERS={"one": {"name": "one"}})
+    _patch_validation(mocker)
+    mocker.patch("nfhl.main._extract_layer", return_value=pd.DataFrame({"a": [1, 2, 3]}))
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    mocker.patch("nfhl.main._load_layer", return_value=3)
+    profiled = set()
+    patched["_initialize"].return_value.notify.side_effect = lambda message: profiled.update(
+        {path.name for path in message.attachments[1].iterdir()}
+    )
+
+    main.process(profile=True)
+
+    summary_message = patched["_initialize"].return_value.notify.call_args.args[0]
+    assert summary_message.attachments[1].name.startswith("profiles_")
+    assert {"one_extract.pstats", "one_transform.pstats", "one_load_allocations.txt"} <= set(profiled)
+    assert "Profiles: 4 stages profiled, attached as profiles_" in summary_message.message
+
+
+def test_cli_passes_the_profile_flag_to_process(mocker):
+    process_mock = mocker.patch("nfhl.main.process")
+
+    main.cli([])
+    main.cli(["--profile"])
+
+    assert [call.kwargs["profile"] for call in process_mock.call_args_list] == [None, True]
+
+
+def test_delete_existing_gdb_item_ignores_other_layers_items(mocker):
+    this_layer_item = mocker.Mock(title="palletjack one Temporary gdb upload")
+    other_layer_item = mocker.Mock(title="palletjack two Temporary gdb upload")
+    gis = mocker.Mock()
+    gis.content.search.return_value = [other_layer_item, this_layer_item]
+
+    main._delete_existing_gdb_item(gis, "palletjack one Temporary gdb upload", mocker.Mock())
+
+    this_layer_item.delete.assert_called_once()
+    other_layer_item.delete.assert_not_called()
+
+
+def test_load_layer_uses_per_layer_gdb_item_prefix(mocker, tmp_path):
+    updater_mock = mocker.patch("palletjack.load.ServiceUpdater")
+    updater_mock.return_value.truncate_and_load.return_value = 42
+
+    features_loaded = main._load_layer(
+        mocker.Mock(), tmp_path, "gis", {"name": "one", "itemid": "foo"}, pd.DataFrame({"a": [1]})
+    )
+
+    assert features_loaded == 42
+    assert updater_mock.call_args.kwargs["gdb_item_prefix"] == "palletjack one"
+
+
+def test_process_skips_unchanged_layers_and_records_loaded_fingerprints(mocker, tmp_path):
+    patched = mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        _delete_existing_gdb_item=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+        _extract_layer=mocker.DEFAULT,
+        _transform_layer=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text('{"one": {"feature_count": 1}, "two": {"feature_count": 2}}', encoding="utf-8")
+    _patch_config(
+        mocker, FEMA_LAYERS={"one": {"name": "one"}, "two": {"name": "two"}}, STATE_MANIFEST_PATH=manifest_path
+    )
+    _patch_validation(mocker)
+    mocker.patch(
+        "nfhl.main.state.probe_layer",
+        side_effect=lambda url, layer, timeout, skid_version: {"feature_count": 1 if layer["name"] == "one" else 3},
+    )
+    mocker.patch("nfhl.main._load_layer", return_value=3)
+
+    main.process()
+
+    assert patched["_extract_layer"].call_count == 1
+    assert patched["_extract_layer"].call_args.args[2] == {"name": "two"}
+    assert main.state.probe_layer.call_args.args[3] == main.version.__version__
+    summary_message = patched["_initialize"].return_value.notify.call_args.args[0]
+    assert "one: unchanged\ntwo: 3" in summary_message.message
+    assert summary_message.subject == "foo Update Summary"
+    assert json.loads(manifest_path.read_text(encoding="utf-8")) == {
+        "one": {"feature_count": 1},
+        "two": {"feature_count": 3},
+    }
+
+
+def test_process_does_not_record_fingerprint_of_failed_layer(mocker, tmp_path):
+    mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        _delete_existing_gdb_item=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+        _extract_layer=mocker.DEFAULT,
+        _transform_layer=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    mocker.patch("palletjack.utils.sleep")
+    manifest_path = tmp_path / "manifest.json"
+    _patch_config(mocker, FEMA_LAYERS={"one": {"name": "one"}}, STATE_MANIFEST_PATH=manifest_path)
+    mocker.patch("nfhl.main.state.probe_layer", return_value={"feature_count": 1})
+    mocker.patch("nfhl.main._load_layer", side_effect=RuntimeError("load failed"))
+
+    main.process()
+
+    assert json.loads(manifest_path.read_text(encoding="utf-8")) == {}
+
+
+def test_process_fetches_a_cached_layer_again_when_its_fingerprint_changes(mocker, tmp_path):
+    mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        _delete_existing_gdb_item=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+        _transform_layer=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader").return_value.url = "https://fema/MapServer"
+    _patch_config(
+        mocker,
+        FEMA_LAYERS={"one": {"name": "one", "number": 1, "where_clause": "1=1"}},
+        STATE_MANIFEST_PATH=tmp_path / "manifest.json",
+        EXTRACT_CACHE_DIR=tmp_path / "cache",
+        EXTRACT_CACHE_TTL=60,
+        EXTRACT_CACHE_MAX_BYTES=1024**3,
+    )
+    _patch_validation(mocker)
+    mocker.patch("nfhl.main._load_layer", return_value=1)
+    extract_mock = mocker.patch(
+        "nfhl.main._extract_layer",
+        return_value=gpd.GeoDataFrame({"OBJECTID": [1], "SHAPE": [Point(0, 0)]}, geometry="SHAPE", crs=4269),
+    )
+    probe_mock = mocker.patch("nfhl.main.state.probe_layer", return_value={"feature_count": 1})
+
+    main.process()
+    (tmp_path / "manifest.json").unlink()  #: a failed load, or a first run, doesn't leave the layer unchanged
+    main.process()
+
+    assert extract_mock.call_count == 1  #: the second run used the cache
+
+    (tmp_path / "manifest.json").unlink()
+    probe_mock.return_value = {"feature_count": 2}  #: FEMA changed the layer within the cache's TTL
+    main.process()
+
+    assert extract_mock.call_count == 2
+
+
+def test_extract_layer_with_cache_uses_cached_extract(mocker, tmp_path):
+    _patch_config(mocker, EXTRACT_CACHE_DIR=tmp_path, EXTRACT_CACHE_TTL=60, EXTRACT_CACHE_MAX_BYTES=1024**3)
+    mocker.patch("nfhl.main.cache.read", return_value="cached")
+    extract_mock = mocker.patch("nfhl.main._extract_layer")
+    fema_extractor = mocker.Mock(url="https://fema/MapServer")
+
+    layer_df = main._extract_layer_with_cache(
+        mocker.Mock(),
+        fema_extractor,
+        {"name": "one", "number": 1, "where_clause": "1=1"},
+        tmp_path,
+        "controller",
+        metrics.Stage("one", "extract"),
+    )
+
+    assert layer_df == "cached"
+    extract_mock.assert_not_called()
+
+
+def test_extract_layer_with_cache_extracts_and_caches_on_miss(mocker, tmp_path):
+    _patch_config(mocker, EXTRACT_CACHE_DIR=tmp_path, EXTRACT_CACHE_TTL=60, EXTRACT_CACHE_MAX_BYTES=1024**3)
+    mocker.patch("nfhl.main.cache.read", return_value=None)
+    write_mock = mocker.patch("nfhl.main.cache.write", side_effect=OSError("disk full"))
+    mocker.patch("nfhl.main._extract_layer", return_value="extracted")
+    fema_extractor = mocker.Mock(url="https://fema/MapServer")
+    stage = metrics.Stage("one", "extract")
+
+    layer_df = main._extract_layer_with_cache(
+        mocker.Mock(),
+        fema_extractor,
+        {"name": "one", "number": 1, "where_clause": "1=1"},
+        tmp_path,
+        "controller",
+        stage,
+    )
+
+    assert layer_df == "extracted"
+    assert stage.attempts == 1
+    assert write_mock.call_args.args[2] == "extracted"
+
+
+def test_hazard_areas_labels_from_zone_and_subtype():
+    hazard_areas_df = pd.DataFrame(
+        {
+            "FLD_ZONE": ["A", "AE", "AE", "D", "X", "X", "X", "AREA NOT INCLUDED", "AE", "X"],
+            "ZONE_SUBTY": [
+                None,
+                None,
+                "FLOODWAY",
+                "ANYTHING",
+                "1 PCT DEPTH LESS THAN 1 FOOT",
+                "AREA WITH REDUCED FLOOD RISK DUE TO LEVEE",
+                None,
+                None,
+                "",
+                "AREA OF MINIMAL FLOOD HAZARD",
+            ],
+            "name": ["foo", None, "bar", None, None, None, None, None, None, None],
+        }
+    ).astype({"FLD_ZONE": "string", "ZONE_SUBTY": "string", "name": "string"})
+
+    hazard_areas_df = main._hazard_areas(hazard_areas_df)
+
+    assert hazard_areas_df["label"].dtype == "category"
+    assert hazard_areas_df["label"].tolist() == [
+        "1% Annual Chance Flood Hazard",
+        "1% Annual Chance Flood Hazard",
+        "Regulatory Floodway",
+        "Area of Undetermined Flood Hazard",
+        "0.2% Annual Chance Flood Hazard",
+        "Area with Reduced Flood Risk due to Levee",
+        "",
+        "Area Not Included",
+        "",
+        "",
+    ]
+    assert hazard_areas_df["name"].tolist() == ["foo", "", "bar", "", "", "", "", "", "", ""]
+
+
+def test_hazard_areas_labels_arrow_backed_categoricals():
+    hazard_areas_df = pd.DataFrame(
+        {
+            "FLD_ZONE": ["AE", "AE", "X"],
+            "ZONE_SUBTY": [None, "FLOODWAY", "AREA WITH REDUCED FLOOD RISK DUE TO LEVEE"],
+            "DFIRM_ID": ["49035C", None, "49035C"],
+        }
+    )
+    hazard_areas_df = main._compact_dtypes({"category_fields": ["fld_zone", "zone_subty"]}, hazard_areas_df)
+
+    hazard_areas_df = main._hazard_areas(hazard_areas_df)
+
+    assert hazard_areas_df["label"].tolist() == [
+        "1% Annual Chance Flood Hazard",
+        "Regulatory Floodway",
+        "Area with Reduced Flood Risk due to Levee",
+    ]
+    assert hazard_areas_df["ZONE_SUBTY"].tolist() == ["", "FLOODWAY", "AREA WITH REDUCED FLOOD RISK DUE TO LEVEE"]
+    assert hazard_areas_df["DFIRM_ID"].tolist() == ["49035C", "", "49035C"]
+
+
+def test_compact_dtypes_uses_arrow_strings_and_categories_for_category_fields():
+    layer_df = pd.DataFrame(
+        {
+            "FLD_ZONE": ["AE", "X", None],
+            "DFIRM_ID": ["49035C", "49049C", None],
+            "MIXED": ["a", 1, None],
+            "DEPTH": [1.0, 2.0, None],
+        }
+    )
+
+    layer_df = main._compact_dtypes({"category_fields": ["fld_zone"]}, layer_df)
+
+    assert isinstance(layer_df["FLD_ZONE"].dtype, pd.CategoricalDtype)
+    assert layer_df["FLD_ZONE"].cat.categories.dtype == pd.StringDtype("pyarrow")
+    assert layer_df["DFIRM_ID"].dtype == pd.StringDtype("pyarrow")
+    assert layer_df["MIXED"].dtype == object
+    assert layer_df["DEPTH"].dtype == "float64"
+
+
+def test_prepare_for_load_converts_arrow_backed_categoricals_to_arrow_strings():
+    layer_df = pd.DataFrame({"fld_zone": pd.array(["AE", "X", "AE"], dtype="string[pyarrow]").astype("category")})
+
+    layer_df = main._prepare_for_load(layer_df)
+
+    assert layer_df["fld_zone"].dtype == pd.StringDtype("pyarrow")
+    assert str(layer_df["fld_zone"].dtype) == "string"
+
+
+def test_prepare_for_load_converts_categoricals_to_strings():
+    layer_df = pd.DataFrame({"label": pd.Categorical(["a", "", "a"]), "number": [1, 2, 3]})
+
+    layer_df = main._prepare_for_load(layer_df)
+
+    assert layer_df["label"].dtype == object
+    assert layer_df["label"].tolist() == ["a", "", "a"]
+    assert layer_df["number"].dtype == "int64"
+
+
+def test_transform_layer_generalizes_geometries_and_drops_collapsed_ones(mocker):
+    layer_df = gpd.GeoDataFrame(
+        {"OBJECTID": [1, 2], "SHAPE": [box(0, 0, 0.0001, 0.0001), box(0.123, 0, 1, 1)]}, geometry="SHAPE", crs=4269
+    )
+    layer = {"name": "S_Wtr_Ln", "simplify_tolerance": 0.001, "xy_precision": 0.01}
+
+    layer_df = main._transform_layer(mocker.Mock(), layer, layer_df)
+
+    assert layer_df["OBJECTID"].tolist() == [2]
+    assert layer_df["SHAPE"].iloc[0].bounds == (0.12, 0, 1, 1)
+
+
+def test_transform_layer_leaves_the_extract_as_it_was_for_a_retry(mocker):
+    layer_df = gpd.GeoDataFrame(
+        {"OBJECTID": [1], "DFIRM_ID": ["49011C"], "GLOBALID": ["a"], "SHAPE": [box(0, 0, 1, 1)]},
+        geometry="SHAPE",
+        crs=4269,
+    )
+    layer = {"name": "S_Wtr_Ln", "xy_precision": 0.01}
+
+    main._transform_layer(mocker.Mock(), layer, layer_df)
+    retried_df = main._transform_layer(mocker.Mock(), layer, layer_df)
+
+    assert layer_df.columns.tolist() == ["OBJECTID", "DFIRM_ID", "GLOBALID", "SHAPE"]
+    assert retried_df.columns.tolist() == ["OBJECTID", "dfirm_id", "global_id", "SHAPE"]
+
+
+def test_transform_layer_clips_layers_to_the_bundled_boundary(mocker):
+    _patch_config(mocker, CLIP_BOUNDARY_PATH=None)
+    layer_df = gpd.GeoDataFrame(
+        {"OBJECTID": [1, 2, 3], "SHAPE": [Point(-111.89, 40.76), Point(-111.5, 36.97), Point(-113.6, 37.1)]},
+        geometry="SHAPE",
+        crs=4269,
+    )
+    layer = {"name": "S_LOMAs", "clip_to_boundary": True}
+
+    layer_df = main._transform_layer(mocker.Mock(), layer, layer_df)
+
+    assert layer_df["OBJECTID"].tolist() == [1, 3]
+
+
+def test_transform_layer_clips_to_the_bundled_boundary_when_the_configured_one_cannot_be_read(mocker, tmp_path):
+    _patch_config(mocker, CLIP_BOUNDARY_PATH=str(tmp_path / "missing.geojson"))
+    module_logger = mocker.Mock()
+    layer_df = gpd.GeoDataFrame(
+        {"OBJECTID": [1, 2], "SHAPE": [Point(-111.89, 40.76), Point(-111.5, 36.97)]}, geometry="SHAPE", crs=4269
+    )
+    layer = {"name": "S_LOMAs", "clip_to_boundary": True}
+
+    layer_df = main._transform_layer(module_logger, layer, layer_df)
+
+    assert layer_df["OBJECTID"].tolist() == [1]
+    assert "Couldn't read the clip boundary" in module_logger.warning.call_args.args[0]
+
+
+def test_stream_layer_truncates_with_first_batch_and_appends_the_rest(mocker, tmp_path):
+    _patch_config(mocker, STREAM_BATCH_SIZE=2)
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    mocker.patch("nfhl.main.query.ServiceLayer")
+    batches = [
+        gpd.GeoDataFrame({"OBJECTID": [1, 2], "SHAPE": [box(0, 0, 1, 1)] * 2}, geometry="SHAPE", crs=4269),
+        gpd.GeoDataFrame({"OBJECTID": [3], "SHAPE": [None]}, geometry="SHAPE", crs=4269),
+        gpd.GeoDataFrame({"OBJECTID": [4], "SHAPE": [box(0, 0, 1, 1)]}, geometry="SHAPE", crs=4269),
+    ]
+    iter_mock = mocker.patch("nfhl.main.paging.iter_features", return_value=iter(batches))
+    updater_mock = mocker.patch("palletjack.load.ServiceUpdater")
+    updater_mock.return_value.truncate_and_load.return_value = 2
+    updater_mock.return_value.add.return_value = 1
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+    layer = {"name": "one", "itemid": "foo", "number": 1, "where_clause": "1=1", "partitions": ["partition"]}
+
+    features_loaded = main._stream_layer(
+        mocker.Mock(), tmp_path, "gis", mocker.Mock(url="https://fema"), mocker.Mock(), run_metrics, layer
+    )
+
+    assert features_loaded == 3
+    assert iter_mock.call_args.args[3] == 2
+    assert iter_mock.call_args.kwargs["partitions"] == ["partition"]
+    assert updater_mock.return_value.truncate_and_load.call_count == 1
+    assert updater_mock.return_value.truncate_and_load.call_args.args[0]["OBJECTID"].tolist() == [1, 2]
+    assert updater_mock.return_value.add.call_args.args[0]["OBJECTID"].tolist() == [4]
+    assert [call.kwargs["working_dir"].name for call in updater_mock.call_args_list] == ["batch_00000", "batch_00001"]
+    assert not list((tmp_path / "one").iterdir())
+    assert run_metrics.stages[0].name == "stream"
+    assert run_metrics.stages[0].rows == 3
+    assert run_metrics.stages[0].attempts == 2
+
+
+def test_stream_layer_does_not_simplify_batches_as_a_coverage(mocker, tmp_path):
+    _patch_config(mocker, STREAM_BATCH_SIZE=2)
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    mocker.patch("nfhl.main.query.ServiceLayer")
+    batch = gpd.GeoDataFrame(
+        {"OBJECTID": [1, 2], "SHAPE": [box(0, 0, 1, 1), box(1, 0, 2, 1)]}, geometry="SHAPE", crs=4269
+    )
+    mocker.patch("nfhl.main.paging.iter_features", return_value=iter([batch]))
+    mocker.patch("palletjack.load.ServiceUpdater").return_value.truncate_and_load.return_value = 2
+    generalize = mocker.spy(main.geometry, "generalize")
+    layer = {"name": "one", "itemid": "foo", "number": 1, "where_clause": "1=1", "simplify_tolerance": 0.01}
+
+    main._stream_layer(
+        mocker.Mock(),
+        tmp_path,
+        "gis",
+        mocker.Mock(url="https://fema"),
+        mocker.Mock(),
+        metrics.RunMetrics(mocker.Mock()),
+        layer,
+    )
+
+    assert generalize.call_args.kwargs["coverage"] is False
+
+
+def test_process_layer_repairs_invalid_geometries_and_quarantines_unfixable_ones(mocker, tmp_path):
+    _patch_config(mocker, GEOMETRY_QUARANTINE_DIR=str(tmp_path / "quarantine"))
+    layer_df = gpd.GeoDataFrame(
+        {
+            "OBJECTID": [1, 2, 3],
+            "SHAPE": [box(0, 0, 1, 1), Polygon([(0, 0), (1, 1), (1, 0), (0, 1)]), Polygon([(0, 0), (1, 0), (2, 0)])],
+        },
+        geometry="SHAPE",
+        crs=4269,
+    )
+    mocker.patch("nfhl.main._extract_layer_with_cache", return_value=layer_df)
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    load_mock = mocker.patch("nfhl.main._load_layer", return_value=2)
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    main._process_layer(mocker.Mock(), tmp_path, "gis", "fema", "controller", run_metrics, {"name": "S_Fld_Haz_Ar"})
+
+    loaded_df = load_mock.call_args.args[4]
+    assert loaded_df["OBJECTID"].tolist() == [1, 2]
+    assert loaded_df.geometry.is_valid.all()
+    validate_stage = run_metrics.stages[1]
+    assert validate_stage.name == "validate"
+    assert validate_stage.counts == {"repaired": 1, "dropped": 1}
+    assert validate_stage.rows == 2
+    quarantined_df = gpd.read_parquet(tmp_path / "quarantine" / "S_Fld_Haz_Ar_quarantine.parquet")
+    assert quarantined_df["OBJECTID"].tolist() == [3]
+
+
+def test_process_layer_repairs_invalid_geometries_before_generalizing_them(mocker, tmp_path):
+    _patch_config(mocker)
+    bow_tie = Polygon([(0, 0), (1.00012, 1.00012), (1.00012, 0), (0, 1.00012)])
+    layer_df = gpd.GeoDataFrame({"OBJECTID": [1, 2], "SHAPE": [box(2, 0, 3, 1), bow_tie]}, geometry="SHAPE", crs=4269)
+    mocker.patch("nfhl.main._extract_layer_with_cache", return_value=layer_df)
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    load_mock = mocker.patch("nfhl.main._load_layer", return_value=2)
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+    layer = {"name": "one", "simplify_tolerance": 0.001, "xy_precision": 0.001}
+
+    main._process_layer(mocker.Mock(), tmp_path, "gis", "fema", "controller", run_metrics, layer)
+
+    loaded_df = load_mock.call_args.args[4]
+    assert loaded_df.geometry.is_valid.all()
+    assert loaded_df["SHAPE"].iloc[1].geom_type == "MultiPolygon"
+    assert set(shapely.get_coordinates(loaded_df["SHAPE"].iloc[1]).ravel()) == {0, 0.5, 1}  #: snapped to the grid
+    assert [stage.name for stage in run_metrics.stages] == ["extract", "validate", "transform", "load"]
+    assert run_metrics.stages[1].counts == {"repaired": 1, "dropped": 0}
+
+
+def test_stream_layer_drops_unfixable_geometries_from_each_batch(mocker, tmp_path):
+    _patch_config(mocker, STREAM_BATCH_SIZE=2, GEOMETRY_QUARANTINE_DIR=str(tmp_path / "quarantine"))
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    mocker.patch("nfhl.main.query.ServiceLayer")
+    collapsed = Polygon([(0, 0), (1, 0), (2, 0)])
+    batches = [
+        gpd.GeoDataFrame({"OBJECTID": [1, 2], "SHAPE": [box(0, 0, 1, 1), collapsed]}, geometry="SHAPE", crs=4269),
+        gpd.GeoDataFrame({"OBJECTID": [3], "SHAPE": [collapsed]}, geometry="SHAPE", crs=4269),
+    ]
+    mocker.patch("nfhl.main.paging.iter_features", return_value=iter(batches))
+    updater_mock = mocker.patch("palletjack.load.ServiceUpdater")
+    updater_mock.return_value.truncate_and_load.return_value = 1
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+    layer = {"name": "one", "itemid": "foo", "number": 1, "where_clause": "1=1"}
+
+    features_loaded = main._stream_layer(
+        mocker.Mock(), tmp_path, "gis", mocker.Mock(url="https://fema"), mocker.Mock(), run_metrics, layer
+    )
+
+    assert features_loaded == 1
+    updater_mock.return_value.add.assert_not_called()
+    assert run_metrics.stages[0].counts == {"repaired": 0, "dropped": 2}
+    quarantined_df = gpd.read_parquet(tmp_path / "quarantine" / "one_quarantine.parquet")
+    assert quarantined_df["OBJECTID"].tolist() == [2, 3]
+
+
+BLUE_GREEN_LAYER = {"name": "S_XS", "itemid": "view", "source_itemids": ["blue", "green"]}
+
+
+def _patch_blue_green_load(mocker, hosted_count):
+    _patch_config(mocker, BLUE_GREEN=True)
+    layer_df = gpd.GeoDataFrame({"OBJECTID": [1, 2], "SHAPE": [box(0, 0, 1, 1)] * 2}, geometry="SHAPE", crs=4269)
+    mocker.patch("nfhl.main._extract_layer_with_cache", return_value=layer_df)
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    mocker.patch("palletjack.utils.sleep")
+    mocker.patch("nfhl.main.bluegreen.find_standby", return_value=("green", "blue"))
+    mocker.patch("nfhl.main.bluegreen.hosted_count", return_value=hosted_count)
+    return mocker.patch("nfhl.main.bluegreen.switch_view"), mocker.patch("nfhl.main._load_layer", return_value=2)
+
+
+def test_process_layer_loads_blue_green_layers_into_the_standby_and_switches_the_view(mocker):
+    switch_mock, load_mock = _patch_blue_green_load(mocker, hosted_count=2)
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    features_loaded = main._process_layer(
+        mocker.Mock(), "tempdir", "gis", "fema", "controller", run_metrics, BLUE_GREEN_LAYER
+    )
+
+    assert features_loaded == 2
+    assert load_mock.call_args.args[3]["itemid"] == "green"
+    switch_mock.assert_called_once_with("gis", "view", "green")
+    assert [stage.name for stage in run_metrics.stages][-2:] == ["load", "switch"]
+    assert BLUE_GREEN_LAYER["itemid"] == "view"
+
+
+def test_process_layer_leaves_the_view_alone_when_the_standby_count_is_off(mocker):
+    switch_mock, _ = _patch_blue_green_load(mocker, hosted_count=1)
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    with pytest.raises(ValueError, match="Standby green has 1 features instead of 2, leaving S_XS's view as it was"):
+        main._process_layer(mocker.Mock(), "tempdir", "gis", "fema", "controller", run_metrics, BLUE_GREEN_LAYER)
+
+    switch_mock.assert_not_called()
+    assert run_metrics.stages[-1].status == "error"
+
+
+def test_process_layer_loads_in_place_when_blue_green_is_off(mocker):
+    switch_mock, load_mock = _patch_blue_green_load(mocker, hosted_count=2)
+    _patch_config(mocker, BLUE_GREEN=False)
+
+    main._process_layer(
+        mocker.Mock(), "tempdir", "gis", "fema", "controller", metrics.RunMetrics(mocker.Mock()), BLUE_GREEN_LAYER
+    )
+
+    assert load_mock.call_args.args[3]["itemid"] == "view"
+    switch_mock.assert_not_called()
+
+
+def test_stream_layer_streams_blue_green_layers_into_the_standby_and_switches_the_view(mocker, tmp_path):
+    _patch_config(mocker, STREAM_BATCH_SIZE=2, BLUE_GREEN=True)
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    mocker.patch("nfhl.main.query.ServiceLayer")
+    batches = [
+        gpd.GeoDataFrame({"OBJECTID": [1, 2], "SHAPE": [box(0, 0, 1, 1)] * 2}, geometry="SHAPE", crs=4269),
+        gpd.GeoDataFrame({"OBJECTID": [3], "SHAPE": [box(0, 0, 1, 1)]}, geometry="SHAPE", crs=4269),
+    ]
+    mocker.patch("nfhl.main.paging.iter_features", return_value=iter(batches))
+    load_mock = mocker.patch("nfhl.main._load_batch", side_effect=lambda *args: len(args[4]))
+    mocker.patch("nfhl.main.bluegreen.find_standby", return_value=("blue", "green"))
+    mocker.patch("nfhl.main.bluegreen.hosted_count", return_value=3)
+    switch_mock = mocker.patch("nfhl.main.bluegreen.switch_view")
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    layer = {**BLUE_GREEN_LAYER, "number": 1, "where_clause": "1=1"}
+
+    features_loaded = main._stream_layer(
+        mocker.Mock(), tmp_path, "gis", mocker.Mock(url="https://fema"), mocker.Mock(), run_metrics, layer
+    )
+
+    assert features_loaded == 3
+    assert {call.args[3]["itemid"] for call in load_mock.call_args_list} == {"blue"}
+    switch_mock.assert_called_once_with("gis", "view", "blue")
+
+
+def test_process_raises_on_blue_green_layer_without_two_sources(mocker):
+    _patch_config(
+        mocker, BLUE_GREEN=True, FEMA_LAYERS={"S_XS": {**BLUE_GREEN_LAYER, "source_itemids": ["view", "blue"]}}
+    )
+
+    with pytest.raises(ValueError, match="S_XS needs two different source_itemids"):
+        main.process()
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [{"DELTA_SYNC": True}, {"OUTPUT_SINKS": ["vector_tiles"]}],
+    ids=["delta_sync", "no_agol"],
+)
+def test_process_layer_streams_when_batch_size_is_set_unless_delta_syncing_or_not_loading(mocker, settings):
+    stream_mock = mocker.patch("nfhl.main._stream_layer", return_value=5)
+    extract_mock = mocker.patch("nfhl.main._extract_layer_with_cache", side_effect=RuntimeError("not streamed"))
+
+    _patch_config(mocker, STREAM_BATCH_SIZE=1000)
+    assert main._process_layer("logger", "tempdir", "gis", "fema", "controller", "metrics", {"name": "one"}) == 5
+
+    _patch_config(mocker, STREAM_BATCH_SIZE=1000, **settings)
+    with pytest.raises(RuntimeError, match="not streamed"):
+        main._process_layer(
+            mocker.Mock(), "tempdir", "gis", "fema", "controller", metrics.RunMetrics(mocker.Mock()), {"name": "one"}
+        )
+    assert stream_mock.call_count == 1
+    extract_mock.assert_called_once()
+
+
+def test_process_layer_writes_file_outputs_before_loading(mocker, tmp_path):
+    _patch_config(
+        mocker,
+        OUTPUT_SINKS=["geoparquet", "vector_tiles", "agol"],
+        GEOPARQUET_OUTPUT_DIR=str(tmp_path / "archive"),
+        VECTOR_TILE_OUTPUT_DIR=str(tmp_path / "tiles"),
+        VECTOR_TILE_FORMAT="pmtiles",
+        VECTOR_TILE_BASE_URL="https://tiles.example.com/nfhl/",
+        STREAM_BATCH_SIZE=1000,
+    )
+    layer_df = gpd.GeoDataFrame(
+        {"fld_zone": ["AE"], "label": ["1% Annual Chance Flood Hazard"], "SHAPE": [box(-112, 40, -111.99, 40.01)]},
+        geometry="SHAPE",
+        crs=4269,
+    )
+    stream_mock = mocker.patch("nfhl.main._stream_layer")
+    mocker.patch("nfhl.main._extract_layer_with_cache", return_value=layer_df)
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    load_mock = mocker.patch("nfhl.main._load_layer", return_value=1)
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+    layer = {"name": "S_Fld_Haz_Ar", "vector_tiles": {"fields": ["label"], "min_zoom": 4, "max_zoom": 8}}
+
+    features_loaded = main._process_layer(mocker.Mock(), tmp_path, "gis", "fema", "controller", run_metrics, layer)
+
+    assert features_loaded == 1
+    stream_mock.assert_not_called()
+    load_mock.assert_called_once()
+    assert [stage.name for stage in run_metrics.stages] == [
+        "extract",
+        "validate",
+        "transform",
+        "geoparquet",
+        "vector_tiles",
+        "load",
+    ]
+    assert (tmp_path / "archive" / "S_Fld_Haz_Ar.parquet").exists()
+    assert (tmp_path / "tiles" / "S_Fld_Haz_Ar.pmtiles").exists()
+    style = json.loads((tmp_path / "tiles" / "S_Fld_Haz_Ar.style.json").read_text())
+    assert style["sources"]["S_Fld_Haz_Ar"]["url"] == "pmtiles://https://tiles.example.com/nfhl/S_Fld_Haz_Ar.pmtiles"
+
+
+def test_process_layer_only_tiles_layers_with_tile_settings_and_skips_agol_when_not_a_sink(mocker, tmp_path):
+    _patch_config(mocker, OUTPUT_SINKS=["vector_tiles"], VECTOR_TILE_OUTPUT_DIR=str(tmp_path / "tiles"))
+    _patch_validation(mocker)
+    mocker.patch("nfhl.main._extract_layer_with_cache", return_value=pd.DataFrame({"OBJECTID": [1, 2]}))
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    load_mock = mocker.patch("nfhl.main._load_layer")
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    features_loaded = main._process_layer(
+        mocker.Mock(), tmp_path, None, "fema", "controller", run_metrics, {"name": "S_XS"}
+    )
+
+    assert features_loaded == 2
+    load_mock.assert_not_called()
+    assert [stage.name for stage in run_metrics.stages] == ["extract", "validate", "transform"]
+
+
+def test_process_counts_failed_file_outputs_as_errors_without_failing_the_load(mocker, caplog):
+    patched = mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        _delete_existing_gdb_item=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    mocker.patch("palletjack.utils.sleep")
+    _patch_config(mocker, FEMA_LAYERS={"one": {"name": "one"}}, OUTPUT_SINKS=["agol", "geoparquet"])
+    _patch_validation(mocker)
+    mocker.patch("nfhl.main._extract_layer", return_value=pd.DataFrame({"OBJECTID": [1, 2]}))
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    mocker.patch("nfhl.main._load_layer", return_value=2)
+    mocker.patch("nfhl.main.sinks.write_geoparquet", side_effect=OSError("bucket unavailable"))
+
+    main.process()
+
+    assert "Error writing one to geoparquet" in caplog.text
+    summary_message = patched["_initialize"].return_value.notify.call_args.args[0]
+    assert summary_message.subject == "foo Update Summary (1 error)"
+    assert "one: 2\n" in summary_message.message
+    assert "geoparquet" in summary_message.message and "(error)" in summary_message.message
+
+
+def test_process_raises_on_unknown_output_sink(mocker):
+    _patch_config(mocker, OUTPUT_SINKS=["agol", "shapefile"])
+
+    with pytest.raises(ValueError, match="Unknown output sinks \\['shapefile'\\]"):
+        main.process()
+
+
+@pytest.mark.parametrize(
+    "sink, output_dir",
+    [("geoparquet", "GEOPARQUET_OUTPUT_DIR"), ("vector_tiles", "VECTOR_TILE_OUTPUT_DIR")],
+)
+def test_process_raises_on_file_sink_without_an_output_dir(mocker, sink, output_dir):
+    _patch_config(mocker, OUTPUT_SINKS=["agol", sink], **{output_dir: None})
+
+    with pytest.raises(ValueError, match=f"{output_dir} must be set to use the {sink} sink"):
+        main.process()
+
+
+ENRICHED_LAYERS = {
+    "lomas": {"name": "lomas", "enrich": {"panels": {"firm_pan": "firm_pan"}}},
+    "panels": {"name": "panels"},
+}
+
+
+def _enrichment_extract(module_logger, fema_extractor, layer, tempdir, request_controller):
+    if layer["name"] == "panels":
+        return gpd.GeoDataFrame({"firm_pan": ["P1"], "SHAPE": [box(0, 0, 1, 1)]}, geometry="SHAPE", crs=4269)
+    return gpd.GeoDataFrame({"OBJECTID": [1, 2], "SHAPE": [Point(0.5, 0.5), Point(5, 5)]}, geometry="SHAPE", crs=4269)
+
+
+def _patch_enrichment_stages(mocker, **settings):
+    _patch_config(mocker, FEMA_LAYERS=ENRICHED_LAYERS, ENRICHMENT=True, **settings)
+    mocker.patch("nfhl.main._extract_layer", side_effect=_enrichment_extract)
+    mocker.patch("nfhl.main._transform_layer", side_effect=lambda module_logger, layer, layer_df: layer_df)
+    mocker.patch("nfhl.main._delete_existing_gdb_item")
+    mocker.patch("palletjack.utils.sleep")
+    return mocker.patch("nfhl.main._load_layer", side_effect=lambda *args: len(args[4]))
+
+
+def test_process_layers_enriches_a_layer_listed_before_the_layer_it_needs_with_one_worker(mocker):
+    load_mock = _patch_enrichment_stages(mocker, MAX_WORKERS=1)
+    run_metrics = metrics.RunMetrics(mocker.Mock())
+
+    feature_counts = main._process_layers(mocker.Mock(), "tempdir", "gis", "fema", "controller", run_metrics)
+
+    assert feature_counts == {"lomas": 2, "panels": 1}
+    assert list(feature_counts) == ["lomas", "panels"]
+    loaded = {call.args[3]["name"]: call.args[4] for call in load_mock.call_args_list}
+    assert loaded["lomas"]["firm_pan"].tolist()[0] == "P1"
+    assert pd.isna(loaded["lomas"]["firm_pan"].tolist()[1])
+    assert "firm_pan" in loaded["panels"].columns
+    stages = [(stage.layer, stage.name) for stage in run_metrics.stages]
+    assert stages.index(("panels", "index")) < stages.index(("lomas", "enrich"))
+
+
+def test_process_layers_fails_enriched_layer_when_the_layer_it_needs_fails(mocker, caplog):
+    _patch_enrichment_stages(mocker, MAX_WORKERS=2)
+
+    def _extract(module_logger, fema_extractor, layer, tempdir, request_controller):
+        if layer["name"] == "panels":
+            raise RuntimeError("panels failed")
+        return _enrichment_extract(module_logger, fema_extractor, layer, tempdir, request_controller)
+
+    mocker.patch("nfhl.main._extract_layer", side_effect=_extract)
+
+    feature_counts = main._process_layers(
+        logging.getLogger("foo"), "tempdir", "gis", "fema", "controller", metrics.RunMetrics(mocker.Mock())
+    )
+
+    assert feature_counts == {"lomas": "error", "panels": "error"}
+    assert "panels could not be indexed for enrichment" in caplog.text
+
+
+def test_process_layers_loads_the_layer_it_needs_even_if_indexing_it_fails(mocker):
+    _patch_enrichment_stages(mocker)
+    mocker.patch("nfhl.main.enrich.SpatialLookup", side_effect=KeyError("firm_pan"))
+
+    feature_counts = main._process_layers(
+        mocker.Mock(), "tempdir", "gis", "fema", "controller", metrics.RunMetrics(mocker.Mock())
+    )
+
+    assert feature_counts == {"lomas": "error", "panels": 1}
+
+
+@pytest.mark.parametrize(
+    "changed, expected",
+    [
+        ([], {"lomas": "unchanged", "panels": "unchanged"}),
+        (["panels"], {"lomas": 2, "panels": 1}),
+        (["lomas"], {"lomas": 2, "panels": 1}),
+    ],
+    ids=["neither", "reference", "enriched"],
+)
+def test_process_layers_reloads_enriched_layers_and_their_references_together(mocker, tmp_path, changed, expected):
+    _patch_enrichment_stages(mocker, STATE_MANIFEST_PATH=tmp_path / "manifest.json")
+    mocker.patch("nfhl.main.state.load_manifest", return_value={"lomas": {"count": 1}, "panels": {"count": 1}})
+    mocker.patch("nfhl.main.state.save_manifest")
+    mocker.patch(
+        "nfhl.main._probe_layers",
+        return_value={name: {"count": 2 if name in changed else 1} for name in ENRICHED_LAYERS},
+    )
+
+    feature_counts = main._process_layers(
+        mocker.Mock(), "tempdir", "gis", "fema", "controller", metrics.RunMetrics(mocker.Mock())
+    )
+
+    assert feature_counts == expected
+
+
+THREE_LAYERS = {"one": {"name": "one"}, "two": {"name": "two"}, "three": {"name": "three"}}
+
+
+def test_process_layers_reports_layers_not_started_after_the_breaker_opens_as_skipped(mocker, caplog):
+    _patch_config(mocker, FEMA_LAYERS=THREE_LAYERS)
+    mocker.patch("palletjack.utils.sleep")
+    mocker.patch("nfhl.main._extract_layer", side_effect=RuntimeError("FEMA is down"))
+    run_budget = budget.RunBudget(logging.getLogger("foo"), breaker_threshold=1)
+
+    feature_counts = main._process_layers(
+        logging.getLogger("foo"), "tempdir", "gis", "fema", "controller", metrics.RunMetrics(mocker.Mock()), run_budget
+    )
+
+    assert feature_counts == {"one": "error", "two": "skipped", "three": "skipped"}
+    assert "Not starting two: 1 layers failed in a row" in caplog.text
+
+
+def test_process_layers_stops_waiting_at_the_deadline(mocker):
+    _patch_config(mocker, FEMA_LAYERS=THREE_LAYERS)
+    release = threading.Event()
+
+    def _process_layer(*args):
+        if args[6]["name"] == "one":
+            release.wait(10)
+        return 1
+
+    mocker.patch("nfhl.main._process_layer", side_effect=_process_layer)
+    run_budget = budget.RunBudget(logging.getLogger("foo"), run_seconds=0.5, summary_seconds=0)
+
+    try:
+        feature_counts = main._process_layers(
+            mocker.Mock(), "tempdir", "gis", "fema", "controller", metrics.RunMetrics(mocker.Mock()), run_budget
+        )
+    finally:
+        release.set()
+
+    assert feature_counts == {"one": "timed out", "two": "skipped", "three": "skipped"}
+
+
+def test_process_layers_reports_a_layers_own_timeout_as_its_error(mocker, caplog):
+    _patch_config(mocker, FEMA_LAYERS=THREE_LAYERS)
+
+    def _process_layer(*args):
+        if args[6]["name"] == "one":
+            raise TimeoutError("The read operation timed out")
+        return 1
+
+    mocker.patch("nfhl.main._process_layer", side_effect=_process_layer)
+    run_budget = budget.RunBudget(logging.getLogger("foo"), run_seconds=60, summary_seconds=0)
+
+    feature_counts = main._process_layers(
+        logging.getLogger("foo"), "tempdir", "gis", "fema", "controller", metrics.RunMetrics(mocker.Mock()), run_budget
+    )
+
+    assert feature_counts == {"one": "error", "two": 1, "three": 1}
+    assert "Error loading one" in caplog.text
+    assert "deadline" not in caplog.text
+
+
+def test_likely_to_succeed_first_orders_by_references_probes_last_load_and_size():
+    fingerprints = {"small": {"feature_count": 10}, "big": {"feature_count": 1000}, "new": {"feature_count": 1}}
+    fingerprints.update({"unprobed": None, "panels": {"feature_count": 5000}})
+    manifest = {"small": {}, "big": {}, "unprobed": {}, "panels": {}}
+
+    order = main._likely_to_succeed_first(
+        ["unprobed", "new", "big", "small", "panels"], {"panels": None}, fingerprints, manifest
+    )
+
+    assert order == ["panels", "small", "big", "new", "unprobed"]
+
+
+def test_likely_to_succeed_first_keeps_the_order_without_probes():
+    assert main._likely_to_succeed_first(["b", "c", "a"], {"a": None}, {}, {}) == ["a", "b", "c"]
+
+
+def test_process_counts_skipped_layers_as_errors_and_reports_the_budget(mocker):
+    patched = mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    _patch_config(mocker, FEMA_LAYERS=THREE_LAYERS, BREAKER_THRESHOLD=1, RETRY_BUDGET=5)
+    mocker.patch("palletjack.utils.sleep")
+    mocker.patch("nfhl.main._extract_layer", side_effect=RuntimeError("FEMA is down"))
+
+    main.process()
+
+    summary_message = patched["_initialize"].return_value.notify.call_args.args[0]
+    assert summary_message.subject == "foo Update Summary (3 errors)"
+    assert "one: error\ntwo: skipped\nthree: skipped" in summary_message.message
+    assert "Run budget: 3 of 5 retries used, circuit breaker open" in summary_message.message
+
+
+def test_process_raises_on_enrichment_from_unknown_layer(mocker):
+    _patch_config(mocker, FEMA_LAYERS={"lomas": ENRICHED_LAYERS["lomas"]}, ENRICHMENT=True)
+
+    with pytest.raises(ValueError, match="Layers \\['panels'\\] are used for enrichment"):
+        main.process()
+
+
+def test_layer_groups_keeps_layers_enriched_from_each_other_together(mocker):
+    layers = {**ENRICHED_LAYERS, "zones": {"name": "zones"}, "lomrs": {"name": "lomrs"}}
+    layers["xs"] = {"name": "xs", "enrich": {"zones": {"fld_zone": "fld_zone"}, "panels": {"firm_pan": "firm_pan"}}}
+    _patch_config(mocker, FEMA_LAYERS=layers, ENRICHMENT=True)
+
+    groups = main._layer_groups(["lomas", "panels", "zones", "lomrs", "xs"])
+
+    assert groups == [["lomas", "panels", "zones", "xs"], ["lomrs"]]
+
+
+def test_layer_groups_is_one_layer_per_group_without_enrichment(mocker):
+    _patch_config(mocker, FEMA_LAYERS=ENRICHED_LAYERS, ENRICHMENT=False)
+
+    assert main._layer_groups(["lomas", "panels"]) == [["lomas"], ["panels"]]
+
+
+def _patch_worker(mocker, **settings):
+    mocker.patch.multiple(
+        "nfhl.main",
+        _get_secrets=mocker.DEFAULT,
+        _initialize=mocker.DEFAULT,
+        _update_hazard_layer_symbology=mocker.DEFAULT,
+        SimpleNamespace=mocker.DEFAULT,
+    )
+    mocker.patch("arcgis.gis.GIS")
+    mocker.patch("palletjack.extract.RESTServiceLoader")
+    _patch_config(mocker, FEMA_LAYERS=THREE_LAYERS, **settings)
+
+    def _process_layer(module_logger, tempdir, gis, fema_extractor, request_controller, run_metrics, layer, *args):
+        with run_metrics.stage(layer["name"], "load") as stage:
+            stage.rows = len(layer["name"])
+        return len(layer["name"])
+
+    return mocker.patch("nfhl.main._process_layer", side_effect=_process_layer)
+
+
+def _event(run_id, layer_names, results_dir):
+    return {"data": base64.b64encode(fanout.encode(run_id, layer_names, results_dir)).decode("ascii")}
+
+
+def test_process_message_only_processes_its_layers_and_saves_the_results(mocker, tmp_path):
+    process_mock = _patch_worker(mocker)
+
+    main.process_message(_event("run", ["two"], tmp_path))
+
+    assert [call.args[6]["name"] for call in process_mock.call_args_list] == ["two"]
+    result = fanout.read_results(tmp_path, "run")["two.json"]
+    assert result["feature_counts"] == {"two": 3}
+    assert [(stage["layer"], stage["stage"], stage["rows"]) for stage in result["stages"]] == [("two", "load", 3)]
+    assert result["retries"] == 0
+    assert not result["breaker_open"]
+
+
+def test_process_message_saves_errors_when_the_worker_cannot_start(mocker, tmp_path):
+    _patch_worker(mocker)
+    mocker.patch("nfhl.main._get_secrets", side_effect=FileNotFoundError("no secrets"))
+
+    main.process_message(_event("run", ["one", "two"], tmp_path))
+
+    assert fanout.read_results(tmp_path, "run")["one.json"]["feature_counts"] == {"one": "error", "two": "error"}
+
+
+def test_process_fans_layers_out_to_local_workers_and_sends_one_summary(mocker):
+    process_mock = _patch_worker(mocker, FANOUT_TOPIC="local", FANOUT_RESULTS_DIR=None, FANOUT_TIMEOUT=30)
+    mocker.patch("nfhl.main.config.FANOUT_POLL_SECONDS", 0.01)
+
+    main.process()
+
+    assert process_mock.call_count == 3
+    summary_message = main._initialize.return_value.notify.call_args.args[0]
+    assert summary_message.subject == "foo Update Summary"
+    assert "one: 3\ntwo: 3\nthree: 5" in summary_message.message
+    assert "three: load " in summary_message.message  #: the workers' stage metrics
+
+
+def test_fan_out_reports_layers_whose_worker_does_not_report_back_as_timed_out(mocker, tmp_path):
+    _patch_config(mocker, FEMA_LAYERS=THREE_LAYERS, FANOUT_RESULTS_DIR=tmp_path, FANOUT_TIMEOUT=0)
+    queue = mocker.patch("nfhl.main._fanout_queue").return_value
+    fanout.write_result(
+        tmp_path,
+        "run",
+        ["one"],
+        {
+            "feature_counts": {"one": 3},
+            "stages": [],
+            "requests": 10,
+            "failed_requests": 1,
+            "retries": 2,
+            "breaker_open": False,
+        },
+    )
+    request_controller = mocker.Mock(requests=5, failed_requests=0)
+    run_budget = budget.RunBudget(mocker.Mock())
+
+    feature_counts = main._fan_out(
+        mocker.Mock(), "tempdir", "fema", request_controller, metrics.RunMetrics(mocker.Mock()), run_budget, "run"
+    )
+
+    assert feature_counts == {"one": 3, "two": "timed out", "three": "timed out"}
+    assert queue.publish.call_count == 3
+    queue.close.assert_called_once()
+    assert request_controller.requests == 15
+    assert run_budget.retries == 2
+
+
+def test_process_raises_on_pub_sub_fan_out_without_a_results_dir(mocker):
+    _patch_config(mocker, FEMA_LAYERS=THREE_LAYERS, FANOUT_TOPIC="projects/p/topics/t", FANOUT_RESULTS_DIR=None)
+
+    with pytest.raises(ValueError, match="FANOUT_RESULTS_DIR must be set"):
+        main.process()
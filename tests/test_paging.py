@@ -0,0 +1,297 @@
+import threading
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+from nfhl import controller, paging
+
+
+class FakeServiceLayer:
+    def __init__(self, oids, failures=None):
+        self.layer_url = "https://fema/MapServer/28"
+        self.oid_field = "OBJECTID"
+        self.max_record_count = 1000
+        self.timeout = 5
+        self.oids = oids
+        self.failures = failures or {}
+        self.requested_pages = []
+
+    def check_capabilities(self, capability):
+        pass
+
+    def get_object_ids(self):
+        return self.oids
+
+    def get_unique_id_list_as_dataframe(self, unique_id_field, unique_id_list):
+        self.requested_pages.append(list(unique_id_list))
+        if self.failures.get(unique_id_list[0], 0):
+            self.failures[unique_id_list[0]] -= 1
+            raise RuntimeError(f"Page starting at {unique_id_list[0]} failed")
+        return gpd.GeoDataFrame(
+            {
+                unique_id_field: unique_id_list,
+                "DFIRM_ID": ["49035C"] * len(unique_id_list),
+                "SHAPE": [Point(oid, oid) for oid in unique_id_list],
+            },
+            geometry="SHAPE",
+            crs=4269,
+        )
+
+
+@pytest.fixture(autouse=True)
+def _no_sleep(mocker):
+    mocker.patch("nfhl.controller.time.sleep")
+
+
+def _controller(mocker, page_size=100, concurrency=1):
+    #: Pin the page size and concurrency so the pages are predictable and requested in order
+    return controller.RequestController(
+        mocker.Mock(),
+        concurrency=concurrency,
+        page_size=page_size,
+        min_concurrency=concurrency,
+        max_concurrency=concurrency,
+        min_page_size=page_size,
+        max_page_size=page_size,
+    )
+
+
+def test_get_features_assembles_pages_in_order_and_removes_scratch_dir(mocker, tmp_path):
+    service_layer = FakeServiceLayer(list(range(1, 8)))
+    scratch_dir = tmp_path / "S_Fld_Haz_Ar"
+
+    features = paging.get_features(mocker.Mock(), service_layer, scratch_dir, _controller(mocker, 3))
+
+    assert features["OBJECTID"].tolist() == list(range(1, 8))
+    assert features.index.tolist() == list(range(7))
+    assert features.crs.to_epsg() == 4269
+    assert service_layer.requested_pages == [[1, 2, 3], [4, 5, 6], [7]]
+    assert not scratch_dir.exists()
+
+
+def test_get_features_requests_up_to_the_controllers_concurrency_pages_at_once(mocker, tmp_path):
+    service_layer = FakeServiceLayer(list(range(1, 10)))
+    lock = threading.Lock()
+    in_flight = []
+    most_in_flight = 0
+    get_page = service_layer.get_unique_id_list_as_dataframe
+
+    def _slow_page(unique_id_field, unique_id_list):
+        nonlocal most_in_flight
+        with lock:
+            in_flight.append(unique_id_list[0])
+            most_in_flight = max(most_in_flight, len(in_flight))
+        threading.Event().wait(0.05)
+        with lock:
+            in_flight.remove(unique_id_list[0])
+        return get_page(unique_id_field, unique_id_list)
+
+    service_layer.get_unique_id_list_as_dataframe = _slow_page
+
+    features = paging.get_features(mocker.Mock(), service_layer, tmp_path / "layer", _controller(mocker, 1, 3))
+
+    assert most_in_flight == 3
+    assert features["OBJECTID"].tolist() == list(range(1, 10))
+    assert sorted(service_layer.requested_pages) == [[oid] for oid in range(1, 10)]
+
+
+def test_get_features_saves_pages_in_flight_when_another_page_fails(mocker, tmp_path):
+    service_layer = FakeServiceLayer(list(range(1, 5)), failures={1: 4})
+    scratch_dir = tmp_path / "layer"
+    request_controller = _controller(mocker, 2, 2)
+
+    with pytest.raises(RuntimeError, match="Page starting at 1 failed"):
+        paging.get_features(mocker.Mock(), service_layer, scratch_dir, request_controller)
+
+    assert (scratch_dir / "page_0000002_0000004.parquet").exists()
+
+
+def test_get_features_reads_pyarrow_strings_when_requested(mocker, tmp_path):
+    service_layer = FakeServiceLayer(list(range(1, 8)))
+
+    features = paging.get_features(
+        mocker.Mock(), service_layer, tmp_path / "layer", _controller(mocker, 3), arrow_strings=True
+    )
+
+    assert features["DFIRM_ID"].dtype == pd.StringDtype("pyarrow")
+    assert features["DFIRM_ID"].tolist() == ["49035C"] * 7
+    assert features.geometry.name == "SHAPE"
+
+
+def test_get_features_only_refetches_failed_pages_on_retry(mocker, tmp_path):
+    #: the page starting at 4 fails more times than the controller will try it
+    service_layer = FakeServiceLayer(list(range(1, 8)), failures={4: 4})
+    scratch_dir = tmp_path / "S_Fld_Haz_Ar"
+
+    with pytest.raises(RuntimeError, match="Page starting at 4 failed"):
+        paging.get_features(mocker.Mock(), service_layer, scratch_dir, _controller(mocker, 3))
+
+    assert (scratch_dir / "page_0000000_0000003.parquet").exists()
+    assert (scratch_dir / "object_ids.json").exists()
+
+    service_layer.requested_pages = []
+    service_layer.oids = []  #: the saved OBJECTID list is reused instead of being requested again
+    features = paging.get_features(mocker.Mock(), service_layer, scratch_dir, _controller(mocker, 3))
+
+    assert service_layer.requested_pages == [[4, 5, 6], [7]]
+    assert features["OBJECTID"].tolist() == list(range(1, 8))
+
+
+def test_get_features_returns_none_for_empty_layer(mocker, tmp_path):
+    service_layer = FakeServiceLayer([])
+
+    with pytest.warns(UserWarning, match="has no features"):
+        features = paging.get_features(mocker.Mock(), service_layer, tmp_path / "empty", _controller(mocker))
+
+    assert features is None
+    assert not (tmp_path / "empty").exists()
+
+
+class FakePartitionedServiceLayer(FakeServiceLayer):
+    def __init__(self, oids_by_where, failures=None):
+        super().__init__([], failures)
+        self.oids_by_where = oids_by_where
+        self.where_clause = "DFIRM_ID LIKE '49%'"
+        self.envelope_params = None
+
+    def get_object_ids(self):
+        return self.oids_by_where[self.where_clause]
+
+
+def test_get_partitioned_features_concatenates_and_deduplicates_partitions(mocker, tmp_path):
+    service_layer = FakePartitionedServiceLayer({"a": [1, 2, 3], "b": [3, 4], "c": []})
+    partitions = [
+        {"name": "a", "where_clause": "a"},
+        {"name": "b", "where_clause": "b"},
+        {"name": "c", "where_clause": "c"},
+    ]
+
+    features = paging.get_partitioned_features(
+        mocker.Mock(), service_layer, partitions, tmp_path / "layer", _controller(mocker, 2)
+    )
+
+    assert sorted(features["OBJECTID"].tolist()) == [1, 2, 3, 4]
+    assert features.index.tolist() == [0, 1, 2, 3]
+    assert service_layer.where_clause == "DFIRM_ID LIKE '49%'"
+    assert not (tmp_path / "layer").exists()
+
+
+def test_get_partitioned_features_only_refetches_incomplete_partitions(mocker, tmp_path):
+    service_layer = FakePartitionedServiceLayer({"a": [1, 2], "b": [3, 4], "c": []}, failures={3: 4})
+    partitions = [
+        {"name": "a", "where_clause": "a"},
+        {"name": "b", "where_clause": "b"},
+        {"name": "c", "where_clause": "c"},
+    ]
+    scratch_dir = tmp_path / "layer"
+
+    with pytest.raises(RuntimeError, match="Page starting at 3 failed"):
+        paging.get_partitioned_features(
+            mocker.Mock(), service_layer, partitions, scratch_dir, _controller(mocker, 2), max_workers=1
+        )
+
+    service_layer.requested_pages = []
+    features = paging.get_partitioned_features(
+        mocker.Mock(), service_layer, partitions, scratch_dir, _controller(mocker, 2)
+    )
+
+    assert service_layer.requested_pages == [[3, 4]]
+    assert sorted(features["OBJECTID"].tolist()) == [1, 2, 3, 4]
+
+
+def test_get_partitioned_features_returns_none_when_all_partitions_are_empty(mocker, tmp_path):
+    service_layer = FakePartitionedServiceLayer({"a": [], "b": []})
+    partitions = [{"name": "a", "where_clause": "a"}, {"name": "b", "where_clause": "b"}]
+
+    with pytest.warns(UserWarning, match="has no features"):
+        features = paging.get_partitioned_features(
+            mocker.Mock(), service_layer, partitions, tmp_path / "layer", _controller(mocker)
+        )
+
+    assert features is None
+
+
+def test_partition_layer_sets_envelope_without_changing_original_layer():
+    service_layer = FakePartitionedServiceLayer({})
+    partition = {"name": "tile", "envelope_params": {"geometry": "1,2,3,4", "inSR": "4326"}}
+
+    partition_layer = paging._partition_layer(service_layer, partition)
+
+    assert partition_layer.envelope_params == {
+        "geometryType": "esriGeometryEnvelope",
+        "geometry": "1,2,3,4",
+        "inSR": "4326",
+    }
+    assert partition_layer.where_clause == "DFIRM_ID LIKE '49%'"
+    assert service_layer.envelope_params is None
+
+
+def test_get_features_uses_current_controller_page_size_and_resumes_around_saved_pages(mocker, tmp_path):
+    service_layer = FakeServiceLayer(list(range(1, 11)), failures={6: 4})
+    request_controller = _controller(mocker, 5)
+    scratch_dir = tmp_path / "S_Fld_Haz_Ar"
+
+    with pytest.raises(RuntimeError):
+        paging.get_features(mocker.Mock(), service_layer, scratch_dir, request_controller)
+
+    #: the controller has since backed off to smaller pages
+    request_controller.page_size = request_controller.min_page_size = request_controller.max_page_size = 2
+    service_layer.requested_pages = []
+    features = paging.get_features(mocker.Mock(), service_layer, scratch_dir, request_controller)
+
+    assert service_layer.requested_pages == [[6, 7], [8, 9], [10]]
+    assert features["OBJECTID"].tolist() == list(range(1, 11))
+
+
+def test_get_features_limits_page_size_to_max_record_count(mocker, tmp_path):
+    service_layer = FakeServiceLayer(list(range(1, 6)))
+    service_layer.max_record_count = 2
+
+    paging.get_features(mocker.Mock(), service_layer, tmp_path / "layer", _controller(mocker, 100))
+
+    assert service_layer.requested_pages == [[1, 2], [3, 4], [5]]
+
+
+def test_iter_features_yields_full_batches_as_pages_arrive(mocker):
+    service_layer = FakeServiceLayer(list(range(1, 11)))
+
+    batches = paging.iter_features(mocker.Mock(), service_layer, _controller(mocker, 3), batch_size=4)
+
+    assert [batch["OBJECTID"].tolist() for batch in batches] == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+    #: Pages are trimmed to fill each batch exactly
+    assert service_layer.requested_pages == [[1, 2, 3], [4], [5, 6, 7], [8], [9, 10]]
+
+
+def test_iter_features_is_lazy(mocker):
+    service_layer = FakeServiceLayer(list(range(1, 11)))
+
+    batches = paging.iter_features(mocker.Mock(), service_layer, _controller(mocker, 5), batch_size=5)
+    first_batch = next(batches)
+
+    assert first_batch["OBJECTID"].tolist() == [1, 2, 3, 4, 5]
+    assert service_layer.requested_pages == [[1, 2, 3, 4, 5]]
+
+
+def test_iter_features_skips_features_already_returned_by_an_earlier_partition(mocker):
+    service_layer = FakePartitionedServiceLayer({"a": [1, 2, 3], "b": [3, 4], "c": []})
+    partitions = [
+        {"name": "a", "where_clause": "a"},
+        {"name": "b", "where_clause": "b"},
+        {"name": "c", "where_clause": "c"},
+    ]
+
+    batches = list(
+        paging.iter_features(mocker.Mock(), service_layer, _controller(mocker, 2), batch_size=3, partitions=partitions)
+    )
+
+    assert [batch["OBJECTID"].tolist() for batch in batches] == [[1, 2, 3], [4]]
+    assert service_layer.requested_pages == [[1, 2], [3], [4]]
+    assert service_layer.where_clause == "DFIRM_ID LIKE '49%'"
+
+
+def test_iter_features_yields_nothing_for_empty_layer(mocker):
+    service_layer = FakeServiceLayer([])
+
+    assert not list(paging.iter_features(mocker.Mock(), service_layer, _controller(mocker), batch_size=10))
@@ -0,0 +1,93 @@
+import logging
+import pstats
+import threading
+import tracemalloc
+
+import pytest
+
+from nfhl import profiling
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    stage_profiler = profiling.StageProfiler(logging.getLogger("foo"), tmp_path / "profiles", top=5)
+    stage_profiler.start()
+    yield stage_profiler
+    stage_profiler.stop()
+
+
+def _allocate_rows():
+    return [f"row {number}" * 10 for number in range(20_000)]
+
+
+def test_profile_saves_cpu_profile_and_allocation_report(profiler):
+    with profiler.profile("S_XS", "transform"):
+        rows = _allocate_rows()
+
+    stats = pstats.Stats(str(profiler.profile_dir / "S_XS_transform.pstats"))
+    assert any(function == "_allocate_rows" for _, _, function in stats.stats)
+    report = (profiler.profile_dir / "S_XS_transform_allocations.txt").read_text(encoding="utf-8")
+    assert report.startswith("S_XS transform\nTraced memory grew by ")
+    assert "Top 5 allocation sites by growth:" in report
+    assert "test_profiling.py" in report
+    assert profiler.profiled == [("S_XS", "transform")]
+    assert len(rows) == 20_000
+
+
+def test_profile_saves_profiles_when_the_stage_raises(profiler):
+    with pytest.raises(RuntimeError, match="load failed"), profiler.profile("S_XS", "load"):
+        raise RuntimeError("load failed")
+
+    assert (profiler.profile_dir / "S_XS_load.pstats").exists()
+    assert (profiler.profile_dir / "S_XS_load_allocations.txt").exists()
+
+
+def test_profile_only_cpu_profiles_one_stage_at_a_time(profiler):
+    started = threading.Event()
+    release = threading.Event()
+
+    def _other_stage():
+        with profiler.profile("S_BFE", "extract"):
+            started.set()
+            release.wait(5)
+
+    other = threading.Thread(target=_other_stage)
+    other.start()
+    started.wait(5)
+    with profiler.profile("S_XS", "extract"):
+        pass
+    release.set()
+    other.join()
+
+    assert (profiler.profile_dir / "S_BFE_extract.pstats").exists()
+    assert not (profiler.profile_dir / "S_XS_extract.pstats").exists()
+    report = (profiler.profile_dir / "S_XS_extract_allocations.txt").read_text(encoding="utf-8")
+    assert "Not CPU-profiled" in report
+    assert sorted(profiler.profiled) == [("S_BFE", "extract"), ("S_XS", "extract")]
+
+
+def test_stop_only_stops_tracing_that_start_started(tmp_path):
+    tracemalloc.start()
+    try:
+        stage_profiler = profiling.StageProfiler(logging.getLogger("foo"), tmp_path)
+        stage_profiler.start()
+        stage_profiler.stop()
+
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+    stage_profiler.start()
+    stage_profiler.stop()
+    assert not tracemalloc.is_tracing()
+
+
+def test_profile_after_stop_skips_the_allocation_report(profiler):
+    profiler.stop()
+
+    with profiler.profile("S_XS", "load"):
+        pass
+
+    report = (profiler.profile_dir / "S_XS_load_allocations.txt").read_text(encoding="utf-8")
+    assert "Allocations weren't traced" in report
+    assert (profiler.profile_dir / "S_XS_load.pstats").exists()
@@ -0,0 +1,315 @@
+import logging
+import struct
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import MultiLineString, MultiPolygon, Point, Polygon
+
+from nfhl import query
+
+
+def _varint(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _zigzag(value):
+    return _varint(value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def _field(number, payload):
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _double(number, value):
+    return _varint(number << 3 | 1) + struct.pack("<d", value)
+
+
+def _feature_collection(geometry_type, fields, features, origin=0, scale=(0.5, 0.5), translate=(10.0, 20.0)):
+    #: fields is [(name, field type)], features is [(encoded values, parts as lists of quantized points or None)]
+    result = _field(1, b"OBJECTID") + _varint(7 << 3) + _varint(geometry_type)
+    result += _field(8, _varint(1 << 3) + _varint(4269))
+    transform = _field(2, _double(1, scale[0]) + _double(2, scale[1]))
+    transform += _field(3, _double(1, translate[0]) + _double(2, translate[1]))
+    result += _field(12, (_varint(1 << 3) + _varint(origin) if origin else b"") + transform)
+    result += b"".join(_field(13, _field(1, name.encode()) + _varint(2 << 3) + _varint(kind)) for name, kind in fields)
+    for values, parts in features:
+        feature = b"".join(_field(1, value) for value in values)
+        if parts is not None:
+            coords, previous = [], (0, 0)
+            for point in (point for part in parts for point in part):
+                coords.extend([point[0] - previous[0], point[1] - previous[1]])
+                previous = point
+            lengths = _field(2, b"".join(_varint(len(part)) for part in parts)) if geometry_type else b""
+            feature += _field(2, lengths + _field(3, b"".join(_zigzag(value) for value in coords)))
+        result += _field(15, feature)
+    return _field(2, _field(1, result))
+
+
+def _oid(value):
+    return _varint(5 << 3) + _varint(value)
+
+
+def test_decode_features_builds_polygons_with_holes_and_multiple_parts():
+    #: With the default upper left origin, y = 20 - qy * 0.5; outer rings are clockwise once flipped, holes aren't
+    outer = [(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)]
+    hole = [(1, 1), (1, 2), (2, 2), (2, 1), (1, 1)]
+    second = [(10, 0), (12, 0), (12, 2), (10, 2), (10, 0)]
+    content = _feature_collection(
+        query.POLYGON,
+        [("OBJECTID", 6)],
+        [([_oid(2)], [outer, hole, second]), ([_oid(1)], [outer, hole]), ([_oid(3)], None)],
+    )
+
+    features_df = query.decode_features(content)
+
+    assert features_df["OBJECTID"].tolist() == [1, 2, 3]
+    assert features_df.geometry.name == "SHAPE"
+    assert features_df.crs.to_epsg() == 4269
+    polygon = Polygon(
+        [(10, 20), (12, 20), (12, 18), (10, 18), (10, 20)], [[(10.5, 19.5), (10.5, 19), (11, 19), (11, 19.5)]]
+    )
+    assert features_df["SHAPE"][0].equals(polygon)
+    assert isinstance(features_df["SHAPE"][1], MultiPolygon)
+    assert features_df["SHAPE"][1].equals(
+        MultiPolygon([polygon, Polygon([(15, 20), (16, 20), (16, 19), (15, 19), (15, 20)])])
+    )
+    assert features_df["SHAPE"][2] is None
+
+
+def test_decode_features_builds_multilinestrings_from_a_lower_left_origin():
+    content = _feature_collection(
+        query.POLYLINE,
+        [("OBJECTID", 6)],
+        [([_oid(1)], [[(0, 0), (2, 2)], [(4, 0), (6, 2), (8, 0)]])],
+        origin=query.LOWER_LEFT,
+    )
+
+    features_df = query.decode_features(content)
+
+    assert features_df["SHAPE"][0].equals(MultiLineString([[(10, 20), (11, 21)], [(12, 20), (13, 21), (14, 20)]]))
+
+
+def test_decode_features_converts_attributes_like_the_json_path():
+    from arcgis.features import FeatureSet
+    from palletjack import utils
+
+    fields = [("OBJECTID", 6), ("NAME", 4), ("ELEV", 3), ("SEQ", 1), ("EFF_DATE", 5), ("SMALL", 0), ("RATIO", 2)]
+    content = _feature_collection(
+        query.POINT,
+        fields,
+        [
+            (
+                [_oid(1), _field(1, "é".encode()), _double(3, 1.5), _varint(4 << 3) + _zigzag(-3)]
+                + [_varint(8 << 3) + _zigzag(946_684_800_000), _varint(4 << 3) + _zigzag(7)]
+                + [_varint(2 << 3 | 5) + struct.pack("<f", 0.1)],
+                [[(2, 2)]],
+            ),
+            ([_oid(2), b"", b"", b"", b"", b"", b""], None),
+        ],
+    )
+    json_df = FeatureSet.from_json(
+        '{"geometryType": "esriGeometryPoint", "spatialReference": {"wkid": 4269}, "fields": ['
+        '{"name": "OBJECTID", "type": "esriFieldTypeOID"}, {"name": "NAME", "type": "esriFieldTypeString"}, '
+        '{"name": "ELEV", "type": "esriFieldTypeDouble"}, {"name": "SEQ", "type": "esriFieldTypeInteger"}, '
+        '{"name": "EFF_DATE", "type": "esriFieldTypeDate"}, {"name": "SMALL", "type": "esriFieldTypeSmallInteger"}, '
+        '{"name": "RATIO", "type": "esriFieldTypeSingle"}], "features": ['
+        '{"attributes": {"OBJECTID": 1, "NAME": "é", "ELEV": 1.5, "SEQ": -3, "EFF_DATE": 946684800000, "SMALL": 7, '
+        '"RATIO": 0.1}, "geometry": {"x": 11, "y": 19}}, {"attributes": {"OBJECTID": 2, "NAME": null, "ELEV": null, '
+        '"SEQ": null, "EFF_DATE": null, "SMALL": null, "RATIO": null}, "geometry": null}]}'
+    ).sdf
+
+    features_df = query.decode_features(content)
+
+    assert features_df.dtypes.astype(str).to_dict() == json_df.dtypes.astype(str).to_dict()
+    assert query._difference(features_df, utils.convert_to_gdf(json_df)) is None
+    assert features_df["NAME"].tolist() == ["é", pd.NA]
+    assert features_df["ELEV"][0] == 1.5
+    assert features_df["SEQ"][0] == -3
+    assert features_df["EFF_DATE"][0] == pd.Timestamp("2000-01-01")
+    assert features_df["SMALL"][0] == 7
+    assert features_df["RATIO"][0] == pytest.approx(0.1)
+    assert features_df.iloc[1].drop(["OBJECTID", "SHAPE"]).isna().all()
+    assert features_df["SHAPE"][0].equals(Point(11, 19))
+    assert features_df["SHAPE"][1] is None
+
+
+def test_decode_varints_handles_multibyte_and_negative_values():
+    values = [0, 1, -1, 63, -64, 300, -70_000, 2**40, -(2**40)]
+
+    decoded = query._decode_zigzags(b"".join(_zigzag(value) for value in values))
+
+    assert decoded.tolist() == values
+    assert decoded.dtype == np.int64
+
+
+def test_decode_features_raises_on_a_json_response():
+    with pytest.raises(ValueError):
+        query.decode_features(b'{"error": {"code": 400, "message": "Invalid or missing input parameters."}}')
+
+
+def test_make_session_pools_connections_and_accepts_gzip():
+    session = query.make_session(12)
+
+    adapter = session.get_adapter("https://hazards.fema.gov")
+    assert adapter._pool_maxsize == 12
+    assert adapter.max_retries.total == 0
+    assert "gzip" in session.headers["Accept-Encoding"]
+
+
+def _session(mocker, supported_formats="JSON, geoJSON, PBF"):
+    session = mocker.Mock()
+    session.get.return_value.json.return_value = {
+        "type": "Feature Layer",
+        "capabilities": "Map,Query,Data",
+        "maxRecordCount": 2000,
+        "objectIdField": "OBJECTID",
+        "supportedQueryFormats": supported_formats,
+    }
+    return session
+
+
+def test_service_layer_uses_pbf_only_when_the_layer_supports_it(mocker):
+    supported = query.ServiceLayer(mocker.Mock(), "https://fema/MapServer/28/", _session(mocker), query_format="pbf")
+    unsupported = query.ServiceLayer(
+        mocker.Mock(), "https://fema/MapServer/28", _session(mocker, "JSON, geoJSON"), query_format="pbf"
+    )
+
+    assert supported.query_format == "pbf"
+    assert supported.layer_url == "https://fema/MapServer/28"
+    assert supported.max_record_count == 2000
+    assert unsupported.query_format == "json"
+
+
+def _point_json(*points):
+    #: The json response for (OBJECTID, x, y) points
+    features = ", ".join(
+        f'{{"attributes": {{"OBJECTID": {oid}}}, "geometry": {{"x": {x}, "y": {y}}}}}' for oid, x, y in points
+    )
+    return (
+        '{"geometryType": "esriGeometryPoint", "spatialReference": {"wkid": 4269}, "fields": '
+        f'[{{"name": "OBJECTID", "type": "esriFieldTypeOID"}}], "features": [{features}]}}'
+    )
+
+
+def _respond(mocker, session, pbf_content, json_text):
+    #: Answer each query in the format it asks for
+    def _post(url, data, timeout):
+        response = mocker.Mock(status_code=200)
+        response.content, response.text = (pbf_content, None) if data["f"] == "pbf" else (None, json_text)
+        return response
+
+    session.post.side_effect = _post
+
+
+def test_service_layer_requests_pages_as_pbf_and_checks_the_first_against_json(mocker):
+    session = _session(mocker)
+    #: With the default upper left origin, the quantized points (0, 0) and (2, 2) are (10, 20) and (11, 19)
+    pbf_content = _feature_collection(
+        query.POINT, [("OBJECTID", 6)], [([_oid(2)], [[(0, 0)]]), ([_oid(1)], [[(2, 2)]])]
+    )
+    _respond(mocker, session, pbf_content, _point_json((1, 11, 19), (2, 10, 20)))
+    service_layer = query.ServiceLayer(mocker.Mock(), "https://fema/MapServer/28", session, query_format="pbf")
+
+    features_df = service_layer.get_unique_id_list_as_dataframe("OBJECTID", [1, 2])
+    service_layer.get_unique_id_list_as_dataframe("OBJECTID", [1, 2])
+
+    assert features_df["OBJECTID"].tolist() == [1, 2]
+    assert session.post.call_args.args[0] == "https://fema/MapServer/28/query"
+    assert session.post.call_args.kwargs["data"]["where"] == "OBJECTID in (1,2)"
+    assert [call.kwargs["data"]["f"] for call in session.post.call_args_list] == ["pbf", "json", "pbf"]
+    assert service_layer.pbf_checked
+    assert service_layer.query_format == "pbf"
+
+
+def test_service_layer_falls_back_to_json_when_pbf_does_not_match(mocker, caplog):
+    from palletjack import utils
+
+    session = _session(mocker)
+    pbf_content = _feature_collection(query.POINT, [("OBJECTID", 6)], [([_oid(1)], [[(2, 2)]])])
+    _respond(mocker, session, pbf_content, _point_json((1, 11, 25)))
+    service_layer = query.ServiceLayer(
+        logging.getLogger("foo"), "https://fema/MapServer/28", session, query_format="pbf"
+    )
+
+    features_df = service_layer.get_unique_id_list_as_dataframe("OBJECTID", [1])
+    service_layer.get_unique_id_list_as_dataframe("OBJECTID", [1])
+
+    assert utils.convert_to_gdf(features_df)["SHAPE"].iloc[0].equals(Point(11, 25))
+    assert [call.kwargs["data"]["f"] for call in session.post.call_args_list] == ["pbf", "json", "json"]
+    assert service_layer.query_format == "json"
+    assert "pbf features from https://fema/MapServer/28 don't match json" in caplog.text
+    assert "the geometry in row 0 is 6 from json's" in caplog.text
+
+
+def test_difference_allows_for_quantization_but_not_changed_values():
+    pbf_df = gpd.GeoDataFrame(
+        {"OBJECTID": [1, 2], "NAME": ["a", None], "ELEV": [0.1, None]},
+        geometry=[Polygon([(0, 0), (0, 1), (1, 1), (0, 0)]), None],
+    ).rename_geometry("SHAPE")
+    pbf_df.attrs["xy_resolution"] = 0.01
+    #: json's polygon starts at another vertex and is a few thousandths off; the rest match
+    json_df = pbf_df.copy()
+    json_df["SHAPE"] = [Polygon([(0.004, 1), (1, 1.003), (0, 0), (0.004, 1)]), None]
+    json_df["ELEV"] = [0.1 + 1e-9, None]
+
+    assert query._difference(pbf_df, json_df) is None
+
+    json_df.loc[1, "NAME"] = "b"
+    assert query._difference(pbf_df, json_df) == "NAME is None from pbf but 'b' from json in row 1"
+
+
+def test_service_layer_falls_back_to_json_when_pbf_cannot_be_decoded(mocker, caplog):
+    session = _session(mocker)
+    session.post.return_value.status_code = 200
+    session.post.return_value.content = b'{"error": {"code": 500}}'
+    session.post.return_value.text = (
+        '{"geometryType": "esriGeometryPoint", "spatialReference": {"wkid": 4269}, "fields": '
+        '[{"name": "OBJECTID", "type": "esriFieldTypeOID"}], "features": [{"attributes": {"OBJECTID": 1}, '
+        '"geometry": {"x": 1, "y": 2}}]}'
+    )
+    service_layer = query.ServiceLayer(
+        logging.getLogger("foo"), "https://fema/MapServer/28", session, query_format="pbf"
+    )
+
+    features_df = service_layer.get_unique_id_list_as_dataframe("OBJECTID", [1])
+
+    assert features_df["OBJECTID"].tolist() == [1]
+    assert [call.kwargs["data"]["f"] for call in session.post.call_args_list] == ["pbf", "json"]
+    assert service_layer.query_format == "json"
+    assert "Could not decode pbf features" in caplog.text
+
+
+def test_service_layer_raises_on_missing_features(mocker):
+    session = _session(mocker)
+    pbf_content = _feature_collection(query.POINT, [("OBJECTID", 6)], [([_oid(1)], [[(0, 0)]])])
+    _respond(mocker, session, pbf_content, _point_json((1, 10, 20)))
+    service_layer = query.ServiceLayer(mocker.Mock(), "https://fema/MapServer/28", session, query_format="pbf")
+
+    with pytest.raises(RuntimeError, match="2 OIDs requested, but 1 features downloaded"):
+        service_layer.get_unique_id_list_as_dataframe("OBJECTID", [1, 2])
+
+
+def test_service_layer_get_object_ids_applies_envelope_and_sorts(mocker):
+    session = _session(mocker)
+    service_layer = query.ServiceLayer(mocker.Mock(), "https://fema/MapServer/28", session, where_clause="a = 1")
+    service_layer.envelope_params = {"geometryType": "esriGeometryEnvelope", "geometry": "0,0,1,1"}
+    session.get.return_value.json.return_value = {"objectIdFieldName": "OBJECTID", "objectIds": [3, 1, 2]}
+
+    assert service_layer.get_object_ids() == [1, 2, 3]
+    assert session.get.call_args.kwargs["params"]["where"] == "a = 1"
+    assert session.get.call_args.kwargs["params"]["geometry"] == "0,0,1,1"
+
+    session.get.return_value.json.return_value = {"objectIdFieldName": "OBJECTID", "objectIds": None}
+    assert service_layer.get_object_ids() == []
+
+
+def test_service_layer_rejects_unknown_query_formats(mocker):
+    with pytest.raises(ValueError, match="Unknown query format geojson"):
+        query.ServiceLayer(mocker.Mock(), "https://fema/MapServer/28", _session(mocker), query_format="geojson")
@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+import fsspec
+import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
+import pyogrio
+import pytest
+from shapely.geometry import box
+
+from nfhl import sinks
+
+
+def _hazard_areas(count=3):
+    return gpd.GeoDataFrame(
+        {
+            "fld_zone": ["AE"] * count,
+            "label": pd.Categorical(["1% Annual Chance Flood Hazard"] * count),
+            "study_typ": ["NP"] * count,
+            "SHAPE": [box(-112 + x * 0.01, 40, -112 + x * 0.01 + 0.005, 40.005) for x in range(count)],
+        },
+        geometry="SHAPE",
+        crs=4269,
+    )
+
+
+def test_publish_replaces_local_file_without_leaving_temp_file(tmp_path):
+    local_path = tmp_path / "scratch" / "S_XS.parquet"
+    local_path.parent.mkdir()
+    local_path.write_text("new")
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    (output_dir / "S_XS.parquet").write_text("old")
+
+    published = sinks.publish(local_path, output_dir)
+
+    assert published == str(output_dir / "S_XS.parquet")
+    assert (output_dir / "S_XS.parquet").read_text() == "new"
+    assert [path.name for path in output_dir.iterdir()] == ["S_XS.parquet"]
+
+
+def test_publish_uploads_to_fsspec_urls(tmp_path):
+    local_path = tmp_path / "S_XS.parquet"
+    local_path.write_text("data")
+
+    published = sinks.publish(local_path, "memory://bucket/nfhl/")
+
+    assert published == "memory://bucket/nfhl/S_XS.parquet"
+    with fsspec.open(published, "rt") as published_file:
+        assert published_file.read() == "data"
+
+
+def test_write_geoparquet_round_trips_with_bbox_covering(tmp_path):
+    published = sinks.write_geoparquet("S_Fld_Haz_Ar", _hazard_areas(), tmp_path / "scratch", tmp_path / "out")
+
+    archived = gpd.read_parquet(published)
+
+    assert Path(published).name == "S_Fld_Haz_Ar.parquet"
+    assert archived.geometry.name == "SHAPE"
+    assert archived.crs.to_epsg() == 4269
+    assert isinstance(archived["label"].dtype, pd.CategoricalDtype)
+    assert "bbox" in pq.read_schema(published).names
+    assert not list((tmp_path / "scratch").iterdir())
+
+
+def test_write_vector_tiles_keeps_only_the_tile_fields(tmp_path):
+    published = sinks.write_vector_tiles(
+        "S_Fld_Haz_Ar",
+        _hazard_areas(),
+        tmp_path / "scratch",
+        tmp_path / "out",
+        tile_format="mbtiles",
+        fields=["label", "fld_zone", "not_a_field"],
+        min_zoom=4,
+        max_zoom=8,
+    )
+
+    info = pyogrio.read_info(published, layer="S_Fld_Haz_Ar")
+
+    assert Path(published).name == "S_Fld_Haz_Ar.mbtiles"
+    assert set(info["fields"]) == {"mvt_id", "label", "fld_zone"}
+    assert info["features"] == 3
+
+
+def test_write_vector_tiles_builds_pmtiles_by_default(tmp_path):
+    published = sinks.write_vector_tiles("S_Fld_Haz_Ar", _hazard_areas(), tmp_path / "scratch", tmp_path / "out")
+
+    assert Path(published).name == "S_Fld_Haz_Ar.pmtiles"
+    assert pyogrio.list_layers(published)[0][0] == "S_Fld_Haz_Ar"
+
+
+def test_write_vector_tiles_raises_on_unknown_format(tmp_path):
+    with pytest.raises(ValueError, match="Unknown vector tile format geojson"):
+        sinks.write_vector_tiles("S_Fld_Haz_Ar", _hazard_areas(), tmp_path, tmp_path, tile_format="geojson")
+
+
+def test_maplibre_style_matches_the_hosted_layer_symbology():
+    drawing_info = json.loads((Path(sinks.__file__).parent / "fld_haz_ar_drawingInfo.json").read_text())
+
+    style = sinks.maplibre_style(drawing_info, "S_Fld_Haz_Ar", "pmtiles://https://example.com/S_Fld_Haz_Ar.pmtiles")
+
+    assert style["sources"]["S_Fld_Haz_Ar"]["url"] == "pmtiles://https://example.com/S_Fld_Haz_Ar.pmtiles"
+    fill_color = style["layers"][0]["paint"]["fill-color"]
+    assert fill_color[:2] == ["match", ["get", "label"]]
+    colors = dict(zip(fill_color[2:-1:2], fill_color[3:-1:2]))
+    assert colors["1% Annual Chance Flood Hazard"] == "rgba(0, 230, 255, 0.77)"
+    assert colors["Regulatory Floodway"] == "rgba(255, 0, 0, 0.77)"  #: the hatch lines' color
+    assert colors[""] == "rgba(179, 238, 255, 0)"  #: <Null>
+    assert fill_color[-1] == "rgba(130, 130, 130, 1)"
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from nfhl import state
+
+
+def test_probe_layer_builds_fingerprint_from_statistics(mocker):
+    get_mock = mocker.patch("nfhl.state.requests.get")
+    get_mock.return_value.json.return_value = {
+        "features": [{"attributes": {"FEATURE_COUNT": 42, "MAX_OID": 100, "MAX_DATE": 1700000000000}}]
+    }
+    layer = {"name": "S_LOMR", "number": 1, "where_clause": "foo = 'bar'", "change_date_field": "EFF_DATE"}
+
+    fingerprint = state.probe_layer("https://fema/MapServer", layer, 20)
+
+    assert fingerprint == {
+        "where_clause": "foo = 'bar'",
+        "config": state.config_digest(layer),
+        "feature_count": 42,
+        "max_oid": 100,
+        "max_date": 1700000000000,
+    }
+    assert get_mock.call_args.args[0] == "https://fema/MapServer/1/query"
+    statistics = json.loads(get_mock.call_args.kwargs["params"]["outStatistics"])
+    assert [statistic["outStatisticFieldName"] for statistic in statistics] == ["feature_count", "max_oid", "max_date"]
+    assert statistics[2]["onStatisticField"] == "EFF_DATE"
+
+
+def test_probe_layer_skips_date_statistic_without_change_date_field(mocker):
+    get_mock = mocker.patch("nfhl.state.requests.get")
+    get_mock.return_value.json.return_value = {"features": [{"attributes": {"feature_count": 1, "max_oid": 1}}]}
+    layer = {"name": "S_XS", "number": 14, "where_clause": "1=1"}
+
+    state.probe_layer("https://fema/MapServer", layer, 20)
+
+    statistics = json.loads(get_mock.call_args.kwargs["params"]["outStatistics"])
+    assert len(statistics) == 2
+
+
+def test_config_digest_changes_with_the_layer_settings_and_version():
+    layer = {"name": "S_Wtr_Ln", "number": 20, "where_clause": "1=1", "partitions": [{"name": "a"}]}
+
+    digest = state.config_digest(layer, "1.0.0")
+
+    assert digest == state.config_digest(dict(reversed(layer.items())), "1.0.0")
+    assert digest != state.config_digest({**layer, "simplify_tolerance": 0.00001}, "1.0.0")
+    assert digest != state.config_digest(layer, "1.0.1")
+
+
+def test_probe_layer_raises_on_error_response(mocker):
+    get_mock = mocker.patch("nfhl.state.requests.get")
+    get_mock.return_value.json.return_value = {"error": {"code": 400, "message": "Invalid field"}}
+    layer = {"name": "S_XS", "number": 14, "where_clause": "1=1"}
+
+    with pytest.raises(RuntimeError, match="Could not get statistics for S_XS"):
+        state.probe_layer("https://fema/MapServer", layer, 20)
+
+
+def test_manifest_round_trip(tmp_path):
+    manifest_path = tmp_path / "state" / "manifest.json"
+
+    assert state.load_manifest(manifest_path) == {}
+
+    state.save_manifest(manifest_path, {"S_XS": {"feature_count": 1}})
+
+    assert state.load_manifest(manifest_path) == {"S_XS": {"feature_count": 1}}
+    assert not manifest_path.with_suffix(".tmp").exists()
+
+
+def test_load_manifest_ignores_corrupt_file(tmp_path):
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text("{not json", encoding="utf-8")
+
+    assert state.load_manifest(manifest_path) == {}
@@ -0,0 +1,117 @@
+import geopandas as gpd
+import pandas as pd
+from arcgis.features import GeoAccessor  # noqa: F401  #: registers pd.DataFrame.spatial
+from shapely.geometry import Point
+
+from nfhl import sync
+
+
+def _features(keys, names, xs):
+    return gpd.GeoDataFrame(
+        {
+            "OBJECTID": range(1, len(keys) + 1),
+            "global_id": keys,
+            "name": names,
+            "SHAPE": [Point(x, 0) for x in xs],
+        },
+        geometry="SHAPE",
+        crs=4269,
+    )
+
+
+def test_hash_features_ignores_null_vs_empty_string_and_storage_rounding():
+    source = _features(["a", "b"], ["foo", None], [1.0, 2.0])
+    live = _features(["a", "b"], ["foo", ""], [1.00000000001, 2.0])
+
+    source_hashes = sync.hash_features(source, "global_id", ["name"], 0.0000001)
+    live_hashes = sync.hash_features(live, "global_id", ["name"], 0.0000001)
+
+    assert source_hashes.index.tolist() == ["a", "b"]
+    assert (source_hashes == live_hashes).all()
+
+
+def test_hash_features_detects_attribute_and_geometry_changes():
+    source = _features(["a", "b", "c"], ["foo", "bar", "baz"], [1.0, 2.0, 3.0])
+    live = _features(["a", "b", "c"], ["foo", "changed", "baz"], [1.0, 2.0, 3.5])
+
+    source_hashes = sync.hash_features(source, "global_id", ["name"], 0.0000001)
+    live_hashes = sync.hash_features(live, "global_id", ["name"], 0.0000001)
+
+    assert (source_hashes == live_hashes).tolist() == [True, False, False]
+
+
+def test_diff_features_finds_adds_updates_and_deletes():
+    new = _features(["a", "b", "d"], ["foo", "changed", "new"], [1.0, 2.0, 4.0])
+    live = _features(["a", "b", "c"], ["foo", "bar", "gone"], [1.0, 2.0, 3.0])
+    live["OBJECTID"] = [10, 11, 12]
+
+    adds, updates, deletes = sync.diff_features(new, live, "global_id", 0.0000001)
+
+    assert adds["global_id"].tolist() == ["d"]
+    assert updates["global_id"].tolist() == ["b"]
+    assert deletes == [12]
+
+
+def test_delta_load_adds_and_updates_before_deleting(mocker):
+    new = _features(["a", "b", "d"], ["foo", "changed", "new"], [1.0, 2.0, 4.0])
+    live = _features(["a", "b", "c"], ["foo", "bar", "gone"], [1.0, 2.0, 3.0])
+    updater = mocker.Mock()
+    updater.service.properties.fields = [{"name": "OBJECTID"}, {"name": "global_id"}, {"name": "name"}]
+    updater.service.query.return_value.sdf = pd.DataFrame.spatial.from_geodataframe(live, column_name="SHAPE")
+    manager = mocker.Mock()
+    manager.attach_mock(updater.add, "add")
+    manager.attach_mock(updater.update, "update")
+    manager.attach_mock(updater.remove, "remove")
+    updater.add.return_value = 1
+    updater.update.return_value = 1
+    updater.remove.return_value = 1
+
+    result = sync.delta_load(mocker.Mock(), updater, new, "global_id", 0.0000001)
+
+    assert result == 3
+    assert [call[0] for call in manager.mock_calls] == ["add", "update", "remove"]
+    assert updater.update.call_args.kwargs["matching_field"] == "global_id"
+    assert updater.service.query.call_args.kwargs["out_fields"] == "OBJECTID,global_id,name"
+    assert updater.service.query.call_args.kwargs["out_sr"] == 4269
+    updater.truncate_and_load.assert_not_called()
+
+
+def test_delta_load_skips_empty_operations(mocker):
+    new = _features(["a"], ["foo"], [1.0])
+    updater = mocker.Mock()
+    updater.service.properties.fields = [{"name": "OBJECTID"}, {"name": "global_id"}, {"name": "name"}]
+    updater.service.query.return_value.sdf = pd.DataFrame.spatial.from_geodataframe(new, column_name="SHAPE")
+
+    result = sync.delta_load(mocker.Mock(), updater, new, "global_id", 0.0000001)
+
+    assert result == 0
+    updater.add.assert_not_called()
+    updater.update.assert_not_called()
+    updater.remove.assert_not_called()
+
+
+def test_delta_load_falls_back_to_truncate_and_load_on_duplicate_keys(mocker):
+    new = _features(["a", "a"], ["foo", "bar"], [1.0, 2.0])
+    updater = mocker.Mock()
+    updater.truncate_and_load.return_value = 2
+
+    result = sync.delta_load(mocker.Mock(), updater, new, "global_id", 0.0000001)
+
+    assert result == 2
+    updater.service.query.assert_not_called()
+
+
+def test_delta_load_falls_back_to_truncate_and_load_on_duplicate_live_keys(mocker):
+    new = _features(["a", "b"], ["foo", "bar"], [1.0, 2.0])
+    live = _features(["a", "a", "b"], ["foo", "foo", "bar"], [1.0, 1.0, 2.0])
+    updater = mocker.Mock()
+    updater.service.properties.fields = [{"name": "OBJECTID"}, {"name": "global_id"}, {"name": "name"}]
+    updater.service.query.return_value.sdf = pd.DataFrame.spatial.from_geodataframe(live, column_name="SHAPE")
+    updater.truncate_and_load.return_value = 2
+
+    result = sync.delta_load(mocker.Mock(), updater, new, "global_id", 0.0000001)
+
+    assert result == 2
+    updater.add.assert_not_called()
+    updater.update.assert_not_called()
+    updater.remove.assert_not_called()